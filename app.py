@@ -1,14 +1,17 @@
 # Python standard libraries
+import time
+started = time.perf_counter()
 import json
+import hmac
 import os
-import datetime
 import logging
 import random
+import functools
 import string
 
 # Third-party libraries
-from flask import Flask, render_template, session, request, redirect, url_for, jsonify
-from flask_socketio import SocketIO, emit, join_room, close_room
+from flask import Flask, Blueprint, Response, current_app, render_template, session, request, redirect, url_for, jsonify, send_from_directory
+from flask_socketio import SocketIO, emit, join_room, close_room, rooms as socket_rooms
 from flask_login import LoginManager, current_user, login_required, login_user, logout_user
 from oauthlib.oauth2 import WebApplicationClient
 from requests import get, post
@@ -17,20 +20,31 @@ from werkzeug.exceptions import HTTPException, BadRequest
 from apscheduler.schedulers.background import BackgroundScheduler
 
 # Internal imports
-from classes import User, AnonymousUser, CharacterValidation, RoomValidation, SitenameValidation
-from db import create_dbs, add_to_db, read_db, delete_from_db, update_db, build_api_db, get_api_info, build_error_db, add_to_error_db, read_error_db
+from classes import User, AnonymousUser, CharacterValidation, RoomValidation, SitenameValidation, RateLimiter
+import retention
+import metrics
+from errors import error_store
+from logs import http_log, combat_log, token_log, configure_logging
+from archive import archive_room, list_archives, user_archive_dir
+from room_state import rooms, get_room, change_room, drop_room, evict_user, set_write_through, find_open_room, open_room, forget_open_room
+from db import current_timestamp, add_to_db, select, select_one, update, delete, get_api_json, read_error_db, error_group_columns, setup_timings, get_user, get_characters, get_character, invalidate_user, invalidate_characters, cache_stats, read_history, history_json, history_columns, history_page_size, write_behind
 
 
 ### SET VARIABLES AND INITIALIZE PRIMARY PROCESSES
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'secret!'
-app.secret_key = os.environ.get("SECRET_KEY") or os.urandom(24)
+# The app itself is built by create_app below. The databases and the race/class catalog are set up the
+# first time they are used (see db.prepare_db), so importing this module and creating an app stay cheap
+main = Blueprint("main", __name__)
+imports_done = time.perf_counter()
 global spam_timeout # in seconds
 spam_timeout = 10 
 global spam_penalty # in seconds
 spam_penalty = 30
 global spam_max_messages
 spam_max_messages = 5
+# Flood limits for the other room events, per user and room: (max events, per seconds)
+token_move_limit = (20, 1)
+initiative_limit = (10, 10)
+npc_limit = (10, 10)
 npc_images = ["http://upload.wikimedia.org/wikipedia/commons/thumb/f/f7/Auto_Racing_Black_Box.svg/800px-Auto_Racing_Black_Box.svg.png"]
 
 # Google OAuth configurations
@@ -42,34 +56,48 @@ GOOGLE_DISCOVERY_URL = "https://accounts.google.com/.well-known/openid-configura
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
 
 # Setups to the SocketIO server that is used
+# With more than one worker, SOCKETIO_MESSAGE_QUEUE (e.g. redis://localhost:6379/0) lets an emit to a room reach the
+# clients connected to every worker, and room changes are written through to the database so the workers stay in step
 async_mode = None
-socketio = SocketIO(app, async_mode=async_mode)
-
-# Create the database
-create_dbs()
-
-# Creates the API db
-build_api_db(["race", "class"])
-
-# Creates the error holding db
-build_error_db()
+socketio = SocketIO()
+
+
+def combat_event(event):
+    # Registers a /combat handler; its calls, errors and latency show up at /metrics under the event name,
+    # and what it raises is grouped at /errors
+    def decorator(handler):
+        @functools.wraps(handler)
+        def reported(*args, **kwargs):
+            try:
+                return handler(*args, **kwargs)
+            except Exception as e:
+                error_store.report_exception(e, event)
+                raise
+        return socketio.on(event, namespace='/combat')(metrics.timed_event(event)(reported))
+    return decorator
+
+metrics.add_gauge("active_rooms", "Open rooms loaded in this worker", lambda: len(rooms))
+metrics.add_gauge("write_behind_depth", "Chat and log rows waiting for the next write-behind flush", write_behind.depth)
+metrics.add_gauge("write_behind_set_aside", "Chat and log rows dropped after their batch kept failing", lambda: write_behind.set_aside_total)
 
 # User session management setup
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.anonymous_user = AnonymousUser
 
-
+# Per (user, room) limiters for chat spam and event floods
+chat_limiter = RateLimiter(spam_max_messages, spam_timeout, spam_penalty)
+token_move_limiter = RateLimiter(*token_move_limit)
+initiative_limiter = RateLimiter(*initiative_limit)
+npc_limiter = RateLimiter(*npc_limit)
 
 # OAuth 2 client setup
 client = WebApplicationClient(GOOGLE_CLIENT_ID)
 
 # CSRF authenticator to prevent CSRF attacks
-csrf = CSRFProtect(app)
+csrf = CSRFProtect()
 
-# Schedules daily cleaning of DBs (commented out until production)
-# scheduler = BackgroundScheduler()
-# scheduler.start()
+# Runs the nightly retention job (see retention.py) off the request path
+scheduler = BackgroundScheduler(daemon=True, timezone="UTC")
 
 ### FUNCTIONS
 
@@ -80,15 +108,15 @@ def get_google_provider_cfg():
 # Flask-Login helper to retrieve a user from our db
 @login_manager.user_loader
 def load_user(user_id):
-    db_response = read_db("users", "*", f"WHERE user_id = '{user_id}'")
+    db_response = get_user(user_id)
     if not db_response:
         return None
-    return User(id_=db_response[0][0], name=db_response[0][1], email=db_response[0][2], profile_pic=db_response[0][3], site_name=db_response[0][4])
+    return User(id_=db_response[0], name=db_response[1], email=db_response[2], profile_pic=db_response[3], site_name=db_response[4])
 
 
 @login_manager.unauthorized_handler
 def sent_to_login():
-    return redirect(url_for("login_index"))
+    return redirect(url_for(".login_index"))
 
 def readify_form_errors(form):
     errs_lis = []
@@ -105,49 +133,54 @@ def process_character_form(form, user_id, usage, route="/characters/create"):
         values = (user_id, form.name.data, form.classname.data, form.subclass.data, form.race.data, form.subrace.data, form.speed.data, form.level.data, form.strength.data, form.dexterity.data, form.constitution.data, form.intelligence.data, form.wisdom.data, form.charisma.data, form.hitpoints.data, form.char_token.data or current_user.get_profile_pic())
     
         if usage == "create":
-            if read_db("characters", "*", f"WHERE user_key = '{user_id}' AND chr_name = '{values[1]}'") != []:
-                app.logger.warning(f"User {current_user.get_site_name()} already has a character with name {form.name.data}. Reloading the Add Character page to allow them to change the name")
+            if get_character(user_id, values[1]):
+                http_log.warning("Character name already taken, reloading Add Character", {"character": form.name.data})
                 return render_template("add_character.html", message_text="You already have a character with this name!", name=form.name.data, hp=form.hitpoints.data, speed=form.speed.data, lvl=form.level.data, str=form.strength.data, dex=form.dexterity.data, con=form.constitution.data, int=form.intelligence.data, wis=form.wisdom.data, cha=form.wisdom.data, old_race=form.race.data, old_subrace=form.subrace.data, old_class=form.classname.data, old_subclass=form.subclass.data, char_token=form.char_token.data, profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name())
 
-            app.logger.debug(f"User {current_user.get_site_name()} successfully added a character with name {form.name.data}. Redirecting them to the View Characters page.")
+            http_log.debug("Character added", {"character": form.name.data})
             add_to_db("chars", values)
+            invalidate_characters(user_id)
 
-            return redirect(url_for("view_characters"))
+            return redirect(url_for(".view_characters"))
 
         elif usage == "edit":
-            if request.form['old_name'] != request.form['name'] and read_db("characters", "*", f"WHERE user_key = '{user_id}' AND chr_name = '{request.form['name']}'") != []:
-                app.logger.warning(f"User {current_user.get_site_name()} attempted to change the name of character {request.form['old_name']} to {request.form['name']}. They already have another character with that name. Reloading the Edit Character page to allow them to change the name.")
+            if request.form['old_name'] != request.form['name'] and get_character(user_id, request.form['name']):
+                http_log.warning("Character renamed to a name already taken, reloading Edit Character", {"old_name": request.form['old_name'], "character": request.form['name']})
                 return render_template("edit_character.html", message_text="You already have a character with this name!", name=form.name.data, hp=form.hitpoints.data, speed=form.speed.data, lvl=form.level.data, str=form.strength.data, dex=form.dexterity.data, con=form.constitution.data, int=form.intelligence.data, wis=form.wisdom.data, cha=form.wisdom.data, old_race=form.race.data, old_subrace=form.subrace.data, old_class=form.classname.data, old_subclass=form.subclass.data, old_name=request.form['old_name'], char_token=form.char_token.data, profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name())
 
-            app.logger.debug(f"Updating the characters owned by user {current_user.get_site_name()}.")
-            delete_from_db("characters", f"WHERE user_key = '{user_id}' AND chr_name = '{request.form['old_name']}'")
+            http_log.debug("Updating characters")
+            evict_user(user_id)
+            delete("characters", {"user_key": user_id, "chr_name": request.form['old_name']})
             add_to_db("chars", values)
+            invalidate_characters(user_id)
 
             if request.form['old_name'] != form.name.data:
-                app.logger.warning(f"User {current_user.get_site_name()} updating the character name. Updating all of the references to that character in the database.")
-                update_db("active_room", f"chr_name = '{form.name.data}'", f"WHERE chr_name = '{request.form['old_name']}' AND user_key = '{user_id}'")
-                update_db("chat", f"chr_name = '{form.name.data}'", f"WHERE chr_name = '{request.form['old_name']}' AND user_key = '{user_id}'")
+                http_log.warning("Character renamed, updating its references", {"old_name": request.form['old_name'], "character": form.name.data})
+                update("active_room", {"chr_name": form.name.data}, {"chr_name": request.form['old_name'], "user_key": user_id})
+                update("chat", {"chr_name": form.name.data}, {"chr_name": request.form['old_name'], "user_key": user_id})
+                update("map_token", {"chr_name": form.name.data}, {"chr_name": request.form['old_name'], "user_key": user_id})
             
-            app.logger.debug(f"User {current_user.get_site_name()} successfully updated a character with name {form.name.data}. Redirecting them to the View Characters page.")
-            return redirect(url_for("view_characters"))
+            http_log.debug("Character updated", {"character": form.name.data})
+            return redirect(url_for(".view_characters"))
         
         elif usage == "play":
             add_to_db("chars", values)
-            app.logger.debug(f"User {current_user.get_site_name()} successfully created their first character with name {form.name.data}. Redirecting them to the Choose Characters Page")
+            invalidate_characters(user_id)
+            http_log.debug("First character created, redirecting to Choose Characters", {"character": form.name.data})
             return redirect(route)
 
     err_lis = readify_form_errors(form)
 
     if usage == "create":
-        app.logger.warning(f"Character that user {current_user.get_site_name()} attempted to add had errors. Reloading the Add Character page to allow them to fix the errors.")
+        http_log.warning("Character to add had errors, reloading Add Character")
         return render_template("add_character.html", errors=err_lis, action="/characters/create", name=form.name.data, hp=form.hitpoints.data, speed=form.speed.data, lvl=form.level.data, str=form.strength.data, dex=form.dexterity.data, con=form.constitution.data, int=form.intelligence.data, wis=form.wisdom.data, cha=form.charisma.data, old_race=form.race.data, old_subrace=form.subrace.data, old_class=form.classname.data, old_subclass=form.subclass.data,  char_token=form.char_token.data, profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name())
     
     if usage == "edit": 
-        app.logger.warning(f"Character that user {current_user.get_site_name()} attempted to edit had errors. Reloading the Edit Character page to allow them to fix the errors.")
+        http_log.warning("Character to edit had errors, reloading Edit Character")
         return render_template("edit_character.html", errors=err_lis, name=form.name.data, hp=form.hitpoints.data, speed=form.speed.data, lvl=form.level.data, str=form.strength.data, dex=form.dexterity.data, con=form.constitution.data, int=form.intelligence.data, wis=form.wisdom.data, cha=form.charisma.data, old_race=form.race.data, old_subrace=form.subrace.data, old_class=form.classname.data, old_subclass=form.subclass.data, old_name=request.form['old_name'],  char_token=form.char_token.data, profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name())
 
     if usage == "play":
-        app.logger.warning(f"Character user {current_user.get_site_name()} attempted to add had errors. Reloading Add Character page to allow them to fix the errors.")
+        http_log.warning("Character to add had errors, reloading Add Character")
         return render_template("add_character.html", errors=err_lis, action="/play/choose", name=form.name.data, hp=form.hitpoints.data, speed=form.speed.data, lvl=form.level.data, str=form.strength.data, dex=form.dexterity.data, con=form.constitution.data, int=form.intelligence.data, wis=form.wisdom.data, cha=form.charisma.data, old_race=form.race.data, old_subrace=form.subrace.data, old_class=form.classname.data, old_subclass=form.subclass.data,  char_token=form.char_token.data, profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name())
 
 
@@ -155,161 +188,153 @@ def process_room_form(form, user_id, usage, room_id):
     if form.validate():
         if usage == "create":
             values = (user_id, form.room_name.data, "null", '{}', form.map_url.data, form.dm_notes.data)
-            app.logger.debug(f"User {current_user.get_site_name()} has created the room named {form.room_name.data}")
+            http_log.debug("Room created", {"room_name": form.room_name.data})
 
             add_to_db("room_object", values)
-            return redirect(url_for("view_rooms"))
+            return redirect(url_for(".view_rooms"))
 
         if usage == "edit":
             values = (user_id, form.room_name.data, "null", '{}', form.map_url.data, form.dm_notes.data)
-            app.logger.debug(f"User {current_user.get_site_name()} has saved changes to the room named {form.room_name.data}")
+            http_log.debug("Room saved", {"room_name": form.room_name.data})
             
-            delete_from_db("room_object", f"WHERE row_id ='{room_id}'")
+            # Saving closes the room if it is open, since the row is replaced by one without a room id
+            open_row = select_one("room_object", "active_room_id", {"row_id": room_id, "user_key": user_id})
+            if open_row:
+                close_live_room(open_row[0], "The DM changed this room. It has been closed")
+            delete("room_object", {"row_id": room_id})
             add_to_db("room_object", values)
-            return redirect(url_for("view_rooms"))
+            return redirect(url_for(".view_rooms"))
 
     err_lis = readify_form_errors(form)
     if usage == "create":
-        app.logger.debug(f"The room {current_user.get_site_name()} was attempting to create had some errors. Sending back to creation page to fix errors.")
+        http_log.debug("Room to create had errors, sending back to the form")
         return render_template("add_room.html", errors=err_lis, room_name=form.room_name.data, map_url=form.map_url.data, dm_notes=form.dm_notes.data ,profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name() )
 
     if usage == "edit":
-        app.logger.debug(f"The room {current_user.get_site_name()} was attempting to edit had some errors. Sending back to edit page to fix errors.")
+        http_log.debug("Room to edit had errors, sending back to the form")
         return render_template("edit_room.html", errors=err_lis, room_name=form.room_name.data, map_url=form.map_url.data, dm_notes=form.dm_notes.data ,profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name() )
         
 
 
-def determine_if_user_spamming(chats):
-    max_messages = spam_max_messages
-    timeframe = spam_timeout
-    now = datetime.datetime.now()
-    total_messages_user_sent= 0
-    chats.reverse()
-    for message in chats:
-        message_time = datetime.datetime.fromisoformat(message[1])
-        if ((now - message_time).total_seconds()) < timeframe:
-            total_messages_user_sent += 1
-        else:
-            break
-    if total_messages_user_sent > max_messages:
-        return True
-    return False
+def room_event(room_id, event, payload, user_id, title, desc):
+    # Sends an event that changes the room to everyone in it. The event gets the room's next sequence number and is
+    # stored in the log table, so a client that reconnects can be sent only the events it missed
+    room = get_room(room_id)
+    if not room:
+        return
+    payload = dict(payload, seq=room.next_seq())
+    add_to_db("room_event", (room_id, user_id, title, desc, current_timestamp(), payload['seq'], event, json.dumps(payload)))
+    socketio.emit(event, payload, room=room_id, namespace='/combat')
 
 
-def character_icon_add_database(character_name, site_name, character_image, user_id, room_id):
-    initial_height = "2em"
-    initial_width = "2em"
-    initial_top = "25px"
-    initial_left = "25px"
-
-    # map_status = json.loads(read_db("room_object", "map_status", f"WHERE active_room_id = '{room_id}'")[0][0])
-    walla_walla = json.loads(read_db("room_object", "map_status", f"WHERE active_room_id = '{room_id}'")[0][0])
-    
-    # Clean up locally read copy of map_status (or walla_walla in the interm). This is a temporary solution to the larger design problem described at the end of this file. This also fails to preserve character token locations through multiple sessions. Make sure to replace walla_walla with map_status when this is resolved
-    wrong_room = []
-    for i in walla_walla:
-        if walla_walla[i]['room_id'] != room_id:
-            wrong_room.append(i)
-    for i in wrong_room:
-        del walla_walla[i]
+def with_position(room, user_id, character_name, init_val):
+    # (initiative, place in the turn order) of a character whose initiative was just set, or None if it wasn't
+    if init_val is None:
+        return None
+    return init_val, room.initiative_position(user_id, character_name)
 
-    user_id_character_name = str(user_id) + '_' + str(character_name)
-    json_character_to_add = { user_id_character_name: {"site_name": site_name, "character_name": character_name, "room_id": room_id, "character_image": character_image, "height": initial_height, "width": initial_width, "top": initial_top, "left": initial_left, "is_turn": 0}}
-    walla_walla[user_id_character_name] = json_character_to_add[user_id_character_name]
-    map_status_json = json.dumps(walla_walla)
-    update_db("room_object", f"map_status = '{map_status_json}'", f"WHERE active_room_id = '{room_id}'")
 
-    updated_character_icon_status = json.loads(read_db("room_object", "map_status", f"WHERE active_room_id = '{room_id}'")[0][0])
-    emit('redraw_character_tokens_on_map', updated_character_icon_status, room=room_id)
+def close_live_room(room_id, desc):
+    # Closes an open room from outside the battle map: its state and initiative/token rows go, like retention
+    # closing it, and connected players are sent room_ended. Chat and log are left to the retention job
+    if room_id in (None, "", "null"):
+        return
+    retention.close_room(room_id)
+    socketio.emit("room_ended", {'desc': desc}, room=room_id, namespace='/combat')
+    close_room(room_id, namespace='/combat')
 
 
-# COMMENTED UNTIL PRODUCTION 
-# #Clears Chat, Log, Active rooms 
-# def clean_dbs():
-#     current_time = datetime.datetime.now().isoformat(sep=' ',timespec='seconds')
-#     benchmarktime = current_time - datetime.timedelta(hours=24)
-#     open_rooms_past_due = read_db("log", "DISTINCT room_id", f"WHERE timestamp > {benchmarktime} ORDER BY timestamp")
-#     for room_id in open_rooms_past_due:
-#         delete_from_db("active_room", f"WHERE room_id = '{room_id[0]}'")
-#         delete_from_db("chat", f"WHERE room_id = '{room_id[0]}'")
-#         delete_from_db("log", f"WHERE room_id = '{room_id[0]}'")
-#         update_db("room_object", "active_room_id = 'null'", f"WHERE active_room_id = '{room_id[0]}'")
+def add_character_to_room(room, character_name, site_name, character_image, user_id):
+    # Adds the character to the initiative list and places its token on the map. Returns its initiative and its
+    # place in the turn order
+    initial_height = "2em"
+    initial_width = "2em"
+    initial_top = "25px"
+    initial_left = "25px"
 
-# scheduler.add_job(func=clean_dbs, trigger="cron", hour=3, minute=59)
+    init_val = room.add_character(user_id, character_name, site_name, character_image)
+    room.add_token(user_id, character_name, site_name, character_image, initial_height, initial_width, initial_top, initial_left)
+    return with_position(room, user_id, character_name, init_val)
 
 
 
 ### ROUTING DIRECTIVES 
 
 # Viewing characters page
-@app.route("/characters", methods=["GET", "POST"])
+@main.route("/characters", methods=["GET", "POST"])
 @login_required
 def view_characters():
     user_id = current_user.get_user_id()
 
     if request.method == "POST":
-        app.logger.debug(f"Attempting to delete character owned by {current_user.get_site_name()} named {request.form['character_name']}.")
-        delete_from_db("characters", f"WHERE user_key = '{user_id}' AND chr_name = '{request.form['character_name']}'")
-        delete_from_db("active_room", f"WHERE user_key = '{user_id}' AND chr_name = '{request.form['character_name']}'")
+        http_log.debug("Deleting character", {"character": request.form['character_name']})
+        evict_user(user_id)
+        tokens = select("map_token", "room_id, site_name", {"user_key": user_id, "chr_name": request.form['character_name']})
+        delete("characters", {"user_key": user_id, "chr_name": request.form['character_name']})
+        invalidate_characters(user_id)
+        delete("active_room", {"user_key": user_id, "chr_name": request.form['character_name']})
+        delete("map_token", {"user_key": user_id, "chr_name": request.form['character_name']})
+        # Take the character's tokens off the maps of the rooms it was in
+        for room_id, site_name in tokens:
+            room_event(room_id, 'token_removed', {'site_name': site_name, 'character_name': request.form['character_name']}, user_id, "Token", f"{request.form['character_name']} removed from the map")
                         
-    items = read_db("characters", "*", f"WHERE user_key = '{user_id}'")
-    app.logger.debug(f"User {current_user.get_site_name()} has gone to view their characters. They have {len(items)} characters.")
+    items = get_characters(user_id)
+    http_log.debug("Viewing characters", {"characters": len(items)})
     return render_template("view_characters.html", items=items, profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name())
 
 
 # Character creation page
-@app.route("/characters/create", methods=["POST","GET"])
+@main.route("/characters/create", methods=["POST","GET"])
 @login_required
 def character_creation():
     form = CharacterValidation()
     user_id = current_user.get_user_id()
     route = request.args.get('route')
     if request.method == "POST":
-        app.logger.debug(f"User {current_user.get_site_name()} is attempting to register a character with name {form.name.data}.")
+        http_log.debug("Registering character", {"character": form.name.data})
         if route:
             return process_character_form(form, user_id, "play", route)
             
         return process_character_form(form, user_id, "create")
 
-    app.logger.debug(f"User {current_user.get_site_name()} has gone to add a character.")
+    http_log.debug("Adding a character")
     action = "/characters/create"
     if route:
         action += f"?route={route}"
     return render_template("add_character.html", profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name(), action=action)
 
 
-@app.route("/characters/edit/<name>", methods=["GET", "POST"])
+@main.route("/characters/edit/<name>", methods=["GET", "POST"])
 @login_required
 def edit_character(name):
     user_id = current_user.get_user_id()
     form = CharacterValidation()
 
     if request.method == "POST":
-        app.logger.warning(f"User {current_user.get_site_name()} is attempting to update a character with name {request.form['old_name']}.")
+        http_log.warning("Updating character", {"character": request.form['old_name']})
         return process_character_form(form, user_id, "edit")
 
-    character = read_db("characters", "*", f"WHERE user_key = '{current_user.get_user_id()}' AND chr_name = '{name}'")
+    character = get_character(user_id, name)
 
     if character:
-        character = character[0]
-        app.logger.debug(f"User {current_user.get_site_name()} has gone to edit a character with name {character[1]}.")
+        http_log.debug("Editing character", {"character": character[1]})
         return render_template("edit_character.html", name=character[1], hp=character[14], old_race=character[4], old_subrace=character[5], old_class=character[2], old_subclass=character[3], speed=character[6], lvl=character[7], str=character[8], dex=character[9], con=character[10], int=character[11], wis=character[12], cha=character[13], old_name=character[1], char_token=character[15], profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name())
 
-    app.logger.warning(f"User attempted to edit a character with name {name}. They do not have a character with that name. Throwing a Bad Request error.")
+    http_log.warning("No such character to edit, bad request", {"character": name})
     raise BadRequest(description=f"You don't have a character named {name}!")
 
 
 # Post-Login Landing Page
 #TODO: Find way to cache guest users when they go onto the website
 #TODO: Create generalized function that can grab authorized users who skip the site name
-@app.route("/home", methods=["GET", "POST"])
+@main.route("/home", methods=["GET", "POST"])
 def home():
     authenticated = False
     if current_user.is_authenticated:
-        app.logger.debug(f"User logged in")
+        http_log.debug("User logged in")
         authenticated = True
     else:
-        app.logger.debug(f"User not logged in")
+        http_log.debug("User not logged in")
 
     if request.method == "POST":
         if "site_name" in request.form:
@@ -319,26 +344,27 @@ def home():
 
             if not form.validate():
                 err_lis = readify_form_errors(form)
-                app.logger.warning(f"There were errors in the chosen site name. Reloading the page")
+                http_log.warning("Site name had errors, reloading the page")
                 return render_template("set_site_name.html", errors=err_lis, error_site_name=site_name, profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name())
 
-            app.logger.debug(f"User is attempting to set their site name as {site_name}")
-            if read_db("users", "*", f"WHERE site_name = '{site_name}'"):
-                app.logger.warning(f"Site name {site_name} already has been used. Reloading the Set User Name with warning message.")
+            http_log.debug("Setting site name", {"site_name": site_name})
+            if select_one("users", "user_id", {"site_name": site_name}):
+                http_log.warning("Site name already taken, reloading Set User Name", {"site_name": site_name})
                 return render_template("set_site_name.html", message="Another user has that username!" ,error_site_name=site_name, profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name())
 
-            app.logger.debug(f"{site_name} is available as a site name. Adding it to the user.")
-            update_db("users", f"site_name = '{site_name}'", f"WHERE user_id = '{current_user.get_user_id()}'")
-            return redirect(url_for('home'))
+            http_log.debug("Site name available, adding it to the user", {"site_name": site_name})
+            update("users", {"site_name": site_name}, {"user_id": current_user.get_user_id()})
+            invalidate_user(current_user.get_user_id())
+            return redirect(url_for('.home'))
 
         if "spectate_room_id" in request.form:
             room_id = request.form['spectate_room_id']
 
-            if read_db("room_object", "*", f"WHERE active_room_id = '{room_id}'"):
-                app.logger.debug(f"{current_user.get_site_name()} is entering the room {room_id}")
-                return redirect(url_for('spectateRoom', room_id=room_id))
+            if find_open_room(room_id):
+                http_log.debug("Entering room", {"room_id": room_id})
+                return redirect(url_for('.spectateRoom', room_id=room_id))
             
-            app.logger.warning(f"User {current_user.get_site_name()} attempted to enter an nonexistant room. Reloading to form with a message")
+            http_log.warning("No such room to enter, reloading the form")
             if authenticated:
                 return render_template("home.html", spectate_message= "There is not an open room with that key!", spectate_room_id=room_id, profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name())
             else:
@@ -348,11 +374,11 @@ def home():
         if "play_room_id" in request.form:
             room_id = request.form['play_room_id']
 
-            if read_db("room_object", "*", f"WHERE active_room_id = '{room_id}'"):
-                app.logger.debug(f"User {current_user.get_site_name()} is entering room {room_id}")
-                return redirect(url_for('enterRoom', room_id=room_id))
+            if find_open_room(room_id):
+                http_log.debug("Entering room", {"room_id": room_id})
+                return redirect(url_for('.enterRoom', room_id=room_id))
             
-            app.logger.warning(f"User {current_user.get_site_name()} attempted to enter an nonexistant room. Reloading to form with a message")
+            http_log.warning("No such room to enter, reloading the form")
             return render_template("home.html", play_message="There is not an open room with that key!", play_room_id=room_id, profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name())
 
     if not authenticated:
@@ -360,24 +386,22 @@ def home():
 
     if not current_user.get_site_name():
         # site_name is what we call the username in the backend
-        app.logger.warning("User does not have site name. Loading the Set User Name page.")
+        http_log.warning("User has no site name, loading Set User Name")
         return render_template("set_site_name.html", profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name())
 
-    app.logger.debug(f"Rooms in Database:")
-    for i in read_db("room_object"):
-        app.logger.debug(f"{i}")
-    app.logger.debug(f"Active Rooms in Database:")
-    for i in read_db("active_room"):
-        app.logger.debug(f"{i}")
+    # Dumping the tables costs two full scans, so they are only read when someone is looking
+    if http_log.isEnabledFor(logging.DEBUG):
+        http_log.debug("Rooms in database", {"rooms": select("room_object")})
+        http_log.debug("Active rooms in database", {"rows": select("active_room")})
 
     return render_template("home.html", profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name())
 
 
-@app.route("/user/settings", methods=["GET", "POST"])
+@main.route("/user/settings", methods=["GET", "POST"])
 @login_required
 def user_settings():
     user_id = current_user.get_user_id()
-    characters = read_db("characters", "chr_name, char_token", f"WHERE user_key = '{user_id}'")
+    characters = [(character[1], character[15]) for character in get_characters(user_id)]
     user_email = current_user.get_email()
 
     if request.method == "POST":
@@ -388,39 +412,42 @@ def user_settings():
 
             if not form.validate():
                 err_lis = readify_form_errors(form)
-                app.logger.warning(f"There are issues in the renaming form. Allowing the user to change it")
+                http_log.warning("Renaming form had errors, letting the user fix them")
                 return render_template("user_settings.html", characters=characters, username_errors=err_lis, new_site_name=new_site_name, profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name(), user_email=user_email)
 
-            if read_db("users", "*", f"WHERE site_name = '{new_site_name}'"):
-                app.logger.warning(f"Site name {new_site_name} already has been used. Reloading the user settings page with warning message.")
+            if select_one("users", "user_id", {"site_name": new_site_name}):
+                http_log.warning("Site name already taken, reloading user settings", {"site_name": new_site_name})
                 return render_template("user_settings.html", characters=characters, username_message="That username is already in use!", new_site_name=new_site_name, profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name(), user_email=user_email)
 
-            app.logger.debug(f"{new_site_name} is available as a site name. Updating {current_user.get_site_name()} site name.")
-            update_db("users", f"site_name = '{new_site_name}'", f"WHERE user_id = '{user_id}'")
-            return redirect(url_for('user_settings'))
+            http_log.debug("Site name available, renaming the user", {"site_name": new_site_name})
+            update("users", {"site_name": new_site_name}, {"user_id": user_id})
+            invalidate_user(user_id)
+            return redirect(url_for('.user_settings'))
 
-    app.logger.debug(f"User {current_user.get_site_name()} is accessing their user settings")
+    http_log.debug("Viewing user settings")
     return render_template("user_settings.html", characters=characters, new_site_name=current_user.get_site_name(), profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name(), user_email=user_email)
 
 
-@app.route("/rooms", methods=["GET", "POST"])
+@main.route("/rooms", methods=["GET", "POST"])
 @login_required
 def view_rooms():
     if request.method == "POST":
-        app.logger.debug(f"Attempting to delete room owned by {current_user.get_site_name()} named {request.form['room_name']}.")
+        http_log.debug("Deleting room", {"room_name": request.form['room_name']})
         
-        if read_db("active_room", "room_id", f"WHERE room_id = {request.form['room_id']}"):
-            app.logger.warning(f"User {current_user.get_site_name()} is attempting to delete an active room {request.form['room_name']}")
+        room = select_one("room_object", "active_room_id", {"row_id": request.form['room_id'], "user_key": current_user.get_user_id()})
+        if room and room[0] != "null":
+            http_log.warning("Refusing to delete an active room", {"room_name": request.form['room_name']})
             # Do we want this responsibility to be on the user or is there merit to just scrubbing the DBs from this page
+            created_rooms = select("room_object", "row_id, room_name, map_url, dm_notes, active_room_id", {"user_key": current_user.get_user_id()})
             return render_template("view_rooms.html" , message="Room is active! Close it first!", profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name(), room_list=created_rooms)
         
-        delete_from_db("room_object", f"WHERE row_id = {request.form['room_id']}")
-        app.logger.debug(f"Deleted user {current_user.get_site_name()}'s room {request.form['room_name']}")
-        return redirect(url_for('view_rooms'))
+        delete("room_object", {"row_id": request.form['room_id'], "user_key": current_user.get_user_id()})
+        http_log.debug("Room deleted", {"room_name": request.form['room_name']})
+        return redirect(url_for('.view_rooms'))
 
-    app.logger.debug(f"User {current_user.get_site_name()} has gone to the rooms page.")
+    http_log.debug("Viewing rooms")
 
-    created_rooms = read_db("room_object", "row_id, room_name, map_url, dm_notes, active_room_id", f"WHERE user_key = '{current_user.get_user_id()}'")
+    created_rooms = select("room_object", "row_id, room_name, map_url, dm_notes, active_room_id", {"user_key": current_user.get_user_id()})
 
     active_rooms = []
     for room in created_rooms:
@@ -430,102 +457,104 @@ def view_rooms():
     return render_template("view_rooms.html", profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name(), room_list=created_rooms, active_rooms=active_rooms)
 
 
-@app.route("/rooms/create", methods=["GET", "POST"])
+@main.route("/rooms/create", methods=["GET", "POST"])
 @login_required
 def room_creation():
-    app.logger.debug(f"User {current_user.get_site_name()} is creating a new room!")
+    http_log.debug("Creating a new room")
     form = RoomValidation()
     user_id = current_user.get_user_id()
 
     if request.method == "POST":
-        app.logger.debug(f"User {current_user.get_site_name()} is attempting to create a new room")
+        http_log.debug("Submitting a new room")
         return process_room_form(form, user_id, "create", "")
 
     return render_template("add_room.html", profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name(), map_url="https://i.pinimg.com/564x/b7/7f/6d/b77f6df018cc374afca057e133fe9814.jpg")
 
 
-@app.route("/rooms/<room_id>", methods=["GET", "POST"])
+@main.route("/rooms/<room_id>", methods=["GET", "POST"])
 @login_required
 def room_edit(room_id):
     user_id = current_user.get_user_id()
     form = RoomValidation()
 
     if request.method == "POST":
-        app.logger.warning(f"User {current_user.get_site_name()} is attempting to edit their room")
+        http_log.warning("Editing room")
         return process_room_form(form, user_id, "edit", room_id)
 
-    room = read_db("room_object", "*", f"WHERE row_id = {room_id} and user_key= '{current_user.get_user_id()}'")
+    room = select_one("room_object", "*", {"row_id": room_id, "user_key": current_user.get_user_id()})
     if room:
-        room = room[0]
-        app.logger.debug(f"User {current_user.get_site_name()} is prepping their room for their encounter!")
+        http_log.debug("Prepping room for an encounter")
         return render_template("edit_room.html", profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name(), map_url= room[5], room_name=room[2], dm_notes = room[6], room_id=room_id )
 
-    app.logger.warning(f"User attempted to prep a room with name {room_id}. They do not have a room with that id. Throwing a Bad Request error.")
+    http_log.warning("No such room to prep, bad request", {"room_id": room_id})
     raise BadRequest(description=f"You don't have a room with id: {room_id}!")
 
 
-@app.route("/generate_room", methods=["POST"])
+@main.route("/generate_room", methods=["POST"])
 @login_required
 def generate_room_id():
     user_id = current_user.get_user_id()
     room_name = request.form["room_name"]
-    random_key = ''.join(random.choice(string.ascii_uppercase + string.ascii_lowercase + string.digits) for _ in range(8))
+    room = select_one("room_object", "row_id, active_room_id, map_url", {"user_key": user_id, "room_name": room_name})
+    if not room:
+        raise BadRequest(description=f"You don't have a room named {room_name}!")
+    row_id, old_room_id, map_url = room
 
-    while read_db("room_object", "*", f"WHERE active_room_id = '{random_key}'"):
-        random_key = ''.join(random.choice(string.ascii_uppercase + string.ascii_lowercase + string.digits) for _ in range(8))
+    # The room gets a new id even if it was open, so the old one is closed
+    close_live_room(old_room_id, "The DM reopened this room under a new key")
+    random_key = open_room(row_id, user_id, room_name, map_url, lambda: ''.join(random.choice(string.ascii_uppercase + string.ascii_lowercase + string.digits) for _ in range(8)))
 
-    update_db("room_object", f"active_room_id = '{random_key}'", f"WHERE user_key = '{user_id}' AND room_name = '{room_name}'")
+    return redirect(url_for('.enterRoom', room_id=random_key))
 
-    return redirect(url_for('enterRoom', room_id=random_key))
 
-
-@app.route("/play/<room_id>", methods=["GET", "POST"])
+@main.route("/play/<room_id>", methods=["GET", "POST"])
 @login_required
 def enterRoom(room_id):
     user_id = current_user.get_user_id()
     try:
-        image_url, map_owner = read_db("room_object", "map_url, user_key", f"WHERE active_room_id = '{room_id}'")[0]
-        characters = read_db("characters", "chr_name", f"WHERE user_key='{user_id}'")
+        room = find_open_room(room_id)
+        image_url, map_owner = room.map_url, room.owner
+        characters = [(character[1],) for character in get_characters(user_id)]
 
         if not characters:
-            return redirect(url_for("character_creation", route=f"/play/{room_id}"))
+            return redirect(url_for(".character_creation", route=f"/play/{room_id}"))
 
-        app.logger.debug(f"User {current_user.get_site_name()} has entered the room {room_id}")
+        http_log.debug("Entered room", {"room_id": room_id})
         if user_id == map_owner:
             return render_template("play_dm.html", async_mode=socketio.async_mode, characters=characters, in_room=room_id, image_url=image_url, profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name())
         else:
             return render_template("play.html", async_mode=socketio.async_mode, characters=characters, in_room=room_id, image_url=image_url, profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name())
 
     except:
-        app.logger.debug(f"No such room exists")
+        http_log.debug("No such room")
         raise BadRequest(description=f"A room with room id {room_id} does not exist!")
 
 
-@app.route("/spectate/<room_id>", methods=["GET", "POST"])
+@main.route("/spectate/<room_id>", methods=["GET", "POST"])
 def spectateRoom(room_id):
     try:
-        image_url = read_db("room_object", "map_url", f"WHERE active_room_id = '{room_id}'")[0][0]
+        image_url = find_open_room(room_id).map_url
 
-        app.logger.debug(f"User {current_user.get_site_name()} is spectating the room {room_id}")
+        http_log.debug("Spectating room", {"room_id": room_id})
 
         if current_user.is_authenticated:
             return render_template("watch.html", async_mode=socketio.async_mode, in_room=room_id, image_url=image_url, profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name())
         return render_template("unlogged_watch.html", async_mode=socketio.async_mode, in_room=room_id, image_url=image_url, profile_pic=current_user.get_profile_pic(), site_name=current_user.get_site_name())
 
     except:
-        app.logger.debug(f"No such room exists")
+        http_log.debug("No such room")
         raise BadRequest(description=f"A room with room id {room_id} does not exist!")
 
 
 
 # Landing Login Page
-@app.route("/")
+@main.route("/")
 def login_index():
-    return redirect(url_for('home'))
+    return redirect(url_for('.home'))
 
 
 # Login Process
-@app.route("/login")
+@main.route("/login")
 def login():
     # Get the authorization endpoint for Google login
     authorization_endpoint = get_google_provider_cfg()["authorization_endpoint"]
@@ -539,7 +568,7 @@ def login():
 
 
 # Login Callback
-@app.route("/login/callback")
+@main.route("/login/callback")
 def callback():
     # Get authorization code Google returns
     code = request.args.get("code")
@@ -573,51 +602,154 @@ def callback():
         return "User email not available or not verified by Google.", 400
     # Create a user in the datbase if they don't already exist
     user = User(id_=unique_id, name=users_name, email=users_email, profile_pic=picture, site_name=None)
-    if not read_db("users", "*", f"WHERE user_id = '{unique_id}'"):
+    if not get_user(unique_id):
         add_to_db("users", (unique_id, users_name, users_email, picture, None))
+        invalidate_user(unique_id)
     # Log the user in and send them to the homepage
     login_user(user)
-    return redirect(url_for("login_index"))
+    return redirect(url_for(".login_index"))
 
 
 # Logout
-@app.route("/logout")
+@main.route("/logout")
 @login_required
 def logout():
-    app.logger.debug(f"User {current_user.get_site_name()} just logged out")
+    http_log.debug("Logged out")
     logout_user()
-    return redirect(url_for("login_index"))
+    return redirect(url_for(".login_index"))
 
 
 # Delete Account
-@app.route("/delete")
+@main.route("/delete")
 @login_required
 def delete_account():
     user_id = current_user.get_user_id()
-    app.logger.debug(f"User {current_user.get_site_name()} is deleting their account. Deleting all associated information")
-    delete_from_db("log", f"WHERE user_key = '{user_id}'")
-    delete_from_db("chat", f"WHERE user_key = '{user_id}'")
-    delete_from_db("active_room", f"WHERE user_key = '{user_id}'")
-    delete_from_db("room_object", f"WHERE user_key = '{user_id}'")
-    delete_from_db("users", f"WHERE user_id = '{user_id}'")
-    delete_from_db("characters", f"WHERE user_key = '{user_id}'")
-    return redirect(url_for("login_index"))
+    http_log.debug("Deleting account and everything it owns")
+    evict_user(user_id)
+    for room_id, in select("room_object", "active_room_id", {"user_key": user_id}):
+        close_live_room(room_id, "The DM deleted their account. This room has been closed")
+    delete("log", {"user_key": user_id})
+    delete("chat", {"user_key": user_id})
+    delete("active_room", {"user_key": user_id})
+    delete("map_token", {"user_key": user_id})
+    delete("room_object", {"user_key": user_id})
+    delete("users", {"user_id": user_id})
+    delete("characters", {"user_key": user_id})
+    invalidate_user(user_id)
+    invalidate_characters(user_id)
+    return redirect(url_for(".login_index"))
 
 
 
 
 ### API ROUTES
-@app.route("/api/races")
+# The catalog only changes on a redeploy, so browsers may keep it for a day and then revalidate with the ETag
+catalog_max_age = 24 * 60 * 60 # in seconds
+
+def catalog_response(table, names):
+    etag, body = get_api_json(table, table, names)
+    response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = catalog_max_age
+    return response.make_conditional(request)
+
+@main.route("/api/races")
 @login_required
 def get_races():
-    races, subraces = get_api_info("race", "race")
-    return jsonify(races=list(races), subraces=subraces)
+    return catalog_response("race", ("races", "subraces"))
 
-@app.route("/api/classes")
+@main.route("/api/classes")
 @login_required
 def get_classes():
-    classes, subclasses = get_api_info("class", "class")
-    return jsonify(classes=list(classes), subclasses=subclasses)
+    return catalog_response("class", ("classes", "subclasses"))
+
+# Older chat or log entries of an open room, newest page before the before_id cursor. Only for the room's DM and
+# players with a character in it; the history of a closed room stays private until retention or the archive removes it
+@main.route("/rooms/<room_id>/history/<kind>")
+@login_required
+def room_history(room_id, kind):
+    if kind not in history_columns:
+        raise BadRequest(description=f"There is no {kind} history")
+    open_room_row = find_open_room(room_id)
+    if not open_room_row:
+        raise BadRequest(description=f"A room with room id {room_id} does not exist!")
+    user_id = current_user.get_user_id()
+    if user_id != open_room_row.owner and not get_room(room_id).user_characters(user_id):
+        raise BadRequest(description=f"You are not in the room with id: {room_id}!")
+    try:
+        rows, next_before_id = read_history(kind, room_id, request.args.get("before_id"), request.args.get("limit", history_page_size))
+    except ValueError:
+        raise BadRequest(description="before_id and limit must be numbers")
+    return jsonify(items=history_json(kind, rows), next_before_id=next_before_id)
+
+def operator_authorized(token_required):
+    # Whether the request carries METRICS_TOKEN as "Authorization: Bearer <token>". With no token set, only the
+    # routes that don't require one are open
+    token = current_app.config['METRICS_TOKEN']
+    if not token:
+        return not token_required
+    return hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}")
+
+def unauthorized():
+    return Response("Unauthorized\n", status=401, mimetype="text/plain")
+
+@main.route("/startup")
+def startup_timings():
+    # Startup time breakdown of this worker, including the databases set up so far. Needs METRICS_TOKEN, like /errors
+    if not operator_authorized(token_required=True):
+        return unauthorized()
+    timings = {step: round(seconds * 1000, 1) for step, seconds in current_app.config['STARTUP_TIMINGS'].items()}
+    databases = {db_file: round(seconds * 1000, 1) for db_file, seconds in setup_timings.items()}
+    return jsonify(app=timings, databases=databases)
+
+@main.route("/cache")
+def cache_report():
+    # Hit/miss counters of this worker's users and characters caches. Needs METRICS_TOKEN
+    if not operator_authorized(token_required=True):
+        return unauthorized()
+    return jsonify(cache_stats())
+
+@main.route("/archives")
+@login_required
+def archives():
+    # The current user's room archives, newest first
+    user_id = current_user.get_user_id()
+    return jsonify(archives=[{"name": name, "size": size, "url": url_for(".download_archive", name=name)} for name, size in list_archives(user_id)])
+
+@main.route("/archives/<name>")
+@login_required
+def download_archive(name):
+    user_id = current_user.get_user_id()
+    return send_from_directory(os.path.abspath(user_archive_dir(user_id)), name, as_attachment=True, mimetype="application/gzip")
+
+@main.route("/metrics")
+def metrics_report():
+    # Prometheus text format. Open to scrapers unless METRICS_TOKEN is set, then it needs "Authorization: Bearer <token>"
+    if not operator_authorized(token_required=False):
+        return unauthorized()
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@main.route("/errors")
+def error_report():
+    # Error groups, most recently seen first, and the latest reports. The samples hold server tracebacks, so this
+    # always needs METRICS_TOKEN and is closed when it isn't set
+    if not operator_authorized(token_required=True):
+        return unauthorized()
+    try:
+        limit = min(int(request.args.get("limit", 50)), 500)
+    except ValueError:
+        raise BadRequest(description="limit must be a number")
+    error_store.flush()
+    groups = [dict(zip(error_group_columns, row)) for row in read_error_db(limit)]
+    return jsonify({"groups": groups, "recent": list(error_store.recent)})
+
+@main.route("/retention")
+def retention_report():
+    # What the last retention run on this worker closed and reclaimed. Needs METRICS_TOKEN
+    if not operator_authorized(token_required=True):
+        return unauthorized()
+    return jsonify(retention.last_report)
 
 
 
@@ -625,9 +757,9 @@ def get_classes():
 
 ### SOCKETIO EVENT HANDLERS
 
-@socketio.on('set_initiative', namespace='/combat')
+@combat_event('set_initiative')
 def set_initiative(message):
-    time_rcvd = datetime.datetime.now().isoformat(sep=' ',timespec='seconds')
+    time_rcvd = current_timestamp()
     character_name = message['character_name'] or None
     init_val = message['init_val']
     site_name = message['site_name']
@@ -637,380 +769,387 @@ def set_initiative(message):
     if not character_name and not init_val:
         return
 
-    desc = f"{character_name}'s initiative updated in room {room_id}"
-    app.logger.debug(f"Battle update: {desc}.")
-
-    if not init_val:
-        a = read_db("active_room", "init_val", f"WHERE room_id = '{room_id}' AND user_key = '{user_id}' AND chr_name = '{character_name}'")
-        init_val = read_db("active_room", "init_val", f"WHERE room_id = '{room_id}' AND user_key = '{user_id}' AND chr_name = '{character_name}'")[0][0]
-
-    update_db("active_room", f"init_val = '{init_val}'", f"WHERE room_id = '{room_id}' AND user_key = '{user_id}' AND chr_name = '{character_name}'")
-    add_to_db("log", (room_id, user_id, "Init", desc, time_rcvd))
+    if not initiative_limiter.allow((user_id, room_id)):
+        emit('log_update', {'desc': "Too many initiative updates, slow down"})
+        return
 
-    emit('initiative_update', {'character_name': character_name, 'init_val': init_val, 'site_name': site_name}, room=room_id)
+    # None when the room is closed, the character isn't in it or init_val isn't a number; the message is dropped
+    changed = change_room(room_id, lambda room: with_position(room, user_id, character_name, room.set_initiative(user_id, character_name, message['init_val'])))
+    if changed is None:
+        return
+    desc = f"{character_name}'s initiative updated in room {room_id}"
+    combat_log.debug("Initiative updated", {"room_id": room_id, "character": character_name})
+    init_val, position = changed
+    room_event(room_id, 'initiative_update', {'character_name': character_name, 'init_val': init_val, 'site_name': site_name, 'position': position}, user_id, "Init", desc)
     emit('log_update', {'desc': desc}, room=room_id)
 
 
-@socketio.on('send_chat', namespace='/combat')
+@combat_event('send_chat')
 def send_chat(message):
-    time_rcvd = datetime.datetime.now().isoformat(sep=' ',timespec='seconds')
+    time_rcvd = current_timestamp()
     user_id = current_user.get_user_id()
     chr_name = message['character_name']
     room_id = message['room_id']
     site_name = current_user.get_site_name()
 
-    chats = read_db("chat", "user_key, timestamp", f"WHERE room_id = '{room_id}' and user_key = '{user_id}'")
+    if not isinstance(message['chat'], str) or not isinstance(chr_name, str):
+        return
+
+    room = get_room(room_id)
+    if not room:
+        return
 
-    if determine_if_user_spamming(chats):
+    if not chat_limiter.allow((user_id, room_id)):
         add_to_db("log", (room_id, user_id, "Spam", f"{site_name} was spamming the chat. They have been disabled for {spam_penalty} seconds", time_rcvd))
         emit("lockout_spammer", {'message': f"Sorry, you can only send {spam_max_messages} messages per {spam_timeout} seconds. Try again in {spam_penalty} seconds.", 'spam_penalty': spam_penalty})
         emit('log_update', {'desc': f"{site_name} was spamming the chat. They have been disabled for {spam_penalty} seconds"}, room=room_id)
-        app.logger.debug(f"{site_name} was spamming the chat. They have been disabled for {spam_penalty} seconds")
+        combat_log.debug("Chat spam, sender locked out", {"room_id": room_id, "seconds": spam_penalty})
 
     else:
         add_to_db("chat",(room_id, user_id, chr_name, message['chat'], time_rcvd))
-        add_to_db("log", (room_id, user_id, "Chat", message['character_name'], time_rcvd))
-        emit('chat_update', {'chat': message['chat'], 'character_name': message['character_name']}, room=room_id)
-        app.logger.debug(f"Battle update: {chr_name} has sent chat {message['chat']} in room {room_id}")
+        room_event(room_id, 'chat_update', {'chat': message['chat'], 'character_name': message['character_name']}, user_id, "Chat", message['character_name'])
+        combat_log.debug("Chat sent", {"room_id": room_id, "character": chr_name})
 
 
 # TODO: Button to hide or show character icon on map
-@socketio.on('start_combat', namespace='/combat')
+@combat_event('start_combat')
 def start_combat(message):
-    time_rcvd = datetime.datetime.now().isoformat(sep=' ',timespec='seconds')
+    time_rcvd = current_timestamp()
     user_id = current_user.get_user_id()
     room_id = message['room_id']
-    characters = read_db("active_room", "user_key, chr_name, init_val", f"WHERE room_id = '{room_id}' ORDER BY init_val, chr_name DESC ")
-    first_character = characters[-1]
-    character_id = first_character[0]
-    character_name = first_character[1]
-    site_name = read_db("users", "site_name", f"WHERE user_id = '{first_character[0]}'")[0][0]
-    app.logger.debug(f"Battle update: Combat has started in room {room_id}")
-
-    # map_status = json.loads(read_db("room_object", "map_status", f"WHERE active_room_id = '{room_id}'")[0][0])
-    walla_walla = json.loads(read_db("room_object", "map_status", f"WHERE active_room_id = '{room_id}'")[0][0])
-    
-    # Clean up locally read copy of map_status (or walla_walla in the interm). This is a temporary solution to the larger design problem described at the end of this file. This also fails to preserve character token locations through multiple sessions. Make sure to replace walla_walla with map_status when this is resolved
-    wrong_room = []
-    for i in walla_walla:
-        if walla_walla[i]['room_id'] != room_id:
-            wrong_room.append(i)
-    for i in wrong_room:
-        del walla_walla[i]
-
-    user_id_character_name = str(user_id) + '_' + str(character_name)
-    json_character_to_update = { user_id_character_name: {"site_name": site_name, "character_name": character_name, "room_id": room_id, "character_image": walla_walla[user_id_character_name]['character_image'], "height": walla_walla[user_id_character_name]['height'], "width": walla_walla[user_id_character_name]['width'], "top": walla_walla[user_id_character_name]['top'], "left": walla_walla[user_id_character_name]['left'], "is_turn": 1}}
-    walla_walla[user_id_character_name] = json_character_to_update[user_id_character_name]
-    characters_json = json.dumps(walla_walla)
-    update_db("room_object", f"map_status = '{characters_json}'", f"WHERE active_room_id = '{room_id}'")
-
-    update_db("active_room", f"is_turn = '{1}'", f"WHERE room_id = '{room_id}' AND user_key = '{first_character[0]}' AND chr_name = '{first_character[1]}' AND init_val = '{first_character[2]}'")
-    add_to_db("log", (room_id, user_id, "Combat", "Started Combat", time_rcvd))
+
+    first_character = change_room(room_id, lambda room: room.start_combat())
+    if not first_character:
+        return
+    room = get_room(room_id)
+    site_name = room.initiative[first_character]["site_name"]
+    room.checkpoint()
+    combat_log.debug("Combat started", {"room_id": room_id})
 
     emit('log_update', {'desc': "Started Combat"}, room=room_id)
-    emit('combat_started', {'desc': 'Started Combat', 'first_turn_name': first_character[1], 'site_name': site_name}, room=room_id)
+    room_event(room_id, 'combat_started', {'desc': 'Started Combat', 'first_turn_name': first_character[1], 'site_name': site_name}, user_id, "Combat", "Started Combat")
 
 
-@socketio.on('end_combat', namespace='/combat')
+@combat_event('end_combat')
 def end_combat(message):
-    time_rcvd = datetime.datetime.now().isoformat(sep=' ',timespec='seconds')
+    time_rcvd = current_timestamp()
     user_id = current_user.get_user_id()
     room_id = message['room_id']
-    character = read_db("active_room","user_key, chr_name", f"WHERE room_id = '{room_id}' AND is_turn = '1'")[0]
-    character_id = character[0]
-    character_name = character[1]
-    site_name = read_db("users", "site_name", f"WHERE user_id = '{character[0]}'")[0][0]
-    app.logger.debug(f"Battle update: Combat has ended in room {room_id}")
-
-    # map_status = json.loads(read_db("room_object", "map_status", f"WHERE active_room_id = '{room_id}'")[0][0])
-    walla_walla = json.loads(read_db("room_object", "map_status", f"WHERE active_room_id = '{room_id}'")[0][0])
-    
-    # Clean up locally read copy of map_status (or walla_walla in the interm). This is a temporary solution to the larger design problem described at the end of this file. This also fails to preserve character token locations through multiple sessions. Make sure to replace walla_walla with map_status when this is resolved
-    wrong_room = []
-    for i in walla_walla:
-        if walla_walla[i]['room_id'] != room_id:
-            wrong_room.append(i)
-    for i in wrong_room:
-        del walla_walla[i]
-
-    user_id_character_name = str(user_id) + '_' + str(character_name)
-    json_character_to_update = { user_id_character_name: {"site_name": site_name, "character_name": character_name, "room_id": room_id, "character_image": walla_walla[user_id_character_name]['character_image'], "height": walla_walla[user_id_character_name]['height'], "width": walla_walla[user_id_character_name]['width'], "top": walla_walla[user_id_character_name]['top'], "left": walla_walla[user_id_character_name]['left'], "is_turn": 0}}
-    walla_walla[user_id_character_name] = json_character_to_update[user_id_character_name]
-    characters_json = json.dumps(walla_walla)
-    update_db("room_object", f"map_status = '{characters_json}'", f"WHERE active_room_id = '{room_id}'")
-
-    update_db("active_room", f"is_turn = '{0}'", f"WHERE room_id = '{room_id}'")
-    add_to_db("log", (room_id, user_id, "Combat", "Ended Combat", time_rcvd))
+
+    character = change_room(room_id, lambda room: room.end_combat())
+    if not character:
+        return
+    room = get_room(room_id)
+    site_name = room.initiative[character]["site_name"] if character in room.initiative else None
+    room.checkpoint()
+    combat_log.debug("Combat ended", {"room_id": room_id})
 
     emit('log_update', {'desc': "Ended Combat"}, room=room_id)
-    emit('combat_ended', {'desc':'Ended Combat', 'current_turn_name': character[1], 'site_name': site_name}, room=room_id)
+    room_event(room_id, 'combat_ended', {'desc':'Ended Combat', 'current_turn_name': character[1], 'site_name': site_name}, user_id, "Combat", "Ended Combat")
 
 
-@socketio.on('end_room', namespace='/combat')
+@combat_event('end_room')
 def end_session(message):
     room_id = message['room_id']
-    delete_from_db("active_room", f"WHERE room_id = '{room_id}'")
-    delete_from_db("chat", f"WHERE room_id = '{room_id}'")
-    delete_from_db("log", f"WHERE room_id = '{room_id}'")
-    update_db("room_object", "map_status = '{}'", f"WHERE active_room_id = '{room_id}'")
-    update_db("room_object", "active_room_id = 'null'", f"WHERE active_room_id = '{room_id}'")
+    open_room_row = find_open_room(room_id)
+    if not open_room_row:
+        return
+    owner, room_name = open_room_row.owner, open_room_row.room_name
 
-    app.logger.debug(f"The room {room_id} owned by {current_user.get_site_name()} has closed")
+    # The room closes right away. Its rows are written to the owner's archive by a background task, which
+    # deletes them once the archive is on disk
+    room = get_room(room_id)
+    if room:
+        room.checkpoint()
+    drop_room(room_id)
+    forget_open_room(room_id)
+    update("room_object", {"map_status": "{}", "active_room_id": "null", "event_seq": 0}, {"active_room_id": room_id})
+    socketio.start_background_task(archive_room, room_id, room_name, owner)
+
+    combat_log.debug("Room closed", {"room_id": room_id})
     
     emit("room_ended", {'desc': message['desc']}, room=room_id)
     close_room(room_id)
 
 
-@socketio.on('end_turn', namespace='/combat')
+@combat_event('end_turn')
 def end_turn(message):
-    time_rcvd = datetime.datetime.now().isoformat(sep=' ',timespec='seconds')
-    previous_character_id = current_user.get_user_id()
+    time_rcvd = current_timestamp()
+    user_id = current_user.get_user_id()
     previous_character_name = message['previous_character_name']
-    next_character_name = message['next_character_name']
-    previous_site_name = message['previous_site_name']
-    next_site_name = message['next_site_name']
     room_id = message['room_id']
-    next_character_id = read_db("users", "user_id", f"WHERE site_name = '{next_site_name}'")[0][0]
-    app.logger.debug(f"Battle update: {previous_character_name}'s turn has ended. It is now {next_character_name}'s turn in room {room_id}")
 
-    # map_status = json.loads(read_db("room_object", "map_status", f"WHERE active_room_id = '{room_id}'")[0][0])
-    walla_walla = json.loads(read_db("room_object", "map_status", f"WHERE active_room_id = '{room_id}'")[0][0])
-    
-    # Clean up locally read copy of map_status (or walla_walla in the interm). This is a temporary solution to the larger design problem described at the end of this file. This also fails to preserve character token locations through multiple sessions. Make sure to replace walla_walla with map_status when this is resolved
-    wrong_room = []
-    for i in walla_walla:
-        if walla_walla[i]['room_id'] != room_id:
-            wrong_room.append(i)
-    for i in wrong_room:
-        del walla_walla[i]
-
-    previous_user_id_character_name = str(previous_character_id) + '_' + str(previous_character_name)
-    next_user_id_character_name = str(next_character_id) + '_' + str(next_character_name)
-    previous_json_character_to_update = { previous_user_id_character_name: {"site_name": previous_site_name, "character_name": previous_character_name, "room_id": room_id, "character_image": walla_walla[previous_user_id_character_name]['character_image'], "height": walla_walla[previous_user_id_character_name]['height'], "width": walla_walla[previous_user_id_character_name]['width'], "top": walla_walla[previous_user_id_character_name]['top'], "left": walla_walla[previous_user_id_character_name]['left'], "is_turn": 0}}
-    next_json_character_to_update = { next_user_id_character_name: {"site_name": next_site_name, "character_name": next_character_name, "room_id": room_id, "character_image": walla_walla[next_user_id_character_name]['character_image'], "height": walla_walla[next_user_id_character_name]['height'], "width": walla_walla[next_user_id_character_name]['width'], "top": walla_walla[next_user_id_character_name]['top'], "left": walla_walla[next_user_id_character_name]['left'], "is_turn": 1}}
-    walla_walla[previous_user_id_character_name] = previous_json_character_to_update[previous_user_id_character_name]
-    walla_walla[next_user_id_character_name] = next_json_character_to_update[next_user_id_character_name]
-    characters_json = json.dumps(walla_walla)
-    update_db("room_object", f"map_status = '{characters_json}'", f"WHERE active_room_id = '{room_id}'")
-
-    update_db("active_room", f"is_turn = '{0}'", f"WHERE room_id = '{room_id}'AND user_key = '{previous_character_id}' AND chr_name = '{previous_character_name}'")
-    update_db("active_room", f"is_turn = '{1}'", f"WHERE room_id = '{room_id}' AND user_key = '{next_character_id}' AND chr_name = '{next_character_name}'")
-    add_to_db("log", (room_id, previous_character_id, "Combat", f"{previous_character_name}'s Turn Ended", time_rcvd))
-
-    emit('log_update', {'desc': message['desc']}, room=room_id)
-    emit("turn_ended", {'desc': message['desc'], 'previous_site_name': previous_site_name, 'next_site_name': next_site_name}, room=room_id)
-
-
-@socketio.on('on_join', namespace='/combat')
+    def advance(room):
+        # The server decides who goes next. Only the character whose turn it is (or the DM) can end it, and
+        # naming the character stops a double click from skipping the next character's turn
+        if room.turn is None or room.turn[1] != previous_character_name or user_id not in (room.turn[0], room.owner):
+            return None
+        previous, next_character = room.advance_turn()
+        return previous, room.initiative[previous]["site_name"], next_character, room.initiative[next_character]["site_name"]
+
+    turn = change_room(room_id, advance)
+    if not turn:
+        return
+    previous, previous_site_name, next_character, next_site_name = turn
+    desc = f"{previous[1]}'s Turn Ended"
+
+    combat_log.debug("Turn ended", {"room_id": room_id, "previous": previous[1], "next": next_character[1]})
+    emit('log_update', {'desc': desc}, room=room_id)
+    room_event(room_id, "turn_ended", {'desc': desc, 'previous_character_name': previous[1], 'previous_site_name': previous_site_name, 'next_character_name': next_character[1], 'next_site_name': next_site_name}, user_id, "Combat", desc)
+
+
+@combat_event('history')
+def history(message):
+    # Only for a socket that joined the room, and only while the room is open
+    kind = message['kind']
+    room_id = message['room_id']
+    if kind not in history_columns or room_id not in socket_rooms() or not find_open_room(room_id):
+        return
+    try:
+        rows, next_before_id = read_history(kind, room_id, message.get('before_id'), message.get('limit', history_page_size))
+    except ValueError:
+        return
+    emit('history_page', {'kind': kind, 'items': history_json(kind, rows), 'next_before_id': next_before_id})
+
+
+@combat_event('connect')
+def combat_connected():
+    metrics.connected_sockets.inc()
+
+
+@combat_event('disconnect')
+def combat_disconnected():
+    metrics.connected_sockets.dec()
+
+
+@combat_event('on_join')
 def on_join(message):
-    app.logger.debug(f"Battle update: User {current_user.get_site_name()} has entered room {message['room_id']}")
+    combat_log.debug("Joined room", {"room_id": message['room_id']})
     join_room(message['room_id'])
     emit('joined', {'desc': 'Joined room'})
 
 
-@socketio.on('join_actions', namespace='/combat')
+@combat_event('join_actions')
 def connect(message):
     # Sends upon a new connection
-    time_rcvd = datetime.datetime.now().isoformat(sep=' ',timespec='seconds')
+    time_rcvd = current_timestamp()
     user_id = current_user.get_user_id()
     site_name = current_user.get_site_name()
     room_id = message['room_id']
-    initiatives = read_db("active_room", "chr_name, init_val, user_key", f"WHERE room_id = '{room_id}'")
-    chats = read_db("chat", "chr_name, chat", f"WHERE room_id = '{room_id}'")
-    # map_status = json.loads(read_db("room_object", "map_status", f"WHERE active_room_id = '{room_id}'")[0][0])
-    walla_walla = json.loads(read_db("room_object", "map_status", f"WHERE active_room_id = '{room_id}'")[0][0])
-    
-    # Clean up locally read copy of map_status (or walla_walla in the interm). This is a temporary solution to the larger design problem described at the end of this file. This also fails to preserve character token locations through multiple sessions. Make sure to replace walla_walla with map_status when this is resolved
-    wrong_room = []
-    for i in walla_walla:
-        if walla_walla[i]['room_id'] != room_id:
-            wrong_room.append(i)
-    for i in wrong_room:
-        del walla_walla[i]
+
+    room = get_room(room_id)
+    if not room:
+        return
 
     add_to_db("log", (room_id, user_id, "Connection", f"User with id {user_id} connected", time_rcvd))
-    app.logger.debug(f"Battle update: User {current_user.get_site_name()} has connected to room {room_id}")
+    combat_log.debug("Connected to room", {"room_id": room_id})
 
     emit('log_update', {'desc': f"{site_name} Connected"}, room=room_id)
 
-    your_chars = []
-    character_names_read_from_db = read_db("active_room", "chr_name", f"WHERE user_key='{user_id}' AND room_id='{room_id}'")
-    for name in character_names_read_from_db:
-        your_chars.append(name[0])
-    for player_id in walla_walla:
-        if player_id == user_id and walla_walla[player_id]['character_name'] not in your_chars:
-            your_chars.append(walla_walla[player_id]['character_name'])
-    for char in your_chars:
-        emit('populate_select_with_character_names', {'character_name': char, 'site_name': current_user.get_site_name()})
-
-    for item in initiatives:
-        site_name = read_db("users", "site_name", f"WHERE user_id = '{item[2]}'")[0][0]
-        emit('initiative_update', {'character_name': item[0], 'init_val': item[1], 'site_name': site_name})
-    emit('log_update', {'desc': "Initiative List Received"})
+    # A client coming back from a dropped connection says which event it saw last and is sent only what it missed.
+    # If that's no longer possible it gets a full snapshot instead
+    if message.get('last_seq') is not None:
+        missed = room.events_since(int(message['last_seq']))
+        if missed is not None:
+            for event, payload in missed:
+                emit(event, payload)
+            return
 
-    for item in chats:
-        emit('chat_update', {'chat': item[1], 'character_name': item[0]})
-    emit('log_update', {'desc': "Chat History Received"})
+    # Everything the new client needs is sent as one room_snapshot event
+    seq = room.seq
+    snapshot = room.snapshot()
+    snapshot['your_characters'] = room.user_characters(user_id)
+    snapshot['seq'] = seq
+    emit('room_snapshot', snapshot)
 
-    # populate the map with the character tokens
-    if walla_walla:
-        emit('redraw_character_tokens_on_map', walla_walla, room=room_id)
-        emit('log_update', {'desc': "Character Tokens Received"})
 
-    if read_db("active_room", "*", f"WHERE room_id = '{room_id}' AND is_turn = '1'"):
-        emit('log_update', {'desc': "Combat has already started; grabbing the latest information"})
+@combat_event('character_icon_update_database')
+def character_icon_update_database(message):
+    site_name = message['site_name']
+    room_id = message['room_id']
 
-        character = read_db("active_room", "user_key, chr_name", f"WHERE room_id = '{room_id}' AND is_turn = '1'")[0]
-        turn_site_name = read_db("users", "site_name", f"WHERE user_id = '{character[0]}'")[0][0]
+    room = get_room(room_id)
+    if not room:
+        return
 
-        emit('log_update', {'desc': "Rejoined Combat"}, room=room_id)
-        emit('combat_connect', {'desc': 'Rejoined Combat', 'first_turn_name': character[1], 'site_name': turn_site_name})
+    token = room.find_token(site_name, message['character_name'])
+    if not token:
+        return
 
+    if not token_move_limiter.allow((current_user.get_user_id(), room_id)):
+        # Put the sender's token back where the other clients still see it
+        current = room.token_json(token)
+        emit('token_moved', {'site_name': site_name, 'character_name': token[1], 'top': current['top'], 'left': current['left']})
+        emit('token_resized', {'site_name': site_name, 'character_name': token[1], 'width': current['width'], 'height': current['height']})
+        return
 
-@socketio.on('character_icon_update_database', namespace='/combat')
-def character_icon_update_database(message):
-    site_name = message['site_name']
-    room_id = message['room_id']
-    temp_read_for_user_id = json.loads(read_db("room_object", "map_status", f"WHERE active_room_id = '{room_id}'")[0][0])
-    for character in temp_read_for_user_id:
-        if temp_read_for_user_id[character]['site_name'] == message['site_name'] and temp_read_for_user_id[character]['character_name'] == message['character_name']:
-            user_id_character_name = character
-    
-    # map_status = json.loads(read_db("room_object", "map_status", f"WHERE active_room_id = '{room_id}'")[0][0])
-    walla_walla = json.loads(read_db("room_object", "map_status", f"WHERE active_room_id = '{room_id}'")[0][0])
-    
-    # Clean up locally read copy of map_status (or walla_walla in the interm). This is a temporary solution to the larger design problem described at the end of this file. This also fails to preserve character token locations through multiple sessions. Make sure to replace walla_walla with map_status when this is resolved
-    wrong_room = []
-    for i in walla_walla:
-        if walla_walla[i]['room_id'] != room_id:
-            wrong_room.append(i)
-    for i in wrong_room:
-        del walla_walla[i]
-
-    # Ensure that there is a valid value for the token position and size
-    if message['new_top'] == "Null":
-        new_top = walla_walla[user_id_character_name]['top']
-    else:
-        new_top = message['new_top']
-    if message['new_left'] == "Null":
-        new_left = walla_walla[user_id_character_name]['left']
-    else:
-        new_left = message['new_left']
-    if message['new_width'] == "Null":
-        new_width = walla_walla[user_id_character_name]['width']
-    else:
-        new_width = message['new_width']
-    if message['new_height'] == "Null":
-        new_height = walla_walla[user_id_character_name]['height']
-    else:
-        new_height = message['new_height']
-        
+    # Only the position or the size changes. "Null" means the browser did not change that value
+    token_update = {}
+    for column, field in (("top", "new_top"), ("left", "new_left"), ("width", "new_width"), ("height", "new_height")):
+        if message[field] != "Null":
+            token_update[column] = message[field]
 
-    # TODO: Add check here to make sure that the token you're trying to move is your own and not someone elses. Check the user_id_character_name from user_id_character_name = character in the loop above against current_user.get_site_name(). Add exception for if you are the DM
-    json_character_to_update = { user_id_character_name: {"site_name": message['site_name'], "character_name": message['character_name'], "room_id": message['room_id'], "character_image": message['character_image'], "height": new_height, "width": new_width, "top": new_top, "left": new_left, "is_turn": message['is_turn']}}
-    walla_walla[user_id_character_name] = json_character_to_update[user_id_character_name]
-    characters_json = json.dumps(walla_walla)
-    update_db("room_object", f"map_status = '{characters_json}'", f"WHERE active_room_id = '{room_id}'")
+    # TODO: Add check here to make sure that the token you're trying to move is your own and not someone elses. Check token[0] against current_user.get_user_id(). Add exception for if you are the DM
+    if token_update:
+        change_room(room_id, lambda room: room.update_token(token, **token_update))
 
-    if message['desc'] == "Resize":
-        app.logger.debug(f"User {site_name} has resized their character")
-    elif message['desc'] == "ChangeLocation":
-        app.logger.debug(f"User {site_name} has moved their character to X:{message['new_left']}, Y:{message['new_top']}")
+    # Only the changed token is sent; the clients update that one token on their map
+    if 'top' in token_update or 'left' in token_update:
+        token_log.debug("Token moved", {"room_id": room_id, "character": token[1], "left": message['new_left'], "top": message['new_top']})
+        room_event(room_id, 'token_moved', {'site_name': site_name, 'character_name': token[1], 'top': message['new_top'], 'left': message['new_left']}, current_user.get_user_id(), "Token", f"{token[1]} moved")
         emit('log_update', {'desc': f"{message['character_name']} moved"}, room=room_id)
-
-    emit('redraw_character_tokens_on_map', walla_walla, room=room_id)
+    if 'width' in token_update or 'height' in token_update:
+        token_log.debug("Token resized", {"room_id": room_id, "character": token[1]})
+        room_event(room_id, 'token_resized', {'site_name': site_name, 'character_name': token[1], 'width': message['new_width'], 'height': message['new_height']}, current_user.get_user_id(), "Token", f"{token[1]} resized")
 
 
-@socketio.on('add_character', namespace='/combat')
+@combat_event('add_character')
 def add_character(message):
     character_name = message['char_name']
     room_id = message['room_id']
     user_id = current_user.get_user_id()
     site_name = message['site_name']
-    temp_db_read_character_token = read_db("characters", "char_token", f"WHERE user_key = '{user_id}' AND chr_name = '{character_name}'")
-    init_val = 0
 
-    if temp_db_read_character_token:
-        character_image = temp_db_read_character_token[0][0]
+    room = get_room(room_id)
+    if not room:
+        return
+
+    character = get_character(user_id, character_name)
+
+    if character:
+        character_image = character[15]
     else:
         # TODO: This is just a place holder for if a user does not have an image for their character - but that should never happen anyways
         character_image = "http://upload.wikimedia.org/wikipedia/commons/thumb/f/f7/Auto_Racing_Black_Box.svg/800px-Auto_Racing_Black_Box.svg.png"
 
-    temp_db_read_init_value = read_db("active_room", "init_val", f"WHERE room_id='{room_id}' AND user_key = '{user_id}' AND chr_name = '{character_name}'")
-    if temp_db_read_init_value:
-        init_val = temp_db_read_init_value[0][0]
-    else:
-        add_to_db("active_room", (room_id, user_id, character_name, 0, 0, character_image))
+    added = change_room(room_id, lambda room: add_character_to_room(room, character_name, site_name, character_image, user_id))
+    if added is None:
+        return
+    init_val, position = added
 
-    emit('populate_select_with_character_names', {'character_name': character_name, 'site_name': site_name}, room=room_id)
-    emit('initiative_update', {'character_name': character_name, 'init_val': init_val, 'site_name': site_name}, room=room_id)
-    character_icon_add_database(character_name, site_name, character_image, user_id, room_id)
-    app.logger.debug(f"User {site_name} has added character {character_name} to the battle")
+    room_event(room_id, 'populate_select_with_character_names', {'character_name': character_name, 'site_name': site_name}, user_id, "Character", f"{character_name} joined the battle")
+    room_event(room_id, 'initiative_update', {'character_name': character_name, 'init_val': init_val, 'site_name': site_name, 'position': position}, user_id, "Init", f"{character_name}'s initiative updated in room {room_id}")
+    room_event(room_id, 'token_added', get_room(room_id).token_json((user_id, character_name)), user_id, "Token", f"{character_name} placed on the map")
+    combat_log.debug("Character added to the battle", {"room_id": room_id, "character": character_name})
 
-@socketio.on('add_npc', namespace='/combat')
+@combat_event('add_npc')
 def add_npc(message):
     room_id = message['room_id']
     user_id = current_user.get_user_id()
     random_key = ''.join(random.choice(string.ascii_uppercase + string.ascii_lowercase + string.digits) for _ in range(8))
     character_name = "NPC" + random_key
     site_name = message['site_name']
-    init_val = 0
     character_image = random.choice(npc_images)
 
-    temp_db_read_init_value = read_db("active_room", "init_val", f"WHERE room_id='{room_id}' AND user_key = '{user_id}' AND chr_name = '{character_name}'")
-    if temp_db_read_init_value:
-        init_val = temp_db_read_init_value[0][0]
-    else:
-        add_to_db("active_room", (room_id, user_id, character_name, 0, 0, character_image))
+    room = get_room(room_id)
+    if not room:
+        return
 
-    emit('populate_select_with_character_names', {'character_name': character_name, 'site_name': site_name}, room=room_id)
-    emit('initiative_update', {'character_name': character_name, 'init_val': init_val, 'site_name': site_name}, room=room_id)
-    character_icon_add_database(character_name, site_name, character_image, user_id, room_id)
-    app.logger.debug(f"User {site_name} has added character {character_name} to the battle")
+    if not npc_limiter.allow((user_id, room_id)):
+        emit('log_update', {'desc': "Too many NPCs added, slow down"})
+        return
+
+    added = change_room(room_id, lambda room: add_character_to_room(room, character_name, site_name, character_image, user_id))
+    if added is None:
+        return
+    init_val, position = added
+
+    room_event(room_id, 'populate_select_with_character_names', {'character_name': character_name, 'site_name': site_name}, user_id, "Character", f"{character_name} joined the battle")
+    room_event(room_id, 'initiative_update', {'character_name': character_name, 'init_val': init_val, 'site_name': site_name, 'position': position}, user_id, "Init", f"{character_name}'s initiative updated in room {room_id}")
+    room_event(room_id, 'token_added', get_room(room_id).token_json((user_id, character_name)), user_id, "Token", f"{character_name} placed on the map")
+    combat_log.debug("NPC added to the battle", {"room_id": room_id, "character": character_name})
 
 
 ### ERROR HANDLING 
 
-@app.errorhandler(CSRFError)
+@main.app_errorhandler(CSRFError)
 def handle_csrf_error(e):
-    app.logger.warning(f"A CSRFError has occurred. How did this happen?")
+    http_log.warning("CSRF error")
     return render_template("error.html", error_name="Error Code 400" ,error_desc = "The room you were in has closed!", site_name=current_user.get_site_name()), 400
 
-@app.errorhandler(HTTPException)
+@main.app_errorhandler(HTTPException)
 def generic_error(e):
     # Generic HTTP Exception handler
-        app.logger.warning(f"A HTTP error with code {e.code} has occurred. Handling the error.")
+        http_log.warning("HTTP error", {"code": e.code})
+        error_store.report(f"HTTP {e.code}", request.endpoint or "unmatched", e.description or e.name)
         return render_template("error.html", error_name=f"Error Code {e.code}", error_desc=e.description, site_name=current_user.get_site_name(), profile_pic=current_user.get_profile_pic()), e.code
 
-@app.errorhandler(Exception)
+@main.app_errorhandler(Exception)
 def five_hundred_error(e):
-    app.logger.warning(f"A server error occurred. Handling it, but you probably should fix the bug...")
-    app.logger.error(f"Here it is: {e}")
+    http_log.error("Server error. Handled, but you probably should fix the bug", exc_info=e)
+    error_store.report_exception(e, request.endpoint or "unmatched")
     desc = "Internal Server Error. Congrats! You found an unexpected feature!"
     return render_template("error.html", error_name="Error Code 500", error_desc=desc, site_name=current_user.get_site_name(), profile_pic=current_user.get_profile_pic()), 500
 
-@app.route("/process_error", methods=["POST"])
+@main.route("/process_error", methods=["POST"])
 @login_required
 def process_error():
     if 'error_desc' in request.form:
-        add_to_error_db(request.form['error_desc'])
+        # Errors the browser ran into, grouped like the server's own
+        error_store.report("ClientError", "browser", request.form['error_desc'])
     
-    return redirect(url_for("home"))
+    return redirect(url_for(".home"))
 
 
 
+### APP FACTORY
+def start_scheduler():
+    if current_app.testing or scheduler.running:
+        return
+    scheduler.add_job(retention.run_scheduled, trigger="cron", hour=3, minute=59, kwargs={"max_age": current_app.config['RETENTION_HOURS']}, id="retention", replace_existing=True)
+    scheduler.start()
+
+
+def create_app(config=None):
+    timings = {"imports": imports_done - started}
+    step_started = time.perf_counter()
+
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'secret!'
+    app.secret_key = os.environ.get("SECRET_KEY") or os.urandom(24)
+    app.config['SOCKETIO_MESSAGE_QUEUE'] = os.environ.get("SOCKETIO_MESSAGE_QUEUE")
+    app.config.update(config or {})
+    timings["flask"] = time.perf_counter() - step_started
+    step_started = time.perf_counter()
+
+    message_queue = app.config['SOCKETIO_MESSAGE_QUEUE']
+    socketio.init_app(app, async_mode=async_mode, message_queue=message_queue)
+    set_write_through(message_queue is not None)
+    metrics.count_frames(socketio.server.eio)
+    login_manager.init_app(app)
+    csrf.init_app(app)
+    timings["extensions"] = time.perf_counter() - step_started
+    step_started = time.perf_counter()
+
+    app.register_blueprint(main)
+    app.before_request(metrics.start_request)
+    app.after_request(metrics.finish_request)
+    app.teardown_request(metrics.end_request)
+    app.config.setdefault('METRICS_TOKEN', os.environ.get("METRICS_TOKEN"))
+    timings["routes"] = time.perf_counter() - step_started
+
+    # Rooms left open with no activity for RETENTION_HOURS are closed and their chat and log rows removed; 0 turns it off.
+    # The scheduler thread is started by the first request, so importing the app (tests, benchmarks, scripts) doesn't
+    app.config.setdefault('RETENTION_HOURS', float(os.environ.get("RETENTION_HOURS", retention.max_age_hours)))
+    if app.config['RETENTION_HOURS']:
+        app.before_first_request(start_scheduler)
+
+    # Levels per subsystem come from LOG_LEVEL and LOG_LEVEL_<HTTP|COMBAT|DB>, see logs.py
+    configure_logging(app)
+
+    # The databases are not in here as they are set up on first use; their times end up in db.setup_timings
+    app.config['STARTUP_TIMINGS'] = timings
+    app.logger.info("App created in " + ", ".join(f"{step} {seconds * 1000:.1f} ms" for step, seconds in timings.items()))
+    return app
+
+
+app = create_app()
+
+
 ### APP RUNNING
 if __name__ == "__main__":
     app.run(ssl_context="adhoc", port=33507, debug=True)
 
-if __name__ != "__main__":
-    # logging levels: info, debug, warning, critical, error
-    
-    gunicorn_logger = logging.getLogger('gunicorn.error')
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(logging.DEBUG)
-    # app.logger.setLevel(gunicorn_logger.level)
-
 
 # --- References ---
 # Google login with Flask: https://realpython.com/flask-google-login/
@@ -0,0 +1,102 @@
+import os
+import gzip
+import json
+import time
+import logging
+
+import db
+
+logger = logging.getLogger("db.archive")
+
+# Room archives
+# Ending a room writes everything it recorded (initiative, tokens, chat and the log with its room events) to a gzip
+# compressed JSONL file, one JSON object per line, before the rows are deleted. The rows are streamed out of SQLite
+# a batch at a time straight into the compressor, so memory use does not grow with the length of the session.
+#
+# Archives live in archive_dir/<owner's user_key>/<room_id>-<timestamp>.jsonl.gz. A file is written under a temporary
+# name, synced to disk and then renamed, so an archive that exists is always complete
+archive_dir = os.environ.get("ARCHIVE_DIR", "archives")
+archive_suffix = ".jsonl.gz"
+batch_size = 500 # rows per query while streaming chat and log
+
+
+def user_archive_dir(user_key):
+    return os.path.join(archive_dir, user_key)
+
+
+def list_archives(user_key):
+    # (file name, size in bytes) of a user's archives, newest first
+    directory = user_archive_dir(user_key)
+    if not os.path.isdir(directory):
+        return []
+    names = [name for name in os.listdir(directory) if name.endswith(archive_suffix)]
+    return sorted(((name, os.path.getsize(os.path.join(directory, name))) for name in names),
+                  key=lambda archive: os.path.getmtime(os.path.join(directory, archive[0])), reverse=True)
+
+
+def room_records(room_id, room_name, owner):
+    # Every line of a room's archive, produced lazily
+    yield {"type": "room", "room_id": room_id, "room_name": room_name, "owner": owner, "exported_at": db.current_timestamp()}
+    for user_key, chr_name, init_val, is_turn, char_token in db.select("active_room", "user_key, chr_name, init_val, is_turn, char_token", {"room_id": room_id}):
+        yield {"type": "initiative", "user_key": user_key, "character_name": chr_name, "init_val": init_val, "is_turn": is_turn, "char_token": char_token}
+    for row in db.read_map_tokens(room_id):
+        yield dict(db.map_token_json(row), type="token")
+    for user_key, chr_name, chat, timestamp in db.iter_room_rows("chat", room_id, "user_key, chr_name, chat, timestamp", batch_size):
+        yield {"type": "chat", "user_key": user_key, "character_name": chr_name, "chat": chat, "timestamp": timestamp}
+    for user_key, title, log, timestamp, seq, event, payload in db.iter_room_rows("log", room_id, "user_key, title, log, timestamp, seq, event, payload", batch_size):
+        record = {"type": "log", "user_key": user_key, "title": title, "desc": log, "timestamp": timestamp}
+        if seq is not None:
+            record.update(seq=seq, event=event, payload=json.loads(payload))
+        yield record
+
+
+def write_archive(room_id, room_name, owner):
+    # Writes the room's archive and returns its path once it is safely on disk
+    directory = user_archive_dir(owner)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{room_id}-{db.current_timestamp()}{archive_suffix}")
+    tmp_path = path + ".tmp"
+    started = time.perf_counter()
+    try:
+        with open(tmp_path, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as archive:
+                for lines, record in enumerate(room_records(room_id, room_name, owner), 1):
+                    archive.write(json.dumps(record).encode() + b"\n")
+                    if lines % batch_size == 0:
+                        # Lets other greenlets run between batches when served by eventlet
+                        time.sleep(0)
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    sync_directory(directory)
+    logger.info("Room archived", {"room_id": room_id, "path": path, "ms": round((time.perf_counter() - started) * 1000, 1)})
+    return path
+
+
+def archive_room(room_id, room_name, owner):
+    # Archives an ended room and then deletes its rows. If the archive can't be written the rows are kept and left
+    # for the retention job, which deletes them once the room has been quiet for its max age. Returns the archive's
+    # path, or None if it failed
+    try:
+        path = write_archive(room_id, room_name, owner)
+    except Exception:
+        logger.exception("Could not archive room, its rows are left for retention", {"room_id": room_id})
+        return None
+    for table_name in ("active_room", "map_token", "chat", "log"):
+        db.delete(table_name, {"room_id": room_id})
+    return path
+
+
+def sync_directory(directory):
+    # Makes the rename itself durable. Directories can't be opened for syncing on Windows
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
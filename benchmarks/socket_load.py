@@ -0,0 +1,265 @@
+# Load test for the /combat Socket.IO handlers
+# Opens R rooms with P players each (plus the DM) through the Flask-SocketIO test client, then drives a mix of
+# send_chat, character_icon_update_database, set_initiative, end_turn and join_actions at them as fast as they are
+# handled. Reports throughput, p50/p95/p99 handler latency per event and SQL statements per event. Statements are
+# counted by db's query tracing, the same counts the query budget tests assert on
+#
+#   python benchmarks/socket_load.py --rooms 10 --players 4 --events 5000
+#   python benchmarks/socket_load.py --save      # store the numbers as the baseline for this scenario
+#
+# Runs are compared against benchmarks/baselines.json when it has the same scenario. The databases live in a
+# temporary directory, so the run starts from empty tables every time
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import collections
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(repo_dir)
+os.chdir(repo_dir)
+
+import db
+import archive
+import room_state
+from classes import RateLimiter
+
+baselines_file = os.path.join(repo_dir, "benchmarks", "baselines.json")
+
+# Share of each event in the mix. join_actions is a reconnect, half of them resuming from a recent seq
+default_mix = {"send_chat": 30, "character_icon_update_database": 40, "set_initiative": 10, "end_turn": 10, "join_actions": 10}
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+class Player:
+    def __init__(self, app, socketio, user_id, site_name, character_name):
+        self.user_id = user_id
+        self.site_name = site_name
+        self.character_name = character_name
+        self.http = app.test_client()
+        with self.http.session_transaction() as session:
+            # Flask-Login keeps the logged in user's id in the session
+            session["user_id"] = session["_user_id"] = user_id
+            session["_fresh"] = True
+        self.socket = socketio.test_client(app, namespace="/combat", flask_test_client=self.http)
+        self.last_seq = 0
+
+    def emit(self, event, message):
+        self.socket.emit(event, message, namespace="/combat")
+
+    def drain(self):
+        # Keeps the received queue from growing and remembers the newest seq, like the browser does
+        received = 0
+        for packet in self.socket.get_received("/combat"):
+            received += 1
+            for arg in packet["args"]:
+                if isinstance(arg, dict) and arg.get("seq"):
+                    self.last_seq = max(self.last_seq, arg["seq"])
+        return received
+
+
+def set_up_rooms(app, socketio, rooms, players):
+    # Returns {room_id: [dm, player, ...]} with every character in the room, initiative set and combat started
+    layout = {}
+    for r in range(rooms):
+        members = []
+        for p in range(players + 1):
+            user_id = f"bench{r}x{p}"
+            site_name = f"bench_{r}_{p}"
+            character_name = f"Hero {r} {p}"
+            db.add_to_db("users", (user_id, user_id, "bench@example.com", "pic.jpg", site_name))
+            db.add_to_db("chars", (user_id, character_name, "Ranger", "Hunter", "Elf", "High Elf", 30, 1, 10, 10, 10, 10, 10, 10, 10, "token.jpg"))
+            members.append((user_id, site_name, character_name))
+        room_id = f"bench{r:03d}"
+        db.add_to_db("room_object", (members[0][0], f"Bench Room {r}", room_id, "{}", "map.jpg", ""))
+
+        room_players = []
+        for user_id, site_name, character_name in members:
+            player = Player(app, socketio, user_id, site_name, character_name)
+            player.emit("on_join", {"room_id": room_id})
+            player.emit("join_actions", {"room_id": room_id, "character_name": ""})
+            player.emit("add_character", {"char_name": character_name, "site_name": site_name, "room_id": room_id})
+            player.emit("set_initiative", {"character_name": character_name, "init_val": str(random.randint(1, 20)), "site_name": site_name, "room_id": room_id})
+            room_players.append(player)
+        room_players[0].emit("start_combat", {"desc": "Start", "room_id": room_id})
+        for player in room_players:
+            player.drain()
+        layout[room_id] = room_players
+    return layout
+
+
+def next_event(room_id, room_players, event, rng):
+    # Picks who sends the event and builds its message
+    if event == "end_turn":
+        holder = room_state.get_room(room_id).turn
+        player = next(player for player in room_players if (player.user_id, player.character_name) == holder)
+        return player, {"previous_character_name": player.character_name, "room_id": room_id}
+
+    player = rng.choice(room_players)
+    if event == "send_chat":
+        return player, {"chat": f"Attack roll: {rng.randint(1, 20)}", "character_name": player.character_name, "room_id": room_id}
+    if event == "character_icon_update_database":
+        return player, {"desc": "ChangeLocation", "character_image": "token.jpg", "site_name": player.site_name, "character_name": player.character_name,
+                        "new_top": f"{rng.randint(0, 800)}px", "new_left": f"{rng.randint(0, 800)}px", "new_width": "Null", "new_height": "Null", "is_turn": 0, "room_id": room_id}
+    if event == "set_initiative":
+        return player, {"character_name": player.character_name, "init_val": str(rng.randint(1, 20)), "site_name": player.site_name, "room_id": room_id}
+    # join_actions: a reconnect, either resuming from the last seq it saw or asking for a snapshot
+    last_seq = player.last_seq if rng.random() < 0.5 else None
+    return player, {"room_id": room_id, "character_name": "", "last_seq": last_seq}
+
+
+def run(rooms, players, events, mix, seed, keep_rate_limits=False, write_through=False):
+    tmp_dir = tempfile.mkdtemp(prefix="socket_load_")
+    db.battle_sesh_db = os.path.join(tmp_dir, "battle_sesh.db")
+    db.error_db = os.path.join(tmp_dir, "error.db")
+    archive.archive_dir = os.path.join(tmp_dir, "archives")
+
+    import app as app_module
+    app, socketio = app_module.app, app_module.socketio
+    if not keep_rate_limits:
+        # The limiters would turn most of a flood like this into refusals; the point here is the handlers' cost
+        for name in ("chat_limiter", "token_move_limiter", "initiative_limiter", "npc_limiter"):
+            setattr(app_module, name, RateLimiter(10 ** 9, 1))
+    room_state.set_write_through(write_through)
+
+    rng = random.Random(seed)
+    random.seed(seed)
+    layout = set_up_rooms(app, socketio, rooms, players)
+    db.write_behind.flush()
+
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    latencies = collections.defaultdict(list)
+    statements = collections.defaultdict(int)
+    room_ids = list(layout)
+    statements_before = db.statements_run
+    received = 0
+
+    started = time.perf_counter()
+    for i in range(events):
+        room_id = rng.choice(room_ids)
+        event = rng.choices(names, weights)[0]
+        player, message = next_event(room_id, layout[room_id], event, rng)
+        sent = time.perf_counter()
+        # The handler runs inside emit on this thread, so its statements land in this trace
+        with db.traced(event) as trace:
+            player.emit(event, message)
+        latencies[event].append(time.perf_counter() - sent)
+        statements[event] += trace.count
+        if i % 50 == 0:
+            received += sum(player.drain() for room_players in layout.values() for player in room_players)
+    db.write_behind.flush()
+    elapsed = time.perf_counter() - started
+    received += sum(player.drain() for room_players in layout.values() for player in room_players)
+
+    total_statements = db.statements_run - statements_before
+    handler_statements = sum(statements.values())
+    report = {
+        "scenario": scenario_name(rooms, players, events, write_through),
+        "events": events,
+        "seconds": round(elapsed, 3),
+        "events_per_second": round(events / elapsed, 1),
+        "messages_received": received,
+        "statements_per_event": round(total_statements / events, 2),
+        "background_statements_per_event": round((total_statements - handler_statements) / events, 2),
+        "handlers": {},
+    }
+    for event in names:
+        values = sorted(latencies[event])
+        if not values:
+            continue
+        report["handlers"][event] = {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 50) * 1000, 3),
+            "p95_ms": round(percentile(values, 95) * 1000, 3),
+            "p99_ms": round(percentile(values, 99) * 1000, 3),
+            "statements_per_event": round(statements[event] / len(values), 2),
+        }
+    return report
+
+
+def scenario_name(rooms, players, events, write_through):
+    return f"rooms{rooms}_players{players}_events{events}" + ("_write_through" if write_through else "")
+
+
+def load_baselines():
+    if not os.path.exists(baselines_file):
+        return {}
+    with open(baselines_file) as f:
+        return json.load(f)
+
+
+def print_report(report, baseline=None):
+    def change(new, old):
+        if not old:
+            return ""
+        return f" ({(new - old) / old * 100:+.0f}%)"
+
+    print(f"{report['scenario']}: {report['events']} events in {report['seconds']} s")
+    print(f"  throughput {report['events_per_second']} events/s" + change(report['events_per_second'], baseline and baseline['events_per_second']))
+    print(f"  SQL statements per event {report['statements_per_event']} ({report['background_statements_per_event']} from background threads)"
+          + change(report['statements_per_event'], baseline and baseline['statements_per_event']))
+    print(f"  {'event':<32}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'stmts':>8}")
+    for event, numbers in report["handlers"].items():
+        old = (baseline or {}).get("handlers", {}).get(event, {})
+        print(f"  {event:<32}{numbers['count']:>7}{numbers['p50_ms']:>10}{numbers['p95_ms']:>10}{numbers['p99_ms']:>10}{numbers['statements_per_event']:>8}"
+              + change(numbers['p95_ms'], old.get('p95_ms')))
+
+
+def regressions(report, baseline, tolerance):
+    # Handlers whose p95 latency or statement count went up by more than tolerance (a fraction) over the baseline
+    found = []
+    for event, numbers in report["handlers"].items():
+        old = baseline.get("handlers", {}).get(event)
+        if not old:
+            continue
+        if numbers["p95_ms"] > old["p95_ms"] * (1 + tolerance):
+            found.append(f"{event} p95 {old['p95_ms']} -> {numbers['p95_ms']} ms")
+        if numbers["statements_per_event"] > old["statements_per_event"] * (1 + tolerance):
+            found.append(f"{event} statements {old['statements_per_event']} -> {numbers['statements_per_event']}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for the /combat Socket.IO handlers")
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--players", type=int, default=4, help="players per room, not counting the DM")
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=490)
+    parser.add_argument("--mix", type=json.loads, default=default_mix, help='event weights as JSON, e.g. \'{"send_chat": 1}\'')
+    parser.add_argument("--write-through", action="store_true", help="run the rooms the way several workers do")
+    parser.add_argument("--keep-rate-limits", action="store_true")
+    parser.add_argument("--save", action="store_true", help="save this run as the baseline of its scenario")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p95/statement increase over the baseline")
+    args = parser.parse_args()
+
+    report = run(args.rooms, args.players, args.events, args.mix, args.seed, args.keep_rate_limits, args.write_through)
+    baselines = load_baselines()
+    baseline = baselines.get(report["scenario"])
+    print_report(report, baseline)
+
+    if args.save:
+        baselines[report["scenario"]] = report
+        with open(baselines_file, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Saved baseline for {report['scenario']}")
+    elif baseline:
+        found = regressions(report, baseline, args.tolerance)
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,9 @@ from wtforms.validators import Length, NumberRange, DataRequired, ValidationErro
 from wtforms_validators import AlphaNumeric, AlphaSpace
 import random
 import string
+import time
+import threading
+import collections
 
 
 ##
@@ -95,3 +98,47 @@ class AnonymousUser(AnonymousUserMixin):
         return self.site_name
 
 
+class RateLimiter:
+    # Sliding-window limiter kept in memory: allows max_events per window seconds for each key (e.g. a
+    # (user, room) pair). A key that goes over the limit is refused for penalty seconds. Each key keeps at most
+    # max_events timestamps, so a check costs the same however long the session has been going
+    def __init__(self, max_events, window, penalty=0):
+        self.max_events = max_events
+        self.window = window
+        self.penalty = penalty
+        self.events = {} # key -> deque of event times, oldest first
+        self.blocked_until = {}
+        self.lock = threading.Lock()
+        self.checks = 0
+
+    def allow(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.checks += 1
+            if self.checks % 1000 == 0:
+                self.prune(now)
+
+            if self.blocked_until.get(key, 0) > now:
+                return False
+
+            events = self.events.get(key)
+            if events is None:
+                events = self.events[key] = collections.deque(maxlen=self.max_events)
+            while events and now - events[0] >= self.window:
+                events.popleft()
+
+            if len(events) >= self.max_events:
+                if self.penalty:
+                    self.blocked_until[key] = now + self.penalty
+                return False
+
+            events.append(now)
+            return True
+
+    def prune(self, now):
+        # Forgets keys with no events in the window and no penalty running
+        for key in list(self.events):
+            events = self.events[key]
+            if (not events or now - events[-1] >= self.window) and self.blocked_until.get(key, 0) <= now:
+                del self.events[key]
+                self.blocked_until.pop(key, None)
@@ -1,5 +1,22 @@
 import sqlite3
 import csv
+import json
+import os
+import hashlib
+import queue
+import atexit
+import time
+import threading
+import collections
+import logging
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # Windows: no file locks
+    fcntl = None
+
+logger = logging.getLogger(__name__)
 
 # Global variable declarations
 global battle_sesh_db
@@ -9,26 +26,233 @@ battle_sesh_db = "battle_sesh.db"
 api_db = "api.db"
 error_db = "error.db"
 
+# Connection pool settings. Each pool keeps at most pool_size idle connections around;
+# extra connections opened during a burst are closed when they are returned
+pool_size = 8
+busy_timeout = 5000 # in milliseconds
+cache_size = -8192 # negative values are in KiB, so this is 8MB of page cache per connection
+mmap_size = 64 * 1024 * 1024 # in bytes
+statement_cache_size = 256 # prepared statements kept per connection
+
+global pools
+pools = {}
+
+# Databases are set up the first time they are used rather than when the app is imported
+global prepared_dbs
+prepared_dbs = set()
+preparing_dbs = set()
+prepare_lock = threading.RLock()
+setup_timings = {} # db file -> seconds its setup took
+
+
+# Query tracing
+# Pooled connections run every statement through TracedCursor, which counts it against the trace of the route or
+# socket event that ran it (see traced) and logs it with its EXPLAIN QUERY PLAN if it took slow_query_ms or more.
+# Traces are kept per thread, which under eventlet means per greenlet. A SELECT is timed until its first row.
+# statements_run counts every statement on every thread, including the write-behind and checkpoint threads
+slow_query_ms = float(os.environ.get("SLOW_QUERY_MS", 100))
+slow_query_logger = logging.getLogger("db.slow_queries")
+trace_local = threading.local()
+statements_run = 0
+statements_lock = threading.Lock()
+
+
+class QueryTrace:
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = []
+
+
+def current_trace():
+    return getattr(trace_local, "trace", None)
+
+
+def begin_trace(name):
+    # Statements run until end_trace count against this trace and every trace it was started inside of
+    trace = QueryTrace(name, current_trace())
+    trace_local.trace = trace
+    return trace
+
+
+def end_trace(trace):
+    trace_local.trace = trace.parent
+
+
+@contextmanager
+def traced(name):
+    trace = begin_trace(name)
+    try:
+        yield trace
+    finally:
+        end_trace(trace)
+
+
+def record_query(conn, sql, parameters, elapsed):
+    global statements_run
+    with statements_lock:
+        statements_run += 1
+    trace = current_trace()
+    while trace is not None:
+        trace.count += 1
+        trace.seconds += elapsed
+        trace.statements.append(sql)
+        trace = trace.parent
+    if elapsed * 1000 >= slow_query_ms and slow_query_logger.isEnabledFor(logging.WARNING):
+        # The EXPLAIN is a query of its own, so it is skipped when nobody would see the result
+        log_slow_query(conn, sql, parameters, elapsed)
+
+
+def log_slow_query(conn, sql, parameters, elapsed):
+    plan = "n/a"
+    if parameters is not None and sql.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")):
+        try:
+            # A plain cursor, so the EXPLAIN itself is not traced
+            rows = conn.cursor(sqlite3.Cursor).execute(f"EXPLAIN QUERY PLAN {sql}", parameters).fetchall()
+            plan = "; ".join(row[-1] for row in rows)
+        except sqlite3.Error as e:
+            plan = f"unavailable ({e})"
+    trace = current_trace()
+    source = trace.name if trace else "no request"
+    slow_query_logger.warning("Slow query", {"source": source, "ms": round(elapsed * 1000, 1), "sql": " ".join(sql.split()), "plan": plan})
+
+
+class TracedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(self.connection, sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(self.connection, sql, None, time.perf_counter() - started)
+
+
+class TracedConnection(sqlite3.Connection):
+    # conn.execute and conn.executemany go through cursor() as well
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+
+class ConnectionPool:
+    # Keeps long-lived connections to a single database file so that handlers do not pay for
+    # sqlite3.connect and the pragma setup on every statement. Connections are handed out to one
+    # thread (or greenlet under eventlet) at a time, which is why check_same_thread can be turned off
+    def __init__(self, db_file, size=pool_size, read_only=False):
+        self.db_file = db_file
+        self.read_only = read_only
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def _connect(self):
+        if self.read_only:
+            # immutable=1 tells SQLite the file never changes underneath it, so it skips locking and change checks
+            conn = sqlite3.connect(f"file:{self.db_file}?mode=ro&immutable=1", uri=True, check_same_thread=False, cached_statements=statement_cache_size, factory=TracedConnection)
+            conn.execute(f"PRAGMA mmap_size = {mmap_size};")
+        else:
+            conn = sqlite3.connect(self.db_file, check_same_thread=False, cached_statements=statement_cache_size, factory=TracedConnection)
+            conn.execute("PRAGMA journal_mode = WAL;")
+            conn.execute("PRAGMA synchronous = NORMAL;")
+            conn.execute(f"PRAGMA mmap_size = {mmap_size};")
+            conn.execute(f"PRAGMA cache_size = {cache_size};")
+            conn.execute(f"PRAGMA busy_timeout = {busy_timeout};")
+        return conn
+
+    def checkout(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def checkin(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def get_pool(db_file):
+    pool = pools.get(db_file)
+    if pool is None:
+        # api.db is only written by build_api_db, which replaces the whole file, so it is opened read-only
+        pool = pools.setdefault(db_file, ConnectionPool(db_file, read_only=(db_file == api_db)))
+    return pool
+
+
+@contextmanager
 def create_connection(db_file):
-    conn = sqlite3.connect(db_file)
-    return conn
+    # Checks a connection out of the pool for db_file. The block runs as one transaction:
+    # it commits when the block exits cleanly and rolls back if it raises
+    if db_file not in prepared_dbs:
+        prepare_db(db_file)
+    pool = get_pool(db_file)
+    conn = pool.checkout()
+    try:
+        with conn:
+            yield conn
+    finally:
+        pool.checkin(conn)
+
+
+def prepare_db(db_file):
+    # Runs the one-time setup of a database file (migrations, catalog build) before its first use in this process.
+    # The setup itself opens connections to the same file, which pass straight through while it is running
+    setups = {battle_sesh_db: create_dbs, api_db: build_catalog, error_db: build_error_db}
+    with prepare_lock:
+        if db_file in prepared_dbs or db_file in preparing_dbs:
+            return
+        preparing_dbs.add(db_file)
+        try:
+            if db_file in setups:
+                started = time.perf_counter()
+                setups[db_file]()
+                setup_timings[db_file] = time.perf_counter() - started
+                logger.info("Database set up", {"file": db_file, "ms": round(setup_timings[db_file] * 1000, 1)})
+        finally:
+            preparing_dbs.discard(db_file)
+        prepared_dbs.add(db_file)
+
+
+def close_connections():
+    for pool in pools.values():
+        pool.close_all()
+
+atexit.register(close_connections)
 
 
 # TODO: Update these table descriptions
 
 # log table
+# row_id = rowid alias, increases with every entry
 # room_id = Global identifier for battle map created by user
 # user_key = Unique user ID, allows for maps to be sorted by users
 # title = ***CHANGED** used to name type of data being saved such as chat, action, connections etc.
 # Log = entry from log, entered by users. Tracked to actions in battle and other relevant info
-# timestamp = used to keep order of log entries for the room
+# timestamp = used to keep order of log entries for the room (epoch milliseconds)
+# seq, event, payload = set for room events only: per-room sequence number, socket event name and its JSON payload
 
 # chat table
 # (derived from log table to better ecapsulate these two tools)
+# row_id = rowid alias, increases with every chat
 # room_id & user_key = tracks room and user who output text
 # character name = utilized to track which character in the party chatted
 # chat = holds what has been sent to chat
-# timestamp = when a chat was sent
+# timestamp = when a chat was sent (epoch milliseconds)
 
 # active_room table
 # room_id = Global identifier for battle map created by user
@@ -43,8 +267,17 @@ def create_connection(db_file):
 # User_key - ‘owner’ of the room, needed to lock out others from editing the room
 # Name of room - what the owner of the room calls it (for visual purposes)
 # Active room id - null if room not open, changes when room is ‘opened’ !!! THIS IS EQUIVALENT TO 'ROOM_ID IN chat, active_room, log, and characters !!!
-# Map_status - stringified JSON representation of character tokens and locations on map. ex: { user_id: { site_name, character_name, character_image, room_id, height, width, top, left, is_turn } }
+# Map_status - no longer used, character tokens now live in the map_token table (was stringified JSON of the tokens)
 # Map URL - URL to the map (for the “background”)
+# State version - bumped on every change to the open room's initiative or tokens, used to keep workers in step
+# Event seq - last room event sequence number handed out, used when several workers serve the room
+
+# map_token table
+# room_id, user_key, chr_name = the token's room and the character it belongs to (primary key)
+# site_name = owner's site name, used to look up tokens moved from the browser
+# character_image = URL of the token image
+# height, width, top_pos, left_pos = CSS size and position of the token on the map
+# is_turn = 1 if it is this character's turn
 
 # users table ****** THIS IS THE ONLY TABLE THAT UTILIZES USER_ID INSTEAD OF USER_KEY BUT THEY ARE SYNONYMOUS ******
 # user_id = user_id gotten from Google 
@@ -59,52 +292,593 @@ def create_connection(db_file):
 # chr_name, race, subclass, hitpoints = tracks character details and stats
 # user_key and chr_name = primary keys to allow a character to be tracked across rooms and to allow repeats of character names across 
 
+# Schema migrations
+# Each migration upgrades the battle session database by one version and is recorded in the schema_version
+# table, so create_dbs() can be run on every startup and only applies what an existing database is missing.
+# Each one runs once per database; reset_db() recreates its table from the current definition instead of replaying them
+
+def migration_base_tables(cur):
+    cur.execute(f"""CREATE TABLE IF NOT EXISTS log 
+                    (row_id INT PRIMARY KEY, room_id TEXT, user_key TEXT, title TEXT, log LONGTEXT, timestamp DATETIME); """)
+    
+    cur.execute(f"""CREATE TABLE IF NOT EXISTS chat
+                    (row_id INT PRIMARY KEY, room_id TEXT, user_key TEXT, chr_name TEXT, chat TEXT, timestamp DATETIME);""")
+    
+    cur.execute(f"""CREATE TABLE IF NOT EXISTS active_room 
+                    (room_id TEXT, user_key TEXT, chr_name TEXT, init_val INT, is_turn INT, char_token TEXT, PRIMARY KEY(room_id, user_key, chr_name));""") 
+
+    cur.execute(f"""CREATE TABLE IF NOT EXISTS room_object
+                    (row_id INTEGER PRIMARY KEY, user_key TEXT, room_name TEXT, active_room_id TEXT, map_status TEXT, map_url TEXT, dm_notes TEXT);""")
+    
+    cur.execute(f"""CREATE TABLE IF NOT EXISTS users 
+                    (user_id TEXT PRIMARY KEY, user_name TEXT NOT NULL, email TEXT NOT NULL, profile_pic TEXT, site_name Text);""") 
+
+    cur.execute(f""" CREATE TABLE IF NOT EXISTS characters
+                        (user_key TEXT, chr_name TEXT, class TEXT, subclass TEXT, race TEXT, subrace TEXT, speed INT, level INT, strength INT, dexterity INT, constitution INT, intelligence INT, wisdom INT, charisma INT, hitpoints INT, char_token TEXT, PRIMARY KEY(user_key, chr_name));""")
+
+
+def migration_rowids_and_timestamps(cur):
+    # "INT PRIMARY KEY" is not a rowid alias, so row_id was always NULL. The tables are rebuilt with
+    # INTEGER PRIMARY KEY and the ISO timestamp strings (local time) are converted to epoch milliseconds
+    to_epoch_ms = "CASE typeof(timestamp) WHEN 'text' THEN CAST(strftime('%s', timestamp, 'utc') AS INTEGER) * 1000 ELSE timestamp END"
+
+    cur.execute("""CREATE TABLE log_new
+                    (row_id INTEGER PRIMARY KEY, room_id TEXT, user_key TEXT, title TEXT, log TEXT, timestamp INTEGER);""")
+    cur.execute(f"""INSERT INTO log_new(room_id, user_key, title, log, timestamp)
+                    SELECT room_id, user_key, title, log, {to_epoch_ms} FROM log ORDER BY rowid;""")
+    cur.execute("DROP TABLE log;")
+    cur.execute("ALTER TABLE log_new RENAME TO log;")
+
+    cur.execute("""CREATE TABLE chat_new
+                    (row_id INTEGER PRIMARY KEY, room_id TEXT, user_key TEXT, chr_name TEXT, chat TEXT, timestamp INTEGER);""")
+    cur.execute(f"""INSERT INTO chat_new(room_id, user_key, chr_name, chat, timestamp)
+                    SELECT room_id, user_key, chr_name, chat, {to_epoch_ms} FROM chat ORDER BY rowid;""")
+    cur.execute("DROP TABLE chat;")
+    cur.execute("ALTER TABLE chat_new RENAME TO chat;")
+
+
+def migration_hot_path_indexes(cur):
+    # One index per WHERE clause used by app.py that the primary keys do not already cover
+    cur.execute("CREATE INDEX IF NOT EXISTS chat_room_user ON chat(room_id, user_key, timestamp);")
+    cur.execute("CREATE INDEX IF NOT EXISTS chat_user_character ON chat(user_key, chr_name);")
+    cur.execute("CREATE INDEX IF NOT EXISTS log_room ON log(room_id, timestamp);")
+    cur.execute("CREATE INDEX IF NOT EXISTS log_user ON log(user_key);")
+    cur.execute("CREATE INDEX IF NOT EXISTS active_room_turn ON active_room(room_id, is_turn);")
+    cur.execute("CREATE INDEX IF NOT EXISTS active_room_user_character ON active_room(user_key, chr_name);")
+    cur.execute("CREATE INDEX IF NOT EXISTS room_object_active_room ON room_object(active_room_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS room_object_user_room ON room_object(user_key, room_name);")
+    cur.execute("CREATE INDEX IF NOT EXISTS users_site_name ON users(site_name);")
+
+
+def migration_map_tokens(cur):
+    # Map tokens move out of the room_object.map_status JSON blob into one row per token, so a move or
+    # resize only touches its own row. Tokens of currently open rooms are carried over
+    cur.execute("""CREATE TABLE IF NOT EXISTS map_token
+                    (room_id TEXT, user_key TEXT, chr_name TEXT, site_name TEXT, character_image TEXT, height TEXT, width TEXT, top_pos TEXT, left_pos TEXT, is_turn INT, PRIMARY KEY(room_id, user_key, chr_name));""")
+    cur.execute("CREATE INDEX IF NOT EXISTS map_token_site_name ON map_token(room_id, site_name, chr_name);")
+
+    open_rooms = cur.execute("SELECT active_room_id, map_status FROM room_object WHERE active_room_id != 'null' AND map_status IS NOT NULL;").fetchall()
+    for room_id, map_status in open_rooms:
+        try:
+            tokens = json.loads(map_status)
+        except ValueError:
+            continue
+        for key, token in tokens.items():
+            if token.get('room_id') != room_id:
+                continue
+            # Tokens were keyed as "<user_id>_<character name>"
+            user_key = key[:-(len(token['character_name']) + 1)]
+            cur.execute(f"INSERT OR IGNORE INTO map_token({map_token_columns}) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                        (room_id, user_key, token['character_name'], token['site_name'], token['character_image'], token['height'], token['width'], token['top'], token['left'], token['is_turn']))
+        cur.execute("UPDATE room_object SET map_status = '{}' WHERE active_room_id = ?;", (room_id,))
+
+
+def migration_room_state_version(cur):
+    # Bumped on every change to an open room's initiative or tokens, so workers can tell when their copy is stale
+    cur.execute("ALTER TABLE room_object ADD COLUMN state_version INTEGER NOT NULL DEFAULT 0;")
+
+
+def migration_history_indexes(cur):
+    # Keyset pagination of chat and log history walks (room_id, row_id) backwards from a cursor
+    cur.execute("CREATE INDEX IF NOT EXISTS chat_room_row ON chat(room_id, row_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS log_room_row ON log(room_id, row_id);")
+
+
+def migration_room_events(cur):
+    # Room events (chat, initiative, turns, tokens, combat) are log rows with a per-room sequence number, the
+    # event name and its JSON payload, so a reconnecting client can be sent just the events it missed
+    cur.execute("ALTER TABLE log ADD COLUMN seq INTEGER;")
+    cur.execute("ALTER TABLE log ADD COLUMN event TEXT;")
+    cur.execute("ALTER TABLE log ADD COLUMN payload TEXT;")
+    cur.execute("CREATE INDEX IF NOT EXISTS log_room_seq ON log(room_id, seq) WHERE seq IS NOT NULL;")
+    cur.execute("ALTER TABLE room_object ADD COLUMN event_seq INTEGER NOT NULL DEFAULT 0;")
+
+
+def migration_retention_indexes(cur):
+    # The retention job finds the oldest chat and log rows without knowing their room
+    cur.execute("CREATE INDEX IF NOT EXISTS chat_timestamp ON chat(timestamp);")
+    cur.execute("CREATE INDEX IF NOT EXISTS log_timestamp ON log(timestamp);")
+
+
+def migration_unique_open_room_ids(cur):
+    # An open room's id belongs to one room_object row. Closed rooms all have 'null' (or '' in old rows), so the
+    # index only covers open ones. Rows that already share an id keep it on the newest row only
+    cur.execute("""UPDATE room_object SET active_room_id = 'null' WHERE active_room_id NOT IN ('null', '')
+                    AND row_id NOT IN (SELECT MAX(row_id) FROM room_object WHERE active_room_id NOT IN ('null', '') GROUP BY active_room_id);""")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS room_object_open_room_id ON room_object(active_room_id) WHERE active_room_id NOT IN ('null', '');")
+
+
+migrations = [
+    migration_base_tables,
+    migration_rowids_and_timestamps,
+    migration_hot_path_indexes,
+    migration_map_tokens,
+    migration_room_state_version,
+    migration_history_indexes,
+    migration_room_events,
+    migration_retention_indexes,
+    migration_unique_open_room_ids,
+]
+
+
+def migrate_db(conn, migrations):
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied_at INTEGER);")
+    while True:
+        # BEGIN IMMEDIATE takes the write lock before the version is read, so two workers starting at
+        # the same time cannot both apply the same migration
+        conn.execute("BEGIN IMMEDIATE;")
+        try:
+            version = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version;").fetchone()[0]
+            if version >= len(migrations):
+                conn.commit()
+                return version
+            migrations[version](conn.cursor())
+            conn.execute("INSERT INTO schema_version(version, applied_at) VALUES(?, ?);", (version + 1, current_timestamp()))
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+
+
+def current_timestamp():
+    # Timestamps are stored as integer epoch milliseconds
+    return int(time.time() * 1000)
+
+
+@contextmanager
+def setup_lock():
+    # Lock file next to the database, held while a worker or the offline setup switches it to incremental auto-vacuum.
+    # VACUUM can't run inside the BEGIN IMMEDIATE the migrations use, so it needs a lock of its own
+    if fcntl is None:
+        yield
+        return
+    with open(f"{battle_sesh_db}.setup", "a+") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def use_incremental_vacuum(conn, rewrite_existing=False):
+    # Incremental auto-vacuum lets the retention job give pages back a few at a time. Switching takes a full VACUUM,
+    # which is instant for a new, empty database but rewrites every page of an existing one, so that is only done
+    # with rewrite_existing (the offline setup below). Returns whether the database uses it afterwards
+    with setup_lock():
+        # Checked again with the lock held, another worker may have just switched it
+        if conn.execute("PRAGMA auto_vacuum;").fetchone()[0] == 2:
+            return True
+        if not rewrite_existing and conn.execute("SELECT 1 FROM sqlite_master LIMIT 1;").fetchone():
+            return False
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        conn.execute("VACUUM;")
+        return True
+
+
 def create_dbs():
     with create_connection(battle_sesh_db) as conn:
-        cur = conn.cursor()
-        cur.execute(f"""CREATE TABLE IF NOT EXISTS log 
-                        (row_id INT PRIMARY KEY, room_id TEXT, user_key TEXT, title TEXT, log LONGTEXT, timestamp DATETIME); """)
-        
-        cur.execute(f"""CREATE TABLE IF NOT EXISTS chat
-                        (row_id INT PRIMARY KEY, room_id TEXT, user_key TEXT, chr_name TEXT, chat TEXT, timestamp DATETIME);""")
+        if not use_incremental_vacuum(conn):
+            logger.warning("Database doesn't use incremental auto-vacuum, retention can't give its free pages back. Run `python db.py` while the app is stopped to switch it", {"file": battle_sesh_db})
+        migrate_db(conn, migrations)
         
-        cur.execute(f"""CREATE TABLE IF NOT EXISTS active_room 
-                        (room_id TEXT, user_key TEXT, chr_name TEXT, init_val INT, is_turn INT, char_token TEXT, PRIMARY KEY(room_id, user_key, chr_name));""") 
 
-        cur.execute(f"""CREATE TABLE IF NOT EXISTS room_object
-                        (row_id INTEGER PRIMARY KEY, user_key TEXT, room_name TEXT, active_room_id TEXT, map_status TEXT, map_url TEXT, dm_notes TEXT);""")
-        
-        cur.execute(f"""CREATE TABLE IF NOT EXISTS users 
-                        (user_id TEXT PRIMARY KEY, user_name TEXT NOT NULL, email TEXT NOT NULL, profile_pic TEXT, site_name Text);""") 
+insert_statements = {
+    "log": "INSERT INTO log(room_id, user_key, title, log, timestamp) VALUES(?, ?, ?, ?, ?)",
+    "room_event": "INSERT INTO log(room_id, user_key, title, log, timestamp, seq, event, payload) VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+    "chat": "INSERT INTO chat(room_id, user_key, chr_name, chat, timestamp) VALUES(?, ?, ?, ?, ?)",
+    "active_room": "INSERT INTO active_room(room_id, user_key, chr_name, init_val, is_turn, char_token) VALUES(?, ?, ?, ?, ?, ?)",
+    "room_object": "INSERT INTO room_object(user_key, room_name, active_room_id, map_status, map_url, dm_notes) VALUES(?,?,?,?,?,?)",
+    "chars": """INSERT INTO characters(user_key, chr_name, class, subclass, race, subrace, speed, level, strength, dexterity, constitution, intelligence, wisdom, charisma, hitpoints, char_token) 
+                VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+    "users": "INSERT INTO users(user_id, user_name, email, profile_pic, site_name) VALUES (?, ?, ?, ?, ?)",
+}
+
+
+# Write-behind queue for the append-only tables
+# Inserts into log (including room events) and chat are queued and written in batches with executemany, one transaction per flush.
+# A flush happens every flush_interval seconds, as soon as flush_batch_size rows are waiting, before any
+# read/update/delete touching one of these tables (so handlers always see their own writes) and at exit.
+# A batch that fails is put back and retried; once it has failed flush_attempts times in a row its rows are written
+# one at a time and the ones that still fail are logged and set aside (the last set_aside_size are kept in
+# write_behind.set_aside), so one bad row can't block the queue. A flush made for a read doesn't wait for retries: the
+# rows of a failed batch are written one at a time right away, so the read never fails on a row someone else queued.
+# Rows are checked when queued, a value sqlite can't bind is refused with a TypeError there and never joins a batch
+write_behind_tables = ("log", "chat", "room_event")
+flush_interval = 0.05 # in seconds
+flush_batch_size = 100
+flush_attempts = 3
+set_aside_size = 1000
+bindable_types = (type(None), int, float, str, bytes)
+
+
+class WriteBehindQueue:
+    def __init__(self, interval=flush_interval, batch_size=flush_batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = collections.deque()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.failures = 0 # failed flushes in a row
+        self.set_aside = collections.deque(maxlen=set_aside_size)
+        self.set_aside_total = 0
+
+    def put(self, table_name, values):
+        values = tuple(values)
+        for value in values:
+            if not isinstance(value, bindable_types):
+                raise TypeError(f"Can't queue a {type(value).__name__} value for the {table_name} table")
+        self.pending.append((table_name, values))
+        if self.thread is None:
+            self.start()
+        if len(self.pending) >= self.batch_size:
+            self.wakeup.set()
+
+    def depth(self):
+        return len(self.pending)
+
+    def flush(self, retry=True):
+        with self.flush_lock:
+            batch = []
+            while self.pending:
+                batch.append(self.pending.popleft())
+            if not batch:
+                return 0
+
+            rows_by_table = {}
+            for table_name, values in batch:
+                rows_by_table.setdefault(table_name, []).append(values)
+            try:
+                with create_connection(battle_sesh_db) as conn:
+                    for table_name, rows in rows_by_table.items():
+                        conn.executemany(insert_statements[table_name], rows)
+            except Exception:
+                self.failures += 1
+                if retry and self.failures < flush_attempts:
+                    # Put the rows back in their original order so the next flush retries them
+                    self.pending.extendleft(reversed(batch))
+                    raise
+                self.failures = 0
+                return self.write_rows(batch)
+            self.failures = 0
+            return len(batch)
+
+    def write_rows(self, batch):
+        # One transaction per row, for a batch that keeps failing. Returns the rows written
+        written = 0
+        for table_name, values in batch:
+            try:
+                with create_connection(battle_sesh_db) as conn:
+                    conn.execute(insert_statements[table_name], values)
+                written += 1
+            except Exception as e:
+                self.set_aside.append((table_name, values))
+                self.set_aside_total += 1
+                logger.error("Write-behind row set aside", {"table": table_name, "row": values, "error": e})
+        return written
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                # Anything escaping here would end the thread, and with it every later background flush
+                logger.exception("Write-behind flush failed, its rows will be retried", {"rows": self.depth()})
+
+    def start(self):
+        with self.flush_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="write-behind", daemon=True)
+                self.thread.start()
+
+
+write_behind = WriteBehindQueue()
+atexit.register(write_behind.flush)
+
+
+def flush_pending_writes(table_name):
+    if table_name in write_behind_tables and write_behind.depth():
+        write_behind.flush(retry=False)
 
-        cur.execute(f""" CREATE TABLE IF NOT EXISTS characters
-                            (user_key TEXT, chr_name TEXT, class TEXT, subclass TEXT, race TEXT, subrace TEXT, speed INT, level INT, strength INT, dexterity INT, constitution INT, intelligence INT, wisdom INT, charisma INT, hitpoints INT, char_token TEXT, PRIMARY KEY(user_key, chr_name));""")
-        
 
 def add_to_db(table_name, values):
+    if table_name in write_behind_tables:
+        write_behind.put(table_name, values)
+        return
+    if table_name not in insert_statements:
+        return
     with create_connection(battle_sesh_db) as conn:
-        cur = conn.cursor()
-        if table_name == "log":
-            cur.execute("INSERT INTO log(room_id, user_key, title, log, timestamp) VALUES(?, ?, ?, ?, ?)", values)
-        elif table_name == "chat":
-            cur.execute("INSERT INTO chat(room_id, user_key, chr_name, chat, timestamp) VALUES(?, ?, ?, ?, ?)", values)
-        elif table_name == "active_room":
-            cur.execute("INSERT INTO active_room(room_id, user_key, chr_name, init_val, is_turn, char_token) VALUES(?, ?, ?, ?, ?, ?)", values)
-        elif table_name == "room_object":
-            cur.execute("INSERT INTO room_object(user_key, room_name, active_room_id, map_status, map_url, dm_notes) VALUES(?,?,?,?,?,?)", values)
-        elif table_name == "chars":
-            cur.execute("""INSERT INTO characters(user_key, chr_name, class, subclass, race, subrace, speed, level, strength, dexterity, constitution, intelligence, wisdom, charisma, hitpoints, char_token) 
-                           VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", values)
-        elif table_name == "users":
-            cur.execute("INSERT INTO users(user_id, user_name, email, profile_pic, site_name) VALUES (?, ?, ?, ?, ?)", values)
-        conn.commit()
+        conn.execute(insert_statements[table_name], values)
+
 
+# Parameterized query helpers. Values are always bound rather than pasted into the SQL text, so the
+# statement for a given table/column/filter combination is textually identical on every call and the
+# per-connection prepared statement cache can reuse it
+def where_clause(where):
+    if not where:
+        return "", ()
+    return "WHERE " + " AND ".join(f"{column} = ?" for column in where), tuple(where.values())
 
+
+def select(table_name, columns="*", where=None, order_by="", limit=None, read_api_db=False):
+    flush_pending_writes(table_name)
+    clause, params = where_clause(where)
+    sql = f"SELECT {columns} FROM {table_name} {clause}"
+    if order_by:
+        sql += f" ORDER BY {order_by}"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params += (limit,)
+    with create_connection(api_db if read_api_db else battle_sesh_db) as conn:
+        return conn.execute(sql, params).fetchall()
+
+
+def select_one(table_name, columns="*", where=None, order_by="", read_api_db=False):
+    rows = select(table_name, columns, where, order_by, 1, read_api_db)
+    if rows:
+        return rows[0]
+    return None
+
+
+def update(table_name, values, where):
+    flush_pending_writes(table_name)
+    clause, params = where_clause(where)
+    assignments = ", ".join(f"{column} = ?" for column in values)
+    with create_connection(battle_sesh_db) as conn:
+        return conn.execute(f"UPDATE {table_name} SET {assignments} {clause}", tuple(values.values()) + params).rowcount
+
+
+def delete(table_name, where):
+    flush_pending_writes(table_name)
+    clause, params = where_clause(where)
+    with create_connection(battle_sesh_db) as conn:
+        return conn.execute(f"DELETE FROM {table_name} {clause}", params).rowcount
+
+
+def upsert_statement(table_name, columns, conflict_columns):
+    # Inserts a row, or updates the non-key columns of the row that already has the same conflict_columns
+    placeholders = ", ".join("?" for _ in columns)
+    updates = ", ".join(f"{column} = excluded.{column}" for column in columns if column not in conflict_columns)
+    sql = f"INSERT INTO {table_name}({', '.join(columns)}) VALUES({placeholders}) ON CONFLICT({', '.join(conflict_columns)}) "
+    sql += f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+    return sql
+
+
+def upsert(table_name, values, conflict_columns):
+    with create_connection(battle_sesh_db) as conn:
+        conn.execute(upsert_statement(table_name, tuple(values), conflict_columns), tuple(values.values()))
+
+
+# Read-through cache of users and characters rows, keyed by user id. Entries are dropped by the write paths
+# through invalidate_user/invalidate_characters, and expire after cache_ttl seconds so that changes made by
+# another worker are picked up too
+cache_max_entries = 1024
+cache_ttl = 60 # in seconds
+
+
+class TTLCache:
+    def __init__(self, max_entries=cache_max_entries, ttl=cache_ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict() # key -> (expires_at, value), least recently used first
+        self.generation = 0 # bumped by every invalidation, so a load that raced one is not stored
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, load):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self.generation
+
+        value = load()
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = (now + self.ttl, value)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.generation += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+user_cache = TTLCache()
+character_cache = TTLCache()
+
+
+def get_user(user_id):
+    # The users row, or None if there is no such user
+    return user_cache.get(user_id, lambda: select_one("users", "*", {"user_id": user_id}))
+
+
+def get_characters(user_id):
+    # All of the user's characters rows, in the order of the characters table
+    return character_cache.get(user_id, lambda: tuple(select("characters", "*", {"user_key": user_id})))
+
+
+def get_character(user_id, chr_name):
+    for character in get_characters(user_id):
+        if character[1] == chr_name:
+            return character
+    return None
+
+
+def invalidate_user(user_id):
+    user_cache.invalidate(user_id)
+
+
+def invalidate_characters(user_id):
+    character_cache.invalidate(user_id)
+
+
+def cache_stats():
+    return {"users": user_cache.stats(), "characters": character_cache.stats()}
+
+
+# Map token helpers
+# Tokens are sent to the browser in the same shape the old map_status blob used:
+# { "<user_key>_<chr_name>": { site_name, character_name, room_id, character_image, height, width, top, left, is_turn } }
+map_token_columns = "room_id, user_key, chr_name, site_name, character_image, height, width, top_pos, left_pos, is_turn"
+
+
+def map_token_json(row):
+    room_id, user_key, chr_name, site_name, character_image, height, width, top, left, is_turn = row
+    return {"site_name": site_name, "character_name": chr_name, "room_id": room_id, "character_image": character_image, "height": height, "width": width, "top": top, "left": left, "is_turn": is_turn}
+
+
+def map_tokens_json(rows):
+    return {f"{row[1]}_{row[2]}": map_token_json(row) for row in rows}
+
+
+def read_map_tokens(room_id):
+    return select("map_token", map_token_columns, {"room_id": room_id})
+
+
+def add_map_token(room_id, user_key, chr_name, site_name, character_image, height, width, top, left):
+    upsert("map_token", {"room_id": room_id, "user_key": user_key, "chr_name": chr_name, "site_name": site_name, "character_image": character_image, "height": height, "width": width, "top_pos": top, "left_pos": left, "is_turn": 0}, ("room_id", "user_key", "chr_name"))
+
+
+# Room state helpers, used to load and checkpoint the in-memory state of open rooms (see room_state.py)
+initiative_columns = ("room_id", "user_key", "chr_name", "init_val", "is_turn", "char_token")
+
+
+def read_initiatives(room_id):
+    with create_connection(battle_sesh_db) as conn:
+        return conn.execute("""SELECT active_room.user_key, active_room.chr_name, init_val, is_turn, char_token, users.site_name
+                               FROM active_room LEFT JOIN users ON users.user_id = active_room.user_key
+                               WHERE room_id = ?""", (room_id,)).fetchall()
+
+
+def save_room_state(initiative_rows, token_rows, room_id=None, state_version=None):
+    # Writes a room's changed initiative and token rows in one transaction. If state_version is given, the rows
+    # are only written if the room is still at that version; returns the new version, or None if it was not
+    with create_connection(battle_sesh_db) as conn:
+        if state_version is not None:
+            cur = conn.execute("UPDATE room_object SET state_version = state_version + 1 WHERE active_room_id = ? AND state_version = ?;", (room_id, state_version))
+            if cur.rowcount == 0:
+                return None
+            state_version += 1
+        if initiative_rows:
+            conn.executemany(upsert_statement("active_room", initiative_columns, ("room_id", "user_key", "chr_name")), initiative_rows)
+        if token_rows:
+            conn.executemany(upsert_statement("map_token", tuple(map_token_columns.split(", ")), ("room_id", "user_key", "chr_name")), token_rows)
+    return state_version
+
+
+# Chat and log history pages. A page is the newest rows before the cursor row_id, returned oldest first
+history_page_size = 50
+history_max_page_size = 200
+history_columns = {"chat": "row_id, chr_name, chat, timestamp", "log": "row_id, title, log, timestamp"}
+
+
+def read_history(table_name, room_id, before_id=None, limit=history_page_size):
+    # Returns (rows, next_before_id); next_before_id is None once the start of the history is reached
+    flush_pending_writes(table_name)
+    limit = max(1, min(int(limit), history_max_page_size))
+    sql = f"SELECT {history_columns[table_name]} FROM {table_name} WHERE room_id = ?"
+    params = [room_id]
+    if before_id is not None:
+        sql += " AND row_id < ?"
+        params.append(int(before_id))
+    sql += " ORDER BY row_id DESC LIMIT ?;"
+    params.append(limit)
+    with create_connection(battle_sesh_db) as conn:
+        rows = conn.execute(sql, params).fetchall()
+    rows.reverse()
+    next_before_id = rows[0][0] if len(rows) == limit else None
+    return rows, next_before_id
+
+
+def history_json(table_name, rows):
+    if table_name == "chat":
+        return [{"id": row_id, "character_name": chr_name, "chat": chat, "timestamp": timestamp} for row_id, chr_name, chat, timestamp in rows]
+    return [{"id": row_id, "title": title, "desc": log, "timestamp": timestamp} for row_id, title, log, timestamp in rows]
+
+
+def iter_room_rows(table_name, room_id, columns="*", batch_size=500):
+    # Yields a room's chat or log rows oldest first, batch_size rows per query. Each batch picks up after the last
+    # row_id seen, so no connection is held between batches and only one batch is ever in memory
+    flush_pending_writes(table_name)
+    after_id = 0
+    while True:
+        with create_connection(battle_sesh_db) as conn:
+            rows = conn.execute(f"SELECT row_id, {columns} FROM {table_name} WHERE room_id = ? AND row_id > ? ORDER BY row_id LIMIT ?;",
+                                (room_id, after_id, batch_size)).fetchall()
+        for row in rows:
+            yield row[1:]
+        if len(rows) < batch_size:
+            return
+        after_id = rows[-1][0]
+
+
+# Room event stream. Sequence numbers are per room and only go up while the room is open
+def last_event_seq(room_id):
+    row = select_one("log", "MAX(seq)", {"room_id": room_id})
+    return row[0] or 0
+
+
+def next_event_seq(room_id):
+    # Allocates the next sequence number in the database, for when several workers serve the same room
+    flush_pending_writes("log")
+    with create_connection(battle_sesh_db) as conn:
+        conn.execute("""UPDATE room_object SET event_seq = MAX(event_seq, (SELECT COALESCE(MAX(seq), 0) FROM log WHERE room_id = ?)) + 1
+                        WHERE active_room_id = ?;""", (room_id, room_id))
+        row = conn.execute("SELECT event_seq FROM room_object WHERE active_room_id = ?;", (room_id,)).fetchone()
+    return row[0] if row else None
+
+
+def read_room_events(room_id, after_seq, limit):
+    # (seq, event, payload) of the room's events after after_seq, oldest first
+    flush_pending_writes("log")
+    with create_connection(battle_sesh_db) as conn:
+        return conn.execute("SELECT seq, event, payload FROM log WHERE room_id = ? AND seq > ? ORDER BY seq LIMIT ?;", (room_id, after_seq, limit)).fetchall()
+
+
+# The helpers below take a raw SQL clause. Prefer the parameterized helpers above for anything built from user input
 def read_db(table_name, rows="*", extra_clause = "", read_api_db=False):
     if read_api_db:
         db_to_read_from = api_db
     else:
         db_to_read_from = battle_sesh_db
+        flush_pending_writes(table_name)
     with create_connection(db_to_read_from) as conn:
         cur = conn.cursor()
         ret_lst = []
@@ -114,88 +888,158 @@ def read_db(table_name, rows="*", extra_clause = "", read_api_db=False):
 
 
 def delete_from_db(table_name, extra_clause = ""):
+    flush_pending_writes(table_name)
     with create_connection(battle_sesh_db) as conn:
         cur = conn.cursor()
         cur.execute(f"DELETE FROM {table_name} {extra_clause};")
-        conn.commit()
 
 def reset_db(table_name):
+    # Empties a table by dropping it and running its current CREATE TABLE and CREATE INDEX statements again,
+    # so it comes back with every column and index the migrations gave it
+    flush_pending_writes(table_name)
     with create_connection(battle_sesh_db) as conn:
         cur = conn.cursor()
+        definitions = [sql for sql, in cur.execute("SELECT sql FROM sqlite_master WHERE tbl_name = ? AND sql IS NOT NULL ORDER BY type = 'index';", (table_name,))]
         cur.execute(f"""DROP TABLE IF EXISTS {table_name};""")
-        conn.commit()
-
-        create_dbs()
+        for sql in definitions:
+            cur.execute(sql)
 
 def update_db(table_name, columns_values, extra_clause):
+    flush_pending_writes(table_name)
     with create_connection(battle_sesh_db) as conn:
         cur = conn.cursor()
         cur.execute(f"""UPDATE {table_name} SET {columns_values} {extra_clause};""")
-        conn.commit()
+
+
+# Tables of the race/class catalog built from data_files/<name>.csv
+api_tables = {
+    "race": ("CREATE TABLE race (race TEXT NOT NULL, subrace TEXT NOT NULL, speed INT, PRIMARY KEY (race, subrace));",
+             "INSERT INTO race(race, subrace, speed) VALUES(?,?,?);"),
+    "class": ("CREATE TABLE class (class TEXT NOT NULL, subclass TEXT NOT NULL, PRIMARY KEY (class, subclass));",
+              "INSERT INTO class(class, subclass) VALUES(?,?);"),
+}
+
+
+def catalog_hash(files):
+    # Hash of the CSV inputs and the table definitions, so a change to either triggers a rebuild
+    digest = hashlib.sha256()
+    for file in files:
+        digest.update("\n".join(api_tables[file]).encode())
+        with open(f"data_files/{file}.csv", 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def read_catalog_hash(db_file):
+    try:
+        conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+        try:
+            row = conn.execute("SELECT value FROM catalog_meta WHERE key = 'csv_hash';").fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
 
 
 def build_api_db(files):
+    # Builds api.db from the CSV files unless the existing file was built from the same inputs.
+    # The new catalog is written to a temporary file and moved into place, so workers starting at the
+    # same time never see a half built catalog. Returns True if the catalog was rebuilt
 
     def decomment(csvfile):
         for row in csvfile:
             raw = row.split('#')[0].strip()
             if raw: yield raw
 
-    with sqlite3.connect(api_db) as conn:
-        cur = conn.cursor()
+    csv_hash = catalog_hash(files)
+    if read_catalog_hash(api_db) == csv_hash:
+        return False
 
-        for file in files:
-            cur.execute(f"""DROP TABLE IF EXISTS {file};""")
-            if file == "race":
-                cur.execute(f"""CREATE TABLE IF NOT EXISTS race 
-                                (race TEXT NOT NULL, subrace TEXT NOT NULL, speed INT, PRIMARY KEY (race, subrace)); """)
-            elif file == "class":
-                cur.execute(f"""CREATE TABLE IF NOT EXISTS class
-                                (class TEXT NOT NULL, subclass TEXT NOT NULL, PRIMARY KEY (class, subclass));""")
-            with open(f"data_files/{file}.csv", 'r') as f:
-                reader = csv.reader(decomment(f))
-                if file == "race":
-                    for row in reader:
-                        cur.execute(f"""INSERT INTO race(race, subrace, speed) VALUES(?,?,?);""", row)
-                elif file == "class":
-                    for row in reader:
-                        cur.execute(f"""INSERT INTO class(class, subclass) VALUES(?,?);""", row)
-        conn.commit()
+    build_file = f"{api_db}.{os.getpid()}.tmp"
+    if os.path.exists(build_file):
+        os.remove(build_file)
+    conn = sqlite3.connect(build_file)
+    try:
+        with conn:
+            for file in files:
+                create_statement, insert_statement = api_tables[file]
+                conn.execute(create_statement)
+                with open(f"data_files/{file}.csv", 'r') as f:
+                    conn.executemany(insert_statement, csv.reader(decomment(f)))
+            conn.execute("CREATE TABLE catalog_meta (key TEXT PRIMARY KEY, value TEXT);")
+            conn.execute("INSERT INTO catalog_meta(key, value) VALUES('csv_hash', ?);", (csv_hash,))
+    finally:
+        conn.close()
+    os.replace(build_file, api_db)
 
+    # Pooled connections and cached responses still point at the old catalog
+    get_pool(api_db).close_all()
+    catalog_json.clear()
+    return True
+
+
+def build_catalog():
+    build_api_db(list(api_tables))
 
-def get_api_info(table, row):
-    rows = read_db(table, read_api_db=True)
-    main_column = read_db(table, row, read_api_db=True)
 
+def get_api_info(table, row):
     main_column_set = set()
-    for row in main_column:
-        main_column_set.add(row[0])
-    
     column_subsets = {}
-    for column in main_column_set:
-        column_subsets[column] = []
-    for row in rows:
-        column_subsets[row[0]].append(row[1])
+    for main, subset in read_db(table, f"{row}, sub{row}", read_api_db=True):
+        main_column_set.add(main)
+        column_subsets.setdefault(main, []).append(subset)
 
     return main_column_set, column_subsets
 
 
+# Serialized catalog responses, (etag, body) per table. Cleared when build_api_db rebuilds the catalog
+global catalog_json
+catalog_json = {}
+
+
+def get_api_json(table, row, names):
+    # Returns the etag and JSON body {names[0]: [...], names[1]: {...}} for a catalog table, built on first use
+    cached = catalog_json.get(table)
+    if cached is None:
+        main_column_set, column_subsets = get_api_info(table, row)
+        body = json.dumps({names[0]: sorted(main_column_set), names[1]: {main: column_subsets[main] for main in sorted(column_subsets)}}, separators=(",", ":")).encode()
+        cached = catalog_json.setdefault(table, (hashlib.sha256(body).hexdigest()[:32], body))
+    return cached
+
+
 def build_error_db():
     with create_connection(error_db) as conn:
         cur = conn.cursor()              
         cur.execute(f"""CREATE TABLE IF NOT EXISTS error 
                         (row_id INT PRIMARY KEY, error_desc TEXT); """)
+        # One row per distinct error, see errors.py
+        cur.execute("""CREATE TABLE IF NOT EXISTS error_group
+                        (fingerprint TEXT PRIMARY KEY, kind TEXT, handler TEXT, message TEXT, count INT, first_seen INT, last_seen INT, sample TEXT); """)
+        cur.execute("CREATE INDEX IF NOT EXISTS error_group_last_seen ON error_group(last_seen);")
 
-def add_to_error_db(values):
+error_group_columns = ["fingerprint", "kind", "handler", "message", "count", "first_seen", "last_seen", "sample"]
+
+def add_error_groups(rows):
+    # rows are in error_group_columns order. A known fingerprint only gets its count and last_seen bumped,
+    # so it keeps the sample it was first seen with
     with create_connection(error_db) as conn:
-        cur = conn.cursor()
-        cur.execute("INSERT INTO error(error_desc) VALUES(?)", (values,))
-        conn.commit()
+        conn.executemany("""INSERT INTO error_group VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+                            ON CONFLICT(fingerprint) DO UPDATE SET count = count + excluded.count, last_seen = MAX(last_seen, excluded.last_seen);""", rows)
     
-def read_error_db():
+def read_error_db(limit=50):
+    # The most recently seen errors first
     with create_connection(error_db) as conn:
         cur = conn.cursor()
-        ret_lst = []
-        for row in cur.execute(f"SELECT * FROM error;"):
-            ret_lst.append(row)
-        return ret_lst
\ No newline at end of file
+        return cur.execute(f"SELECT {', '.join(error_group_columns)} FROM error_group ORDER BY last_seen DESC LIMIT ?;", (limit,)).fetchall()
+
+
+# Offline setup, run before the workers start (the Procfile's release step): switches an existing database to
+# incremental auto-vacuum and applies any migrations it is missing, so neither happens on a worker's first request
+if __name__ == "__main__":
+    conn = sqlite3.connect(battle_sesh_db, timeout=busy_timeout / 1000)
+    try:
+        use_incremental_vacuum(conn, rewrite_existing=True)
+    finally:
+        conn.close()
+    prepare_db(battle_sesh_db)
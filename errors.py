@@ -0,0 +1,121 @@
+import os
+import re
+import time
+import atexit
+import hashlib
+import logging
+import threading
+import traceback
+import collections
+
+import db
+
+logger = logging.getLogger("db.errors")
+
+# Error aggregation
+# Server errors, socket handler errors and the reports browsers send to /process_error are grouped by a fingerprint of
+# their kind, the route or event they happened in, their message with the numbers and quoted values taken out and,
+# for exceptions, the files and functions they were raised through. error.db keeps one row per fingerprint with a
+# count, when it was first and last seen and the first sample of it.
+#
+# Reporting only updates the in-memory group under a lock; a background thread writes the groups to error.db in one
+# transaction every flush_interval seconds. In an error storm every repeat is a counter bump, at most max_groups
+# distinct fingerprints wait for a flush (reports of new ones beyond that are counted as dropped), and the last
+# recent_size reports are kept in a ring buffer for /errors
+flush_interval = 1.0 # in seconds
+max_groups = 500
+recent_size = 100
+stack_depth = 5 # innermost frames that go into an exception's fingerprint
+sample_size = 4000 # characters
+
+
+def normalize(message):
+    message = re.sub(r"0x[0-9a-fA-F]+", "0x?", message)
+    message = re.sub(r"'[^']*'|\"[^\"]*\"", "'?'", message)
+    message = re.sub(r"\d+", "?", message)
+    return " ".join(message.split())[:200]
+
+
+def stack_signature(tb):
+    # Line numbers are left out, so an unrelated edit elsewhere in a file doesn't start a new group
+    frames = traceback.extract_tb(tb)[-stack_depth:]
+    return ";".join(f"{os.path.basename(frame.filename)}:{frame.name}" for frame in frames)
+
+
+def fingerprint(kind, handler, message, stack=""):
+    return hashlib.sha1(f"{kind}|{handler}|{normalize(message)}|{stack}".encode()).hexdigest()[:16]
+
+
+class ErrorStore:
+    def __init__(self, interval=flush_interval):
+        self.interval = interval
+        self.pending = {} # fingerprint -> [kind, handler, message, count, first_seen, last_seen, sample]
+        self.recent = collections.deque(maxlen=recent_size)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+
+    def report(self, kind, handler, message, stack="", sample=None):
+        now = db.current_timestamp()
+        key = fingerprint(kind, handler, message, stack)
+        with self.lock:
+            self.recent.append({"fingerprint": key, "kind": kind, "handler": handler, "message": message[:sample_size], "time": now})
+            self.merge(key, [kind, handler, normalize(message), 1, now, now, (sample or message)[:sample_size]])
+        if self.thread is None:
+            self.start()
+        return key
+
+    def report_exception(self, e, handler):
+        sample = "".join(traceback.format_exception(type(e), e, e.__traceback__))
+        return self.report(type(e).__name__, handler, str(e), stack_signature(e.__traceback__), sample)
+
+    def merge(self, key, group):
+        # Called with self.lock held
+        existing = self.pending.get(key)
+        if existing is not None:
+            existing[3] += group[3]
+            existing[4] = min(existing[4], group[4])
+            existing[5] = max(existing[5], group[5])
+        elif len(self.pending) < max_groups:
+            self.pending[key] = group
+        else:
+            self.dropped += group[3]
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                logger.warning("Error reports dropped, too many distinct errors waiting to be written", {"reports": dropped})
+            if not pending:
+                return 0
+            try:
+                db.add_error_groups([(key, *group) for key, group in pending.items()])
+            except:
+                # Counted again on the next flush
+                with self.lock:
+                    for key, group in pending.items():
+                        self.merge(key, group)
+                raise
+            return len(pending)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                # Anything escaping here would end the thread, and with it every later flush
+                logger.exception("Error store flush failed, its groups will be retried", {"groups": len(self.pending)})
+
+    def start(self):
+        with self.flush_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="error-store", daemon=True)
+                self.thread.start()
+
+
+error_store = ErrorStore()
+atexit.register(error_store.flush)
@@ -0,0 +1,132 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import itertools
+import logging.handlers
+
+from flask import has_request_context
+from flask_login import current_user
+
+# Logging pipeline
+# Code logs through one logger per subsystem: http (page views and forms), combat (the /combat socket events) and db
+# (the database, retention and archives). Records go onto an in-memory queue and a listener thread formats and writes
+# them, so a handler never waits on the log's stream and nothing is formatted for records the level drops.
+#
+# Log with the message's fields in a dict rather than an f-string, e.g. combat_log.debug("Chat sent", {"room_id": room_id}).
+# The fields are only turned into text on the listener thread, as key=value pairs after the message (or as one JSON
+# object per line with LOG_FORMAT=json). The logged in user is added to every record made during a request.
+#
+# LOG_LEVEL sets the level of every subsystem, LOG_LEVEL_HTTP, LOG_LEVEL_COMBAT and LOG_LEVEL_DB override it for one.
+# Token moves happen on every drag, so only one in LOG_SAMPLE_TOKENS of them is logged
+subsystems = ("http", "combat", "db")
+http_log = logging.getLogger("http")
+combat_log = logging.getLogger("combat")
+token_log = logging.getLogger("combat.tokens")
+sample_every = {"combat.tokens": int(os.environ.get("LOG_SAMPLE_TOKENS", 20))}
+log_queue = queue.Queue(-1)
+listener = None
+
+
+def format_value(value):
+    text = str(value)
+    if text == "" or any(c in text for c in ' ="\n'):
+        return json.dumps(text)
+    return text
+
+
+class KeyValueFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = record_fields(record)
+        if fields:
+            first, _, rest = line.partition("\n") # keeps a traceback below the fields
+            line = first + "".join(f" {key}={format_value(value)}" for key, value in fields.items()) + (_ + rest if rest else "")
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name, "message": record.getMessage()}
+        entry.update(record_fields(record))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def record_fields(record):
+    fields = dict(getattr(record, "context", {}))
+    if isinstance(record.args, dict):
+        fields.update(record.args)
+    if hasattr(record, "sampled"):
+        fields["sampled"] = record.sampled
+    return fields
+
+
+class RequestContext(logging.Filter):
+    # Runs on the thread that logged, after the level check, so only records that will be written pay for it
+    def filter(self, record):
+        if has_request_context():
+            user = current_user._get_current_object()
+            if user is not None and hasattr(user, "get_site_name"):
+                record.context = {"user": user.get_site_name()}
+        return True
+
+
+class Sample(logging.Filter):
+    # Lets one in every `every` records through
+    def __init__(self, every):
+        super().__init__()
+        self.every = max(1, every)
+        self.seen = itertools.count(1)
+
+    def filter(self, record):
+        if next(self.seen) % self.every:
+            return False
+        if self.every > 1:
+            record.sampled = f"1/{self.every}"
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    # The stock QueueHandler formats the record before queueing it. The queue never leaves this process, so the
+    # record can go as it is and be formatted by the listener
+    def prepare(self, record):
+        return record
+
+
+def level_for(subsystem, default):
+    return os.environ.get(f"LOG_LEVEL_{subsystem.upper()}", os.environ.get("LOG_LEVEL", default)).upper()
+
+
+def configure_logging(app):
+    # Sets up the pipeline once per process; later calls only set the levels
+    global listener
+    if listener is None:
+        for name, every in sample_every.items():
+            logging.getLogger(name).addFilter(Sample(every))
+
+        # Under gunicorn the log goes wherever its error log does
+        gunicorn_handlers = logging.getLogger("gunicorn.error").handlers
+        stream = next((handler.stream for handler in gunicorn_handlers if isinstance(handler, logging.StreamHandler)), sys.stderr)
+        output = logging.StreamHandler(stream)
+        output.setFormatter(JsonFormatter() if os.environ.get("LOG_FORMAT") == "json" else KeyValueFormatter())
+
+        # On the root logger, so warnings from libraries (which stay at the root's WARNING level) end up in the same place
+        queue_handler = LazyQueueHandler(log_queue)
+        queue_handler.addFilter(RequestContext())
+        logging.getLogger().addHandler(queue_handler)
+        listener = logging.handlers.QueueListener(log_queue, output)
+        listener.start()
+        atexit.register(listener.stop) # writes out what is still queued
+
+    default_level = "DEBUG" if app.debug else "INFO"
+    for subsystem in subsystems:
+        logging.getLogger(subsystem).setLevel(level_for(subsystem, default_level))
+    # Only touched once the root has its handler, otherwise Flask gives app.logger a handler of its own
+    app.logger.setLevel(level_for("http", default_level))
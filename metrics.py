@@ -0,0 +1,191 @@
+import time
+import bisect
+import functools
+import threading
+
+from flask import g, request
+
+import db
+
+# In-process metrics, rendered in the Prometheus text format at /metrics
+# Every Flask request and /combat socket event is timed into a latency histogram with call and error counts, and
+# every Socket.IO frame sent is counted with its size. Recording only takes a metric's lock around a few integer
+# updates, never around I/O. The numbers are per worker process, so with several workers scrape each one
+# (or sum them) rather than reading one behind a load balancer
+prefix = "battlemap_"
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5) # in seconds
+query_buckets = (0, 1, 2, 5, 10, 20, 50, 100) # SQL statements
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name, description, labels=()):
+        self.name = prefix + name
+        self.description = description
+        self.labels = labels
+        self.values = {} # label values -> count
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = list(self.values.items())
+        lines += [f"{self.name}{format_labels(self.labels, label_values)} {value}" for label_values, value in sorted(values)]
+        return lines
+
+
+class Gauge:
+    # A value that goes up and down, or is read from read_value when the metrics are rendered
+    def __init__(self, name, description, read_value=None):
+        self.name = prefix + name
+        self.description = description
+        self.read_value = read_value
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def render(self):
+        value = self.read_value() if self.read_value else self.value
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=latency_buckets):
+        self.name = prefix + name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {} # label values -> [count per bucket (the last one is +Inf), sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bucket] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = [(label_values, list(counts), total, count) for label_values, (counts, total, count) in self.series.items()]
+        for label_values, counts, total, count in sorted(series):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), label_values + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {count}")
+        return lines
+
+
+http_latency = Histogram("http_request_duration_seconds", "Time spent handling HTTP requests", ("route", "method"))
+http_requests = Counter("http_requests_total", "HTTP requests handled", ("route", "method", "status"))
+http_errors = Counter("http_request_errors_total", "HTTP requests answered with a 5xx status", ("route", "method"))
+http_queries = Histogram("http_request_queries", "SQL statements run per HTTP request", ("route", "method"), query_buckets)
+event_latency = Histogram("socket_event_duration_seconds", "Time spent in /combat socket event handlers", ("event",))
+event_errors = Counter("socket_event_errors_total", "/combat socket event handlers that raised", ("event",))
+event_queries = Histogram("socket_event_queries", "SQL statements run per /combat socket event", ("event",), query_buckets)
+frames_sent = Counter("socket_frames_sent_total", "Socket.IO frames sent to clients")
+bytes_sent = Counter("socket_bytes_sent_total", "Size of the Socket.IO frames sent to clients")
+connected_sockets = Gauge("connected_sockets", "Sockets connected to the /combat namespace")
+registry = [http_latency, http_requests, http_errors, http_queries, event_latency, event_errors, event_queries, frames_sent, bytes_sent, connected_sockets]
+
+
+def add_gauge(name, description, read_value):
+    registry.append(Gauge(name, description, read_value))
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+# Flask hooks, registered on the app by create_app. The statements a request runs are counted by a db trace
+def route_name():
+    # The URL rule rather than the path, so /rooms/<room_id> is one series and not one per room
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+
+def start_request():
+    g.metrics_started = time.perf_counter()
+    g.query_trace = db.begin_trace(f"{request.method} {route_name()}")
+
+
+def finish_request(response):
+    started = g.pop("metrics_started", None)
+    if started is not None:
+        route = route_name()
+        http_latency.observe(time.perf_counter() - started, route, request.method)
+        http_requests.inc(route, request.method, response.status_code)
+        http_queries.observe(g.query_trace.count, route, request.method)
+        if response.status_code >= 500:
+            http_errors.inc(route, request.method)
+    return response
+
+
+def end_request(exc):
+    # Teardown runs even when after_request did not, so the trace never outlives its request
+    trace = g.pop("query_trace", None)
+    if trace is not None:
+        db.end_trace(trace)
+
+
+def timed_event(event):
+    # Decorator for socket event handlers
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            trace = db.begin_trace(event)
+            try:
+                return handler(*args, **kwargs)
+            except Exception:
+                event_errors.inc(event)
+                raise
+            finally:
+                db.end_trace(trace)
+                event_latency.observe(time.perf_counter() - started, event)
+                event_queries.observe(trace.count, event)
+        return wrapper
+    return decorator
+
+
+def count_frames(eio_server):
+    # Wraps the Engine.IO server's send, which every Socket.IO frame to a client on this worker goes through
+    if getattr(eio_server, "frames_counted", False):
+        return
+    send = eio_server.send
+
+    def counted_send(sid, data):
+        frames_sent.inc()
+        bytes_sent.inc(amount=len(data))
+        return send(sid, data)
+
+    eio_server.send = counted_send
+    eio_server.frames_counted = True
@@ -0,0 +1,161 @@
+import time
+import logging
+try:
+    import fcntl
+except ImportError:
+    # Windows: no file locks, every worker runs the job
+    fcntl = None
+
+import db
+import room_state
+
+logger = logging.getLogger("db.retention")
+
+# Retention of chat and log rows
+# Rooms that are never ended keep their chat and log rows forever. The retention job closes open rooms with no
+# log activity for max_age_hours, then deletes chat and log rows older than that which belong to no open room,
+# and finally hands the freed pages back with an incremental vacuum. Initiative and token rows of rooms that are no
+# longer open (left behind when a room's archive couldn't be written) go too, once the room has had no log row for
+# as long.
+#
+# Deletes are done batch_size rows per transaction with a short sleep in between, so the write lock is never held
+# for long. The job runs on the scheduler's thread; under eventlet that is a green thread, and the sleeps are what
+# let the hub get back to the live sockets
+max_age_hours = 24
+batch_size = 500
+batch_pause = 0.05 # in seconds
+vacuum_step_pages = 1000 # free pages released per incremental_vacuum step
+retention_tables = ("chat", "log")
+orphan_tables = ("active_room", "map_token")
+
+min_run_gap = 3600 # in seconds; a scheduled run this soon after the last one is skipped
+
+last_report = {}
+
+
+def open_rooms():
+    rows = db.select("room_object", "active_room_id")
+    return [room_id for room_id, in rows if room_id not in (None, "", "null")]
+
+
+def stale_rooms(cutoff):
+    # Open rooms whose newest log row is older than cutoff. Every connection and room event writes a log row, and
+    # the newest one is a single seek on the log_room index. Rooms without any log rows have nothing to reclaim
+    stale = []
+    room_ids = open_rooms()
+    db.flush_pending_writes("log")
+    with db.create_connection(db.battle_sesh_db) as conn:
+        for room_id in room_ids:
+            newest = conn.execute("SELECT MAX(timestamp) FROM log WHERE room_id = ?;", (room_id,)).fetchone()[0]
+            if newest is not None and newest < cutoff:
+                stale.append(room_id)
+    return stale
+
+
+def close_room(room_id):
+    # Same as ending the room from the battle map, except the chat and log rows are left to the batched purge
+    room_state.drop_room(room_id)
+    room_state.forget_open_room(room_id)
+    db.delete("active_room", {"room_id": room_id})
+    db.delete("map_token", {"room_id": room_id})
+    db.update("room_object", {"map_status": "{}", "active_room_id": "null", "event_seq": 0}, {"active_room_id": room_id})
+
+
+def purge_table(table_name, cutoff):
+    # Deletes the table's rows older than cutoff that belong to no open room, oldest first. Returns the rows deleted
+    db.flush_pending_writes(table_name)
+    deleted = 0
+    while True:
+        with db.create_connection(db.battle_sesh_db) as conn:
+            batch = conn.execute(f"""DELETE FROM {table_name} WHERE row_id IN
+                                        (SELECT row_id FROM {table_name} WHERE timestamp < ?
+                                         AND room_id NOT IN (SELECT active_room_id FROM room_object WHERE active_room_id IS NOT NULL)
+                                         ORDER BY timestamp LIMIT ?);""", (cutoff, batch_size)).rowcount
+        deleted += batch
+        if batch < batch_size:
+            return deleted
+        time.sleep(batch_pause)
+
+
+def purge_orphans(table_name, cutoff):
+    # Deletes the table's rows of rooms that are not open and have no log row since cutoff. Returns the rows deleted
+    db.flush_pending_writes("log")
+    deleted = 0
+    while True:
+        with db.create_connection(db.battle_sesh_db) as conn:
+            batch = conn.execute(f"""DELETE FROM {table_name} WHERE rowid IN
+                                        (SELECT rowid FROM {table_name}
+                                         WHERE room_id NOT IN (SELECT active_room_id FROM room_object WHERE active_room_id IS NOT NULL)
+                                         AND NOT EXISTS (SELECT 1 FROM log WHERE log.room_id = {table_name}.room_id AND log.timestamp >= ?)
+                                         LIMIT ?);""", (cutoff, batch_size)).rowcount
+        deleted += batch
+        if batch < batch_size:
+            return deleted
+        time.sleep(batch_pause)
+
+
+def reclaim_space():
+    # Releases the free pages left by the purge, vacuum_step_pages at a time. Returns the bytes handed back
+    with db.create_connection(db.battle_sesh_db) as conn:
+        page_size = conn.execute("PRAGMA page_size;").fetchone()[0]
+        free_pages = conn.execute("PRAGMA freelist_count;").fetchone()[0]
+    released = 0
+    while free_pages:
+        with db.create_connection(db.battle_sesh_db) as conn:
+            conn.execute(f"PRAGMA incremental_vacuum({vacuum_step_pages});").fetchall()
+            remaining = conn.execute("PRAGMA freelist_count;").fetchone()[0]
+        if remaining >= free_pages:
+            # auto_vacuum is off for this database, so there is nothing incremental_vacuum can do
+            break
+        released += free_pages - remaining
+        free_pages = remaining
+        time.sleep(batch_pause)
+    return released * page_size
+
+
+def run_retention(max_age=None, now=None):
+    # One pass of the retention job. Returns (and keeps in last_report) what was reclaimed
+    started = time.perf_counter()
+    max_age = max_age_hours if max_age is None else max_age
+    now = db.current_timestamp() if now is None else now
+    cutoff = now - int(max_age * 3600 * 1000)
+
+    closed = stale_rooms(cutoff)
+    for room_id in closed:
+        close_room(room_id)
+    report = {"rooms_closed": len(closed)}
+    for table_name in orphan_tables:
+        report[f"{table_name}_rows"] = purge_orphans(table_name, cutoff)
+    for table_name in retention_tables:
+        report[f"{table_name}_rows"] = purge_table(table_name, cutoff)
+    report["bytes_reclaimed"] = reclaim_space()
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    report["finished_at"] = db.current_timestamp()
+
+    last_report.clear()
+    last_report.update(report)
+    logger.info("Retention finished", dict(report))
+    return report
+
+
+def run_scheduled(max_age=None):
+    # What the scheduler calls. Every worker schedules the job for the same minute; the first to take the lock file
+    # next to the database runs it and writes down when, the others find the file locked or the run recent and skip
+    if fcntl is None:
+        return run_retention(max_age)
+    with open(f"{db.battle_sesh_db}.retention", "a+") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info("Retention skipped, another worker is running it")
+            return None
+        lock_file.seek(0)
+        last_run = lock_file.read().strip()
+        if last_run and time.time() - float(last_run) < min_run_gap:
+            logger.info("Retention skipped, another worker already ran it")
+            return None
+        report = run_retention(max_age)
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(time.time()))
+        return report
@@ -0,0 +1,423 @@
+import threading
+import atexit
+import logging
+import bisect
+import json
+import sqlite3
+import collections
+
+import db
+
+logger = logging.getLogger("combat.room_state")
+
+# In-memory state of the open rooms
+# The first event for a room loads its initiative list and map tokens from the database. After that
+# the socket handlers read and change the RoomState directly. Changed initiative and token rows are written back
+# by a background checkpoint every checkpoint_interval seconds, and right away at the checkpoints the handlers ask
+# for (combat starting or ending). Chat and log rows are still appended through db.add_to_db
+#
+# When more than one worker serves the rooms, write_through is turned on. Every change is then written to the
+# database immediately and only if room_object.state_version still matches the version the worker loaded; if
+# another worker got there first, the room is reloaded and the change applied again
+
+checkpoint_interval = 1.0 # in seconds
+change_retries = 5 # attempts at a change before giving up when other workers keep changing the room
+write_through = False
+resume_max_events = 500 # a client further behind than this gets a new snapshot instead of the missed events
+
+global rooms
+rooms = {}
+rooms_lock = threading.RLock()
+
+# Registry of open rooms: active_room_id -> OpenRoom for every open room this worker has seen. Checking that a room
+# exists and entering it read the registry instead of room_object; a room missing from it (opened by another worker,
+# or before a restart) is looked up once and remembered. With write_through on the other workers can close rooms
+# too, so then every lookup goes to the database. room_object has a UNIQUE index on open room ids
+# (see db.migration_unique_open_room_ids), so two rooms can't end up with the same id whatever the registry holds
+OpenRoom = collections.namedtuple("OpenRoom", "owner room_name map_url row_id")
+open_rooms = {}
+room_id_attempts = 10
+
+
+class InitiativeTracker:
+    # The initiative order of a room, kept sorted as characters join or change their initiative: highest
+    # initiative first, ties by name. Finding a character's place is a binary search, so starting combat and
+    # advancing the turn never re-sort the list
+    def __init__(self):
+        self.order = [] # (-init_val, chr_name, user_key), in turn order
+
+    def sort_key(self, key, init_val):
+        return (-init_val, key[1], key[0])
+
+    def add(self, key, init_val):
+        bisect.insort(self.order, self.sort_key(key, init_val))
+
+    def remove(self, key, init_val):
+        sort_key = self.sort_key(key, init_val)
+        i = bisect.bisect_left(self.order, sort_key)
+        if i < len(self.order) and self.order[i] == sort_key:
+            del self.order[i]
+
+    def update(self, key, old_init_val, new_init_val):
+        self.remove(key, old_init_val)
+        self.add(key, new_init_val)
+
+    def first(self):
+        if not self.order:
+            return None
+        _, chr_name, user_key = self.order[0]
+        return (user_key, chr_name)
+
+    def next(self, key, init_val):
+        # The character after key, wrapping around to the top of the order
+        i = bisect.bisect_right(self.order, self.sort_key(key, init_val)) % len(self.order)
+        _, chr_name, user_key = self.order[i]
+        return (user_key, chr_name)
+
+    def keys(self):
+        return [(user_key, chr_name) for _, chr_name, user_key in self.order]
+
+    def position(self, key, init_val):
+        return bisect.bisect_left(self.order, self.sort_key(key, init_val))
+
+
+class RoomState:
+    def __init__(self, room_id, row_id, owner, map_url, state_version=0, seq=0):
+        self.room_id = room_id
+        self.row_id = row_id
+        self.owner = owner
+        self.map_url = map_url
+        self.state_version = state_version
+        self.seq = seq # sequence number of the room's latest event
+
+        # (user_key, chr_name) -> {init_val, is_turn, char_token, site_name}
+        self.initiative = {}
+        self.order = InitiativeTracker()
+        # (user_key, chr_name) -> {site_name, character_image, height, width, top, left, is_turn}
+        self.tokens = {}
+        self.turn = None
+
+        self.dirty_initiative = set()
+        self.dirty_tokens = set()
+        self.lock = threading.RLock()
+
+    # Initiative
+    def add_character(self, user_key, chr_name, site_name, char_token):
+        with self.lock:
+            key = (user_key, chr_name)
+            if key not in self.initiative:
+                self.initiative[key] = {"init_val": 0, "is_turn": 0, "char_token": char_token, "site_name": site_name}
+                self.order.add(key, 0)
+                self.dirty_initiative.add(key)
+            return self.initiative[key]["init_val"]
+
+    def set_initiative(self, user_key, chr_name, init_val):
+        # Returns the character's initiative, or None if the character isn't in the room or init_val isn't a number
+        with self.lock:
+            entry = self.initiative.get((user_key, chr_name))
+            if entry is None:
+                return None
+            if init_val not in (None, ""):
+                try:
+                    init_val = int(init_val)
+                except (TypeError, ValueError):
+                    return None
+                self.order.update((user_key, chr_name), entry["init_val"], init_val)
+                entry["init_val"] = init_val
+                self.dirty_initiative.add((user_key, chr_name))
+            return entry["init_val"]
+
+    def initiative_position(self, user_key, chr_name):
+        # The character's index in the turn order. Sent with initiative_update, so clients put the character where
+        # the server has it rather than sorting the list themselves
+        with self.lock:
+            return self.order.position((user_key, chr_name), self.initiative[(user_key, chr_name)]["init_val"])
+
+    def initiative_order(self):
+        # Highest initiative first; ties go to the alphabetically first name
+        with self.lock:
+            return self.order.keys()
+
+    # Turns
+    def set_turn(self, key):
+        with self.lock:
+            for previous in (self.turn, key):
+                if previous is None:
+                    continue
+                is_turn = 1 if previous == key else 0
+                if previous in self.initiative:
+                    self.initiative[previous]["is_turn"] = is_turn
+                    self.dirty_initiative.add(previous)
+                if previous in self.tokens:
+                    self.tokens[previous]["is_turn"] = is_turn
+                    self.dirty_tokens.add(previous)
+            self.turn = key
+
+    def start_combat(self):
+        with self.lock:
+            first = self.order.first()
+            if first is None:
+                return None
+            self.set_turn(first)
+            return first
+
+    def advance_turn(self):
+        # Passes the turn to the next character in initiative order. Returns (previous, next), or None outside of combat
+        with self.lock:
+            previous = self.turn
+            if previous not in self.initiative:
+                return None
+            next_character = self.order.next(previous, self.initiative[previous]["init_val"])
+            self.set_turn(next_character)
+            return previous, next_character
+
+    def end_combat(self):
+        with self.lock:
+            previous = self.turn
+            self.set_turn(None)
+            return previous
+
+    # Map tokens
+    def add_token(self, user_key, chr_name, site_name, character_image, height, width, top, left):
+        with self.lock:
+            key = (user_key, chr_name)
+            self.tokens[key] = {"site_name": site_name, "character_image": character_image, "height": height, "width": width, "top": top, "left": left, "is_turn": 1 if key == self.turn else 0}
+            self.dirty_tokens.add(key)
+
+    def find_token(self, site_name, chr_name):
+        for key, token in self.tokens.items():
+            if key[1] == chr_name and token["site_name"] == site_name:
+                return key
+        return None
+
+    def update_token(self, key, **changes):
+        with self.lock:
+            if key not in self.tokens:
+                return
+            self.tokens[key].update(changes)
+            self.dirty_tokens.add(key)
+
+    def token_json(self, key):
+        token = self.tokens[key]
+        return {"site_name": token["site_name"], "character_name": key[1], "room_id": self.room_id, "character_image": token["character_image"], "height": token["height"], "width": token["width"], "top": token["top"], "left": token["left"], "is_turn": token["is_turn"]}
+
+    def tokens_json(self):
+        with self.lock:
+            return {f"{user_key}_{chr_name}": self.token_json((user_key, chr_name)) for user_key, chr_name in self.tokens}
+
+    def user_characters(self, user_key):
+        # Names of the user's characters in the room, in the initiative list or on the map
+        with self.lock:
+            names = []
+            for key_user, chr_name in list(self.initiative) + list(self.tokens):
+                if key_user == user_key and chr_name not in names:
+                    names.append(chr_name)
+            return names
+
+    def snapshot(self):
+        # The whole room as the client draws it: initiative list in turn order, turn holder, tokens and the
+        # newest page of chat. Older chat is fetched page by page through the history event
+        chat, chat_before_id = db.read_history("chat", self.room_id)
+        with self.lock:
+            initiative = [{"character_name": key[1], "init_val": self.initiative[key]["init_val"], "site_name": self.initiative[key]["site_name"]}
+                          for key in self.initiative_order()]
+            turn = None
+            if self.turn in self.initiative:
+                turn = {"first_turn_name": self.turn[1], "site_name": self.initiative[self.turn]["site_name"]}
+            return {"initiative": initiative, "turn": turn, "tokens": self.tokens_json(), "chat": db.history_json("chat", chat), "chat_before_id": chat_before_id}
+
+    # Event stream
+    def next_seq(self):
+        with self.lock:
+            if write_through:
+                self.seq = db.next_event_seq(self.room_id)
+            else:
+                self.seq += 1
+            return self.seq
+
+    def events_since(self, last_seq):
+        # The (event, payload) pairs a client that has seen up to last_seq missed, or None if it has to start over
+        if write_through:
+            self.seq = max(self.seq, db.last_event_seq(self.room_id))
+        missed = self.seq - last_seq
+        if missed < 0 or missed > resume_max_events:
+            return None
+        rows = db.read_room_events(self.room_id, last_seq, missed)
+        # Events still on their way to the database (or lost to a failed write) leave a gap
+        if [row[0] for row in rows] != list(range(last_seq + 1, self.seq + 1)):
+            return None
+        return [(event, json.loads(payload)) for _, event, payload in rows]
+
+    # Persistence
+    def dirty_rows(self):
+        initiative_rows = [(self.room_id, key[0], key[1], self.initiative[key]["init_val"], self.initiative[key]["is_turn"], self.initiative[key]["char_token"])
+                           for key in self.dirty_initiative if key in self.initiative]
+        token_rows = [(self.room_id, key[0], key[1], self.tokens[key]["site_name"], self.tokens[key]["character_image"], self.tokens[key]["height"], self.tokens[key]["width"], self.tokens[key]["top"], self.tokens[key]["left"], self.tokens[key]["is_turn"])
+                      for key in self.dirty_tokens if key in self.tokens]
+        return initiative_rows, token_rows
+
+    def commit(self):
+        # Writes the changed rows if no other worker has changed the room since it was loaded. Returns False if one has
+        with self.lock:
+            initiative_rows, token_rows = self.dirty_rows()
+            if not initiative_rows and not token_rows:
+                return True
+            state_version = db.save_room_state(initiative_rows, token_rows, self.room_id, self.state_version)
+            if state_version is None:
+                return False
+            self.state_version = state_version
+            self.dirty_initiative = set()
+            self.dirty_tokens = set()
+            return True
+
+    def checkpoint(self):
+        with self.lock:
+            initiative_rows, token_rows = self.dirty_rows()
+            dirty_initiative, self.dirty_initiative = self.dirty_initiative, set()
+            dirty_tokens, self.dirty_tokens = self.dirty_tokens, set()
+        if not initiative_rows and not token_rows:
+            return
+        try:
+            db.save_room_state(initiative_rows, token_rows)
+        except:
+            # Keep the rows marked as changed so the next checkpoint writes them
+            with self.lock:
+                self.dirty_initiative |= dirty_initiative
+                self.dirty_tokens |= dirty_tokens
+            raise
+
+
+def load_room(room_id):
+    room = db.select_one("room_object", "row_id, user_key, map_url, state_version, event_seq", {"active_room_id": room_id})
+    if not room:
+        return None
+
+    row_id, owner, map_url, state_version, event_seq = room
+    state = RoomState(room_id, row_id, owner, map_url, state_version, max(event_seq, db.last_event_seq(room_id)))
+    for user_key, chr_name, init_val, is_turn, char_token, site_name in db.read_initiatives(room_id):
+        state.initiative[(user_key, chr_name)] = {"init_val": init_val, "is_turn": is_turn, "char_token": char_token, "site_name": site_name}
+        state.order.add((user_key, chr_name), init_val)
+        if is_turn:
+            state.turn = (user_key, chr_name)
+    for _, user_key, chr_name, site_name, character_image, height, width, top, left, is_turn in db.read_map_tokens(room_id):
+        state.tokens[(user_key, chr_name)] = {"site_name": site_name, "character_image": character_image, "height": height, "width": width, "top": top, "left": left, "is_turn": is_turn}
+    return state
+
+
+def get_room(room_id):
+    # Returns the RoomState of an open room, loading it on first access. Returns None if the room is not open
+    state = rooms.get(room_id)
+    if state is not None and write_through:
+        current = db.select_one("room_object", "state_version", {"active_room_id": room_id})
+        if current is None or current[0] != state.state_version:
+            drop_room(room_id)
+            state = None
+    if state is None:
+        with rooms_lock:
+            state = rooms.get(room_id)
+            if state is None:
+                state = load_room(room_id)
+                if state is None:
+                    return None
+                rooms[room_id] = state
+                checkpointer.start()
+    return state
+
+
+def change_room(room_id, change):
+    # Applies change(room) to an open room and returns its result, or None if the room is not open. With
+    # write_through on, a change that loses the race with another worker is retried on a freshly loaded room
+    for _ in range(change_retries):
+        state = get_room(room_id)
+        if state is None:
+            return None
+        with state.lock:
+            result = change(state)
+            if not write_through or state.commit():
+                return result
+        drop_room(room_id)
+    raise RuntimeError(f"Room {room_id} changed {change_retries} times while applying a change")
+
+
+def set_write_through(enabled):
+    global write_through
+    write_through = enabled
+
+
+def drop_room(room_id):
+    # Forgets a room without writing its pending changes, used when the room's rows are being deleted
+    with rooms_lock:
+        rooms.pop(room_id, None)
+
+
+def find_open_room(room_id):
+    # The OpenRoom of an open room id, or None
+    if room_id in (None, "", "null"):
+        return None
+    room = None if write_through else open_rooms.get(room_id)
+    if room is None:
+        row = db.select_one("room_object", "user_key, room_name, map_url, row_id", {"active_room_id": room_id})
+        if row is None:
+            open_rooms.pop(room_id, None)
+            return None
+        room = open_rooms[room_id] = OpenRoom(*row)
+    return room
+
+
+def open_room(row_id, owner, room_name, map_url, new_room_id):
+    # Gives the room_object row a new active_room_id from new_room_id() and returns it. Ids in the registry are passed
+    # over without asking the database, and one taken by a room this worker has not seen fails the UNIQUE index
+    for _ in range(room_id_attempts):
+        room_id = new_room_id()
+        if room_id in open_rooms:
+            continue
+        try:
+            db.update("room_object", {"active_room_id": room_id}, {"row_id": row_id})
+        except sqlite3.IntegrityError:
+            continue
+        open_rooms[room_id] = OpenRoom(owner, room_name, map_url, row_id)
+        return room_id
+    raise RuntimeError(f"No free room id after {room_id_attempts} attempts")
+
+
+def forget_open_room(room_id):
+    # Called when a room closes
+    open_rooms.pop(room_id, None)
+
+
+def checkpoint_rooms():
+    for state in list(rooms.values()):
+        state.checkpoint()
+
+
+def evict_user(user_key):
+    # Writes back and forgets every loaded room the user has characters in. Used before changing a user's
+    # characters outside of a room, so the next event reloads the room from the database
+    checkpoint_rooms()
+    with rooms_lock:
+        for room_id, state in list(rooms.items()):
+            if any(key[0] == user_key for key in state.initiative) or any(key[0] == user_key for key in state.tokens):
+                rooms.pop(room_id, None)
+
+
+class Checkpointer:
+    def __init__(self, interval=checkpoint_interval):
+        self.interval = interval
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                checkpoint_rooms()
+            except Exception:
+                logger.exception("Room state checkpoint failed")
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="room-checkpoint", daemon=True)
+            self.thread.start()
+
+
+checkpointer = Checkpointer()
+atexit.register(checkpoint_rooms)
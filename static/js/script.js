@@ -15,6 +15,14 @@ $(document).ready(function() {
 
   var initiatives = [];
   var turn_index = null;
+  // Cursor of the next older page of chat and log history; null once there is nothing older.
+  // The log has no cursor until its first page is asked for, which starts from the newest entry. That page already
+  // has the entries shown live since joining, so it replaces the box's contents instead of going above them
+  var history_before_id = {chat: null, log: undefined};
+  var history_loading = {chat: false, log: false};
+  var history_boxes = {chat: ['#chat-box', '#chat-list'], log: ['#log_div', '#log']};
+  // Sequence number of the newest room event seen, sent back on reconnect so only the missed events are replayed
+  var last_seq = null;
   var site_name = $('#site_name').text();
   var room_id = $('#room_id').text();
 
@@ -46,8 +54,15 @@ $(document).ready(function() {
   // Connect to the Socket.IO server.
   // The connection URL has the following format, relative to the current page:
   //     http[s]://<domain>:<port>[/<namespace>]
+  // Websocket only, so that every request of a connection stays on the worker that accepted it
 
-  var socket = io(namespace);
+  var socket = io(namespace, {transports: ['websocket']});
+
+  socket.onAny(function(event, msg) {
+    if (msg && msg.seq) {
+      last_seq = Math.max(last_seq || 0, msg.seq);
+    }
+  });
 
 
   // javascript events
@@ -84,15 +99,9 @@ $(document).ready(function() {
     return false; 
   });
   
+  // The server picks the next character and answers with turn_ended
   $('form#end_turn').submit(function(event) {
-    var next_index = null;
-    if (turn_index + 1 == initiatives.length) {
-      next_index = 0;
-    }
-    else {
-      next_index = turn_index + 1;
-    }
-    socket.emit('end_turn', {desc: `${initiatives[turn_index][0]}'s Turn Ended`, previous_character_name: initiatives[turn_index][0], next_character_name: initiatives[next_index][0], previous_site_name: initiatives[turn_index][2], next_site_name: initiatives[next_index][2], room_id: room_id});
+    socket.emit('end_turn', {previous_character_name: initiatives[turn_index][0], previous_site_name: initiatives[turn_index][2], room_id: room_id});
     return false;
   });
 
@@ -112,50 +121,26 @@ $(document).ready(function() {
   });
 
   socket.on('joined', function(msg) {
-    socket.emit('join_actions', {room_id: room_id, character_name: ""});
+    socket.emit('join_actions', {room_id: room_id, character_name: "", last_seq: last_seq});
   });
 
   socket.on('log_update', function(msg) {
-    var log = $('<div/>').text(msg.desc);
-    var col = $('<div/>').addClass("col");
-    var row = $('<div/>').addClass("row");
-    col.append(log);
-    row.append(col);
+    var row = build_log_row(msg);
     $('#log').append(row);
     $('#log_div').animate({ scrollTop: $('#log_div').prop("scrollHeight")}, 10);
   });
 
   // TODO: allow characters to select who goes first when initiatives tied
+  // The server sends the character's place in the turn order, so the table always matches the order end_turn follows
   socket.on('initiative_update', function(msg) {
-    var updated = false;
-
-    for (i = 0; i < initiatives.length; i++) {
-      if (initiatives[i][0] == msg.character_name && initiatives[i][2] == msg.site_name) {
-        initiatives[i][1] = msg.init_val;
-        updated = true;
-      }
-    }
-
-    if (!updated) {
-      initiatives.push([msg.character_name, msg.init_val, msg.site_name]);
-    }
-
-    initiatives.sort(function(a, b) { 
-      return (b[1] - a[1]  ||  a[0].localeCompare(b[0]));
-      // https://stackoverflow.com/questions/12900058/how-can-i-sort-a-javascript-array-of-objects-numerically-and-then-alphabetically
-      // TODO: Fix the way name entry happens to conicide with SQL sort
-    });
-
-    var html_code = update_init_table();
-    $('#initiative-table').html(html_code);
+    initiatives = initiatives.filter(x => !(x[0] == msg.character_name && x[2] == msg.site_name));
+    var position = (msg.position === undefined) ? initiatives.length : msg.position;
+    initiatives.splice(position, 0, [msg.character_name, msg.init_val, msg.site_name]);
+    draw_initiative_table();
   });
 
   socket.on('chat_update', function(msg) {
-    var log = $('<div/>').text(`${msg.character_name}: ${msg.chat}`);
-    var col = $('<div/>').addClass("col");
-    var row = $('<div/>').addClass("row");
-    col.append(log);
-    row.append(col);
+    var row = build_chat_row(msg);
     // var name = $('<p/>').text(`${msg.character_name}: ${msg.chat}`).addClass("mb-0 mt-0");
     // var chat;
 
@@ -183,7 +168,7 @@ $(document).ready(function() {
 
   socket.on('combat_started', function(msg) {
     var first_turn_name = msg.first_turn_name.split(" ").join("_");
-    turn_index = 0;
+    turn_index = initiatives.findIndex(x => x[0]===msg.first_turn_name && x[2]===msg.site_name);
 
     // $('#initiative-wrapper').html(checklist);
 
@@ -231,18 +216,9 @@ $(document).ready(function() {
   });
 
   socket.on('turn_ended', function(msg) {
-    // TODO: Fix having to hit "end turn" twice when characters have the same name.
-    // I think its something to do with the way that the front end sorts the initiatives list
-    var next_index = null;
-    if (turn_index + 1 == initiatives.length) {
-      next_index = 0;
-    }
-    else {
-      next_index = turn_index + 1;
-    }
-    var previous_character_name = initiatives[turn_index][0].split(" ").join("_");
-    var next_character_name = initiatives[next_index][0].split(" ").join("_");
-    turn_index = next_index;
+    var previous_character_name = msg.previous_character_name.split(" ").join("_");
+    var next_character_name = msg.next_character_name.split(" ").join("_");
+    turn_index = initiatives.findIndex(x => x[0]===msg.next_character_name && x[2]===msg.next_site_name);
 
     // $('#initiative_wrapper').html(checklist);
     $('#checklist_div').html("");
@@ -263,7 +239,70 @@ $(document).ready(function() {
     }
   });
 
-  socket.on('combat_connect', function(msg) {
+  socket.on('combat_connect', combat_connect);
+
+  // Sent once on join with the whole room, so a late joiner gets one frame however long the session has run
+  // Also sent after a reconnect the server can't replay, so everything it covers is drawn from scratch
+  socket.on('room_snapshot', function(msg) {
+    last_seq = msg.seq;
+    initiatives = msg.initiative.map(x => [x.character_name, x.init_val, x.site_name]);
+    draw_initiative_table();
+
+    for (let character_name of msg.your_characters) {
+      populate_select({character_name: character_name, site_name: site_name});
+    }
+
+    $('#chat-list').empty().append(msg.chat.map(build_chat_row));
+    $('#chat-box').animate({ scrollTop: $('#chat-box').prop("scrollHeight")}, 10);
+    history_before_id.chat = msg.chat_before_id;
+
+    $('.characterIconWrapper').remove();
+    redraw_tokens(msg.tokens);
+    reloadDroppable(socket, room_id);
+
+    if (msg.turn) {
+      combat_connect(msg.turn);
+    }
+    $('#log').append(build_log_row({desc: "Room Received"}));
+  });
+
+  // Older history is loaded a page at a time when the chat or log box is scrolled to the top
+  socket.on('history_page', function(msg) {
+    let box = history_boxes[msg.kind][0];
+    let list = history_boxes[msg.kind][1];
+    if (history_before_id[msg.kind] === undefined) {
+      $(list).empty();
+    }
+    let old_height = $(box).prop("scrollHeight");
+
+    $(list).prepend(msg.items.map(msg.kind == 'chat' ? build_chat_row : build_log_row));
+    $(box).scrollTop($(box).prop("scrollHeight") - old_height);
+
+    history_before_id[msg.kind] = msg.next_before_id;
+    history_loading[msg.kind] = false;
+  });
+
+  $('#chat-box').on('scroll wheel', function() {
+    if (this.scrollTop == 0) {
+      load_older_history('chat');
+    }
+  });
+
+  $('#log_div').on('scroll wheel', function() {
+    if (this.scrollTop == 0) {
+      load_older_history('log');
+    }
+  });
+
+  function load_older_history(kind) {
+    if (history_before_id[kind] === null || history_loading[kind]) {
+      return;
+    }
+    history_loading[kind] = true;
+    socket.emit('history', {room_id: room_id, kind: kind, before_id: history_before_id[kind]});
+  }
+
+  function combat_connect(msg) {
     var first_turn_name = msg.first_turn_name.split(" ").join("_");
     turn_index = initiatives.findIndex(x => x[0]===first_turn_name && x[2]===msg.site_name);
 
@@ -283,13 +322,18 @@ $(document).ready(function() {
       $('#checklist_div').html(checklist);
     }
     setTimeout(() => $(`#${first_turn_name}-${msg.site_name}-row`).addClass("bg-warning"), 100);
-  });
+  }
+
+  socket.on('populate_select_with_character_names', populate_select);
 
-  socket.on('populate_select_with_character_names', function(msg) {
+  function populate_select(msg) {
     if (msg.site_name == site_name) {
       let character_name = msg.character_name;
       let id_character_name = character_name.split(" ").join(":") + "-init-update";
       let old_character_name = character_name.split(" ").join("\\:") + "-add-row";
+      if ($('#player_name option').filter((i, option) => $(option).text() == character_name).length) {
+        return;
+      }
       $('#init_placeholder').remove();
       $('#player_name').append(`<option id=${id_character_name}>${character_name}</option>`);
       $(`#${old_character_name}`).remove();
@@ -300,37 +344,75 @@ $(document).ready(function() {
         $('#add_character_button').prop('disabled', true);
       }
     }
-  });
+  }
 
- socket.on('redraw_character_tokens_on_map', function(msg) {
+ // Map tokens are sent one at a time as they change; only the token's own node is touched
+ socket.on('token_added', place_token);
+
+ socket.on('token_moved', function(msg) {
+  $(token_selector(msg)).css({top: msg.top, left: msg.left});
+ });
+
+ socket.on('token_resized', function(msg) {
+  let token = $(token_selector(msg));
+  token.find(".ui-wrapper").css({height: msg.height, width: msg.width});
+  token.find("img").css({height: msg.height, width: msg.width});
+ });
+
+ socket.on('token_removed', function(msg) {
+  $(token_selector(msg)).remove();
+ });
+
+ function redraw_tokens(msg) {
   for (let character in msg) {
-    let character_site_name = msg[character].site_name;
-    let character_name = msg[character].character_name.split(" ").join(":");
-    let character_image = msg[character].character_image;
-    let room_id = msg[character].room_id;
-    let height = msg[character].height;
-    let width = msg[character].width;
-    let top = msg[character].top;
-    let left = msg[character].left;
-    let is_turn = msg[character].is_turn;
+    place_token(msg[character]);
+  }
+ }
 
-    let character_html_id_build = character_name + "_" + character_site_name;
+ function token_selector(msg) {
+  return "#" + msg.character_name.split(" ").join("\\:") + "_" + msg.site_name;
+ }
 
-    let character_token_html = build_html_for_character_icon(character_html_id_build, character_image, height, width, top, left, is_turn);
+ function place_token(msg) {
+  let character_name = msg.character_name.split(" ").join(":");
+  let character_html_id_build = character_name + "_" + msg.site_name;
 
-    let character_html_id_remove = character_name.split(":").join("\\:") + "_" + character_site_name;
+  let character_token_html = build_html_for_character_icon(character_html_id_build, msg.character_image, msg.height, msg.width, msg.top, msg.left, msg.is_turn);
 
-    $("#" + character_html_id_remove).remove();
-    $('#battle_map_container').append(character_token_html.outerHTML);
+  $(token_selector(msg)).remove();
+  let token = $(character_token_html.outerHTML);
+  $('#battle_map_container').append(token);
 
-    reloadDraggable(socket);
-    reloadDroppable(socket, room_id);
-    reloadResizable(socket, room_id);
-  }
-});
+  reloadDraggable(socket, token);
+  reloadResizable(socket, msg.room_id, token.find(".resizable"));
+ }
 
 
   // "Helper" functions
+  // initiatives is kept in the server's turn order, see initiative_update and room_snapshot
+  function draw_initiative_table() {
+    var html_code = update_init_table();
+    $('#initiative-table').html(html_code);
+  }
+
+  function build_log_row(msg) {
+    var log = $('<div/>').text(msg.desc);
+    var col = $('<div/>').addClass("col");
+    var row = $('<div/>').addClass("row");
+    col.append(log);
+    row.append(col);
+    return row;
+  }
+
+  function build_chat_row(msg) {
+    var log = $('<div/>').text(`${msg.character_name}: ${msg.chat}`);
+    var col = $('<div/>').addClass("col");
+    var row = $('<div/>').addClass("row");
+    col.append(log);
+    row.append(col);
+    return row;
+  }
+
   function update_init_table() {
     code = "<tbody>";
     for (i = 0; i < initiatives.length; i++) {
@@ -394,8 +476,8 @@ function scrapeCharacterImage(partially_sliced_character_image) {
 }
 
 
-function reloadDraggable(socket){
-  $(".draggable").draggable({
+function reloadDraggable(socket, element){
+  $(element || ".draggable").draggable({
     containment: 'parent',
     stack: ".characterIcon",
     zIndex: 100
@@ -432,8 +514,8 @@ function reloadDroppable(socket, room_id){
 }
 
 
-function reloadResizable(socket, room_id) {
-  $(".resizable" ).resizable({
+function reloadResizable(socket, room_id, element) {
+  $(element || ".resizable").resizable({
     autoHide: true,
     ghost: true,
     // get size of battle map and then set max size for resizing to that
@@ -13,17 +13,27 @@ from requests import get, post, request
 import toml
 import pathlib
 import os, sys
+import logging
 import tempfile
+import gzip
+import json
 from unittest import mock
 
 
 # https://flask.palletsprojects.com/en/1.1.x/testing/
 # Internal imports
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-from app import app, socketio
-from db import create_dbs, add_to_db, delete_from_db, read_db
+from app import app, socketio, scheduler
+import db
+import room_state
+import retention
+import archive
+import errors
+import metrics
+import logs
+from db import create_dbs, add_to_db, delete_from_db, read_db, select_one, update, delete
 import wtforms.csrf 
-from classes import User
+from classes import User, RateLimiter
 
 
 # 
@@ -264,6 +274,586 @@ def test_delete_character(client_2):
 
     assert b'Yanko' not in del_char.data
 
+# Testing the parameterized query helpers
+# Values with quotes in them used to break the f-string SQL
+def test_query_helpers_bind_quotes(client_2):
+    update("room_object", {"room_name": "Dragon's Lair"}, {"user_key": "paulinaMock21", "room_name": "Dungeon Battle"})
+    room = select_one("room_object", "room_name, dm_notes", {"user_key": "paulinaMock21", "room_name": "Dragon's Lair"})
+
+    assert room == ("Dragon's Lair", "This is going to be an intense batle")
+
+    delete("room_object", {"room_name": "Dragon's Lair"})
+    assert select_one("room_object", "room_name", {"user_key": "paulinaMock21"}) is None
+
+# Testing that an existing database from before the migrations is upgraded in place
+def test_migrate_old_database(tmp_path, monkeypatch):
+    old_db = str(tmp_path / "old_battle_sesh.db")
+    with db.create_connection(old_db) as conn:
+        db.migration_base_tables(conn.cursor())
+        conn.execute("INSERT INTO chat(room_id, user_key, chr_name, chat, timestamp) VALUES('abcd1234', 'mocksterid', 'Yanko', 'hi', '2020-11-30 12:00:00')")
+
+    monkeypatch.setattr(db, "battle_sesh_db", old_db)
+    create_dbs()
+    create_dbs()
+
+    assert read_db("schema_version", "MAX(version)") == [(len(db.migrations),)]
+    row_id, timestamp = select_one("chat", "row_id, timestamp", {"room_id": "abcd1234"})
+    assert row_id == 1
+    assert isinstance(timestamp, int) and timestamp > 1600000000000
+    assert read_db("sqlite_master", "name", "WHERE type = 'index' AND name = 'chat_room_user'")
+
+# An existing database is only switched to incremental auto-vacuum by the offline setup, a new one when it is created
+def test_incremental_vacuum_offline_only(tmp_path, monkeypatch):
+    old_db = str(tmp_path / "old_battle_sesh.db")
+    with db.create_connection(old_db) as conn:
+        db.migration_base_tables(conn.cursor())
+
+    monkeypatch.setattr(db, "battle_sesh_db", old_db)
+    create_dbs()
+    assert read_db("pragma_auto_vacuum") == [(0,)]
+
+    with db.create_connection(old_db) as conn:
+        assert db.use_incremental_vacuum(conn, rewrite_existing=True)
+    assert read_db("pragma_auto_vacuum") == [(2,)]
+
+    monkeypatch.setattr(db, "battle_sesh_db", str(tmp_path / "new_battle_sesh.db"))
+    create_dbs()
+    assert read_db("pragma_auto_vacuum") == [(2,)]
+
+# Resetting a table keeps the schema the migrations built, instead of replaying them
+def test_reset_db_keeps_schema(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "battle_sesh_db", str(tmp_path / "reset_battle_sesh.db"))
+    create_dbs()
+    add_to_db("room_event", ("resetroom", "mocksterid", "Chat", "hi", db.current_timestamp(), 1, "chat_update", "{}"))
+    add_to_db("chat", ("resetroom", "mocksterid", "Yanko", "hi", db.current_timestamp()))
+
+    db.reset_db("log")
+    create_dbs()
+
+    assert read_db("log") == []
+    assert select_one("chat", "chat", {"room_id": "resetroom"}) == ("hi",)
+    assert "seq" in [column[1] for column in read_db("pragma_table_info('log')")]
+    assert read_db("sqlite_master", "name", "WHERE type = 'index' AND name = 'log_room_seq'")
+    assert read_db("schema_version", "MAX(version)") == [(len(db.migrations),)]
+
+# Testing that queued chat inserts are visible to the next read
+def test_write_behind_read_your_writes(client_2):
+    for i in range(3):
+        add_to_db("chat", ("wbroom01", "paulinaMock21", "Yanko", f"message {i}", db.current_timestamp()))
+
+    chats = db.select("chat", "chat", {"room_id": "wbroom01"})
+
+    assert [chat[0] for chat in chats] == ["message 0", "message 1", "message 2"]
+    assert db.write_behind.depth() == 0
+    delete("chat", {"room_id": "wbroom01"})
+
+# A row that can never be written is set aside after flush_attempts failures instead of blocking the queue
+def test_write_behind_sets_bad_rows_aside(client_2):
+    queue = db.WriteBehindQueue()
+    queue.pending.extend([("chat", ("wbroom02", "paulinaMock21", "Yanko", "kept", db.current_timestamp())), ("chat", ("wbroom02", "too few"))])
+    for _ in range(db.flush_attempts - 1):
+        with pytest.raises(Exception):
+            queue.flush()
+        assert queue.depth() == 2
+
+    assert queue.flush() == 1
+    assert queue.depth() == 0 and list(queue.set_aside) == [("chat", ("wbroom02", "too few"))]
+    assert db.select("chat", "chat", {"room_id": "wbroom02"}) == [("kept",)]
+    delete("chat", {"room_id": "wbroom02"})
+
+# A value sqlite can't bind is refused when queued, and a read never fails on a bad row already in the queue
+def test_write_behind_reads_skip_bad_rows(client_2):
+    with pytest.raises(TypeError):
+        db.write_behind.put("chat", ("wbroom03", "paulinaMock21", "Yanko", {"not": "text"}, db.current_timestamp()))
+
+    db.write_behind.pending.extend([("chat", ("wbroom03", "paulinaMock21", "Yanko", "kept", db.current_timestamp())), ("chat", ("wbroom03", "too few"))])
+    assert db.select("chat", "chat", {"room_id": "wbroom03"}) == [("kept",)]
+    assert db.write_behind.depth() == 0 and db.write_behind.set_aside[-1] == ("chat", ("wbroom03", "too few"))
+    delete("chat", {"room_id": "wbroom03"})
+
+# Testing that moving one map token only changes that token's row
+def test_map_token_row_updates(client_2):
+    db.add_map_token("tokroom1", "paulinaMock21", "Yanko", "mrsmock69", "lizardboi.jpg", "2em", "2em", "25px", "25px")
+    db.add_map_token("tokroom1", "paulinaMock21", "Fuyuki", "mrsmock69", "mock.jpg", "2em", "2em", "25px", "25px")
+
+    update("map_token", {"top_pos": "100px", "left_pos": "40px"}, {"room_id": "tokroom1", "user_key": "paulinaMock21", "chr_name": "Yanko"})
+    tokens = db.map_tokens_json(db.read_map_tokens("tokroom1"))
+
+    assert tokens["paulinaMock21_Yanko"]["top"] == "100px"
+    assert tokens["paulinaMock21_Yanko"]["left"] == "40px"
+    assert tokens["paulinaMock21_Fuyuki"]["top"] == "25px"
+    delete("map_token", {"room_id": "tokroom1"})
+
+def test_room_state_checkpoint(client_2):
+    update("room_object", {"active_room_id": "stateroom1"}, {"room_name": "Dungeon Battle", "user_key": "paulinaMock21"})
+
+    room = room_state.get_room("stateroom1")
+    room.add_character("paulinaMock21", "Yanko", "mrsmock69", "lizardboi.jpg")
+    room.set_initiative("paulinaMock21", "Yanko", "17")
+    room.add_token("paulinaMock21", "Yanko", "mrsmock69", "lizardboi.jpg", "2em", "2em", "25px", "25px")
+    room.update_token(("paulinaMock21", "Yanko"), top="80px")
+    room.checkpoint()
+    room_state.drop_room("stateroom1")
+
+    reloaded = room_state.get_room("stateroom1")
+    assert reloaded is not room
+    assert reloaded.initiative[("paulinaMock21", "Yanko")]["init_val"] == 17
+    assert reloaded.tokens[("paulinaMock21", "Yanko")]["top"] == "80px"
+
+    room_state.drop_room("stateroom1")
+    delete("active_room", {"room_id": "stateroom1"})
+    delete("map_token", {"room_id": "stateroom1"})
+    update("room_object", {"active_room_id": "null"}, {"active_room_id": "stateroom1"})
+
+def test_room_state_write_through_conflict(client_2, monkeypatch):
+    monkeypatch.setattr(room_state, "write_through", True)
+    update("room_object", {"active_room_id": "stateroom2"}, {"room_name": "Dungeon Battle", "user_key": "paulinaMock21"})
+    room_state.change_room("stateroom2", lambda room: room.add_character("paulinaMock21", "Yanko", "mrsmock69", "lizardboi.jpg"))
+
+    # Another worker changes the room between this worker loading it and writing its own change
+    attempts = []
+    def change(room):
+        if not attempts:
+            db.save_room_state([("stateroom2", "paulinaMock21", "Fuyuki", 3, 0, "mock.jpg")], [], "stateroom2", room.state_version)
+        attempts.append(room)
+        return room.set_initiative("paulinaMock21", "Yanko", "12")
+
+    assert room_state.change_room("stateroom2", change) == 12
+    assert len(attempts) == 2
+    room = room_state.get_room("stateroom2")
+    assert ("paulinaMock21", "Fuyuki") in room.initiative
+    assert select_one("active_room", "init_val", {"room_id": "stateroom2", "chr_name": "Yanko"})[0] == 12
+
+    room_state.drop_room("stateroom2")
+    delete("active_room", {"room_id": "stateroom2"})
+    update("room_object", {"active_room_id": "null"}, {"active_room_id": "stateroom2"})
+
+def test_build_api_db_skips_unchanged_catalog(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "api_db", str(tmp_path / "api.db"))
+
+    assert db.build_api_db(["race", "class"])
+    assert not db.build_api_db(["race", "class"])
+
+    races, subraces = db.get_api_info("race", "race")
+    assert "Elf" in races
+    assert "High" in subraces["Elf"]
+
+def test_api_catalog_etag(client_2):
+    races = client_2.get("/api/races")
+    assert races.status_code == 200
+    assert "Elf" in races.get_json()["races"]
+    assert races.headers["ETag"]
+
+    not_modified = client_2.get("/api/races", headers={"If-None-Match": races.headers["ETag"]})
+    assert not_modified.status_code == 304
+    assert not_modified.data == b""
+
+def test_databases_set_up_on_first_use(tmp_path, monkeypatch):
+    assert set(app.config["STARTUP_TIMINGS"]) == {"imports", "flask", "extensions", "routes"}
+
+    new_db = tmp_path / "battle_sesh.db"
+    monkeypatch.setattr(db, "battle_sesh_db", str(new_db))
+    assert not new_db.exists()
+
+    assert select_one("users", "user_id", {"user_id": "nobody"}) is None
+    assert read_db("schema_version", "MAX(version)") == [(len(db.migrations),)]
+    assert str(new_db) in db.setup_timings
+
+def test_user_cache_invalidation(client_2):
+    db.invalidate_user("paulinaMock21")
+    misses = db.user_cache.stats()["misses"]
+
+    assert db.get_user("paulinaMock21")[4] == "mrsmock69"
+    assert db.get_user("paulinaMock21")[4] == "mrsmock69"
+    assert db.user_cache.stats()["misses"] == misses + 1
+
+    update("users", {"site_name": "mrsmock70"}, {"user_id": "paulinaMock21"})
+    assert db.get_user("paulinaMock21")[4] == "mrsmock69"
+    db.invalidate_user("paulinaMock21")
+    assert db.get_user("paulinaMock21")[4] == "mrsmock70"
+
+    update("users", {"site_name": "mrsmock69"}, {"user_id": "paulinaMock21"})
+    db.invalidate_user("paulinaMock21")
+
+def test_rate_limiter_window_and_penalty():
+    limiter = RateLimiter(3, 10, penalty=30)
+
+    assert [limiter.allow("mock", now=t) for t in (0, 1, 2)] == [True, True, True]
+    assert not limiter.allow("mock", now=3)
+    assert limiter.allow("other", now=3)
+    # Still locked out after the window has passed, until the penalty runs out
+    assert not limiter.allow("mock", now=20)
+    assert limiter.allow("mock", now=34)
+
+def test_room_snapshot():
+    room = room_state.RoomState("snaproom", 1, "paulinaMock21", "map.jpg")
+    room.add_character("paulinaMock21", "Yanko", "mrsmock69", "lizardboi.jpg")
+    room.add_character("otherMock", "Fuyuki", "othermock", "mock.jpg")
+    room.set_initiative("otherMock", "Fuyuki", "15")
+    room.add_token("paulinaMock21", "Yanko", "mrsmock69", "lizardboi.jpg", "2em", "2em", "25px", "25px")
+    add_to_db("chat", ("snaproom", "paulinaMock21", "Yanko", "hi", db.current_timestamp()))
+    room.start_combat()
+
+    snapshot = room.snapshot()
+
+    assert [entry["character_name"] for entry in snapshot["initiative"]] == ["Fuyuki", "Yanko"]
+    assert snapshot["turn"] == {"first_turn_name": "Fuyuki", "site_name": "othermock"}
+    assert list(snapshot["tokens"]) == ["paulinaMock21_Yanko"]
+    assert [(chat["character_name"], chat["chat"]) for chat in snapshot["chat"]] == [("Yanko", "hi")]
+    assert snapshot["chat_before_id"] is None
+    assert room.user_characters("paulinaMock21") == ["Yanko"]
+    delete("chat", {"room_id": "snaproom"})
+
+# Tied NPCs differ only in case; the position sent with initiative_update must follow the server's turn order
+def test_initiative_position_matches_turn_order():
+    room = room_state.RoomState("posroom", 1, "paulinaMock21", "map.jpg")
+    for name in ("NPCb", "NPCB", "NPCa", "NPCA"):
+        room.add_character("paulinaMock21", name, "mrsmock69", "npc.jpg")
+    room.set_initiative("paulinaMock21", "NPCa", "12")
+    order = [chr_name for _, chr_name in room.initiative_order()]
+    assert order == ["NPCa", "NPCA", "NPCB", "NPCb"]
+    assert [room.initiative_position("paulinaMock21", name) for name in order] == [0, 1, 2, 3]
+
+# An initiative that isn't a number is refused and leaves the turn order as it was
+def test_set_initiative_refuses_non_numbers():
+    room = room_state.RoomState("badinit", 1, "paulinaMock21", "map.jpg")
+    room.add_character("paulinaMock21", "Yanko", "mrsmock69", "lizardboi.jpg")
+    assert room.set_initiative("paulinaMock21", "Yanko", "15") == 15
+    for init_val in ("fast", "12.5", {"init": 3}, [3]):
+        assert room.set_initiative("paulinaMock21", "Yanko", init_val) is None
+    assert room.initiative[("paulinaMock21", "Yanko")]["init_val"] == 15
+    assert room.initiative_position("paulinaMock21", "Yanko") == 0
+
+def test_chat_history_pages(client_2):
+    add_to_db("room_object", ("paulinaMock21", "History Battle", "histroom", "{}", "map.jpg", ""))
+    for i in range(5):
+        add_to_db("chat", ("histroom", "paulinaMock21", "Yanko", f"message {i}", db.current_timestamp()))
+
+    first_page = client_2.get("/rooms/histroom/history/chat?limit=2").get_json()
+    assert [item["chat"] for item in first_page["items"]] == ["message 3", "message 4"]
+
+    second_page = client_2.get(f"/rooms/histroom/history/chat?limit=2&before_id={first_page['next_before_id']}").get_json()
+    assert [item["chat"] for item in second_page["items"]] == ["message 1", "message 2"]
+
+    rows, next_before_id = db.read_history("chat", "histroom", second_page["next_before_id"], 2)
+    assert [row[2] for row in rows] == ["message 0"]
+    assert next_before_id is None
+    assert client_2.get("/rooms/histroom/history/users").status_code == 400
+    delete("chat", {"room_id": "histroom"})
+    room_state.forget_open_room("histroom")
+
+# History is only served for an open room, over HTTP to its DM and players and over the socket to those that joined it
+def test_history_needs_open_room(mocker):
+    add_to_db("room_object", ("otherMock", "Private Battle", "privroom", "{}", "map.jpg", ""))
+    add_to_db("chat", ("privroom", "otherMock", "Boss", "secret plan", db.current_timestamp()))
+    add_to_db("chat", ("closedroom", "otherMock", "Boss", "old plan", db.current_timestamp()))
+    mocker.patch("flask_login.utils._get_user", return_value = User("paulinaMock21", "Paulina Mock", "mail", "mock.jpg", "mrsmock69"))
+    client = app.test_client()
+
+    assert client.get("/rooms/privroom/history/chat").status_code == 400
+    assert client.get("/rooms/closedroom/history/chat").status_code == 400
+
+    socket = socketio.test_client(app, namespace="/combat", flask_test_client=client)
+    socket.emit("history", {"room_id": "privroom", "kind": "chat"}, namespace="/combat")
+    socket.emit("history", {"room_id": "closedroom", "kind": "chat"}, namespace="/combat")
+    socket.emit("on_join", {"room_id": "closedroom"}, namespace="/combat")
+    socket.emit("history", {"room_id": "closedroom", "kind": "chat"}, namespace="/combat")
+    assert [msg for msg in socket.get_received("/combat") if msg["name"] == "history_page"] == []
+
+    socket.emit("on_join", {"room_id": "privroom"}, namespace="/combat")
+    socket.emit("history", {"room_id": "privroom", "kind": "chat"}, namespace="/combat")
+    pages = [msg["args"][0] for msg in socket.get_received("/combat") if msg["name"] == "history_page"]
+    assert [item["chat"] for item in pages[0]["items"]] == ["secret plan"]
+    socket.disconnect(namespace="/combat")
+
+    for room_id in ("privroom", "closedroom"):
+        delete("chat", {"room_id": room_id})
+    delete("room_object", {"user_key": "otherMock"})
+    room_state.forget_open_room("privroom")
+
+def test_initiative_tracker_turn_order():
+    room = room_state.RoomState("initroom", 1, "paulinaMock21", "map.jpg")
+    for i in range(100):
+        room.add_character("paulinaMock21", f"NPC{i:03d}", "mrsmock69", "npc.jpg")
+        room.set_initiative("paulinaMock21", f"NPC{i:03d}", str(i % 20))
+
+    order = room.initiative_order()
+    assert order[:2] == [("paulinaMock21", "NPC019"), ("paulinaMock21", "NPC039")]
+    assert room.start_combat() == order[0]
+
+    assert room.advance_turn() == (order[0], order[1])
+    room.set_initiative("paulinaMock21", "NPC001", "30")
+    assert room.advance_turn()[1] == order[2]
+
+    room.set_turn(order[-1])
+    assert room.advance_turn() == (order[-1], ("paulinaMock21", "NPC001"))
+
+def test_room_events_resume(client_2):
+    room = room_state.RoomState("seqroom", 1, "paulinaMock21", "map.jpg")
+    for i in range(3):
+        seq = room.next_seq()
+        add_to_db("room_event", ("seqroom", "paulinaMock21", "Chat", "Yanko", db.current_timestamp(), seq, "chat_update", f'{{"chat": "message {i}", "seq": {seq}}}'))
+
+    assert room.events_since(1) == [("chat_update", {"chat": "message 1", "seq": 2}), ("chat_update", {"chat": "message 2", "seq": 3})]
+    assert room.events_since(3) == []
+
+    # An event that never made it to the log can't be replayed, so the client has to take a snapshot
+    room.next_seq()
+    assert room.events_since(1) is None
+    assert room.events_since(-room_state.resume_max_events) is None
+    delete("log", {"room_id": "seqroom"})
+
+def test_retention_closes_stale_rooms(client_2, monkeypatch):
+    monkeypatch.setattr(retention, "batch_size", 2)
+    monkeypatch.setattr(retention, "batch_pause", 0)
+    day = 24 * 3600 * 1000
+    now = db.current_timestamp()
+    add_to_db("room_object", ("paulinaMock21", "Old Cave", "oldroom", "{}", "map.jpg", ""))
+    add_to_db("room_object", ("paulinaMock21", "New Cave", "newroom", "{}", "map.jpg", ""))
+    for i in range(5):
+        add_to_db("chat", ("oldroom", "paulinaMock21", "Yanko", f"old {i}", now - 3 * day))
+        add_to_db("log", ("oldroom", "paulinaMock21", "Chat", "Yanko", now - 2 * day))
+    add_to_db("log", ("newroom", "paulinaMock21", "Connection", "connected", now - 3 * day))
+    add_to_db("log", ("newroom", "paulinaMock21", "Connection", "connected", now))
+
+    report = retention.run_retention(24, now)
+
+    assert (report["rooms_closed"], report["chat_rows"], report["log_rows"]) == (1, 5, 5)
+    assert select_one("room_object", "active_room_id", {"room_name": "Old Cave"}) == ("null",)
+    # An open room keeps its whole history
+    assert len(db.select("log", "row_id", {"room_id": "newroom"})) == 2
+    assert retention.last_report == report
+    delete("log", {"room_id": "newroom"})
+    delete("room_object", {"user_key": "paulinaMock21", "map_url": "map.jpg"})
+
+# Only one worker runs the nightly job, and importing the app in tests never starts the scheduler
+# Initiative and token rows left behind by a closed room go once the room has been quiet for the max age
+def test_retention_purges_orphaned_room_rows(client_2, monkeypatch):
+    monkeypatch.setattr(retention, "batch_size", 1)
+    monkeypatch.setattr(retention, "batch_pause", 0)
+    day = 24 * 3600 * 1000
+    now = db.current_timestamp()
+    add_to_db("room_object", ("paulinaMock21", "Live Cave", "liveorph", "{}", "map.jpg", ""))
+    for room_id, log_time in (("oldorph", now - 2 * day), ("neworph", now), ("liveorph", now)):
+        add_to_db("log", (room_id, "paulinaMock21", "Chat", "Yanko", log_time))
+        for chr_name in ("Yanko", "Goblin"):
+            add_to_db("active_room", (room_id, "paulinaMock21", chr_name, 10, 0, "lizardboi.jpg"))
+            db.add_map_token(room_id, "paulinaMock21", chr_name, "mrsmock69", "lizardboi.jpg", "50", "50", "10", "10")
+
+    report = retention.run_retention(24, now)
+
+    assert (report["active_room_rows"], report["map_token_rows"]) == (2, 2)
+    assert db.select("active_room", "room_id", {"room_id": "oldorph"}) == [] and db.read_map_tokens("oldorph") == []
+    for room_id in ("neworph", "liveorph"):
+        assert len(db.select("active_room", "room_id", {"room_id": room_id})) == 2 and len(db.read_map_tokens(room_id)) == 2
+    for table_name in ("log", "active_room", "map_token"):
+        for room_id in ("neworph", "liveorph"):
+            delete(table_name, {"room_id": room_id})
+    delete("room_object", {"active_room_id": "liveorph"})
+    room_state.forget_open_room("liveorph")
+
+def test_retention_runs_once_across_workers(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "battle_sesh_db", str(tmp_path / "battle_sesh.db"))
+    runs = []
+    monkeypatch.setattr(retention, "run_retention", lambda max_age=None: runs.append(max_age) or {"rooms_closed": 0})
+    assert retention.run_scheduled(24) == {"rooms_closed": 0}
+    assert retention.run_scheduled(24) is None
+    assert runs == [24]
+    assert not scheduler.running
+
+def test_archive_room_before_delete(client_2, tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, "archive_dir", str(tmp_path))
+    monkeypatch.setattr(archive, "batch_size", 2)
+    for i in range(5):
+        add_to_db("chat", ("archroom", "paulinaMock21", "Yanko", f"message {i}", db.current_timestamp()))
+    add_to_db("room_event", ("archroom", "paulinaMock21", "Init", "Yanko's initiative", db.current_timestamp(), 1, "initiative_update", '{"init_val": 12, "seq": 1}'))
+    db.add_map_token("archroom", "paulinaMock21", "Yanko", "mrsmock69", "lizardboi.jpg", "2em", "2em", "25px", "25px")
+
+    path = archive.archive_room("archroom", "Dungeon Battle", "paulinaMock21")
+
+    with gzip.open(path, "rt") as f:
+        records = [json.loads(line) for line in f]
+    assert [record["type"] for record in records] == ["room", "token"] + ["chat"] * 5 + ["log"]
+    assert [record["chat"] for record in records if record["type"] == "chat"] == [f"message {i}" for i in range(5)]
+    assert records[-1]["payload"] == {"init_val": 12, "seq": 1}
+    assert db.select("chat", "row_id", {"room_id": "archroom"}) == []
+    assert db.read_map_tokens("archroom") == []
+
+    listing = client_2.get("/archives").get_json()["archives"]
+    assert [entry["name"] for entry in listing] == [os.path.basename(path)]
+    download = client_2.get(listing[0]["url"])
+    assert download.status_code == 200
+    assert gzip.decompress(download.data).startswith(b'{"type": "room"')
+    assert client_2.get("/archives/../other.jsonl.gz").status_code == 404
+
+def test_metrics_endpoint(mocker):
+    mocker.patch("flask_login.utils._get_user", return_value = User("paulinaMock21", "Paulina Mock", "mail", "mock.jpg", "mrsmock69"))
+    client = app.test_client()
+    add_to_db("room_object", ("paulinaMock21", "Metrics Battle", "metricsroom", "{}", "map.jpg", ""))
+    history_route = ("/rooms/<room_id>/history/<kind>", "GET", 200)
+    requests_before = metrics.http_requests.values.get(history_route, 0)
+    events_before = metrics.event_latency.series.get(("history",), [None, 0, 0])[2]
+    socket = socketio.test_client(app, namespace="/combat", flask_test_client=client)
+    socket.emit("on_join", {"room_id": "metricsroom"}, namespace="/combat")
+    socket.emit("history", {"room_id": "metricsroom", "kind": "chat"}, namespace="/combat")
+    client.get("/rooms/metricsroom/history/chat")
+
+    body = client.get("/metrics").get_data(as_text=True)
+    assert f'battlemap_http_requests_total{{route="/rooms/<room_id>/history/<kind>",method="GET",status="200"}} {requests_before + 1}' in body
+    assert f'battlemap_socket_event_duration_seconds_count{{event="history"}} {events_before + 1}' in body
+    assert f'battlemap_socket_event_duration_seconds_bucket{{event="history",le="+Inf"}} {events_before + 1}' in body
+    assert "battlemap_connected_sockets 1" in body
+    socket.disconnect(namespace="/combat")
+    delete("room_object", {"active_room_id": "metricsroom"})
+    room_state.forget_open_room("metricsroom")
+
+# Query budgets for the busiest socket events. The counts must not grow with the number of characters in the room
+@pytest.mark.parametrize("event, budget", [("join_actions", 2), ("start_combat", 2), ("end_combat", 2)])
+def test_socket_event_query_budget(mocker, event, budget):
+    mocker.patch("flask_login.utils._get_user", return_value = User("paulinaMock21", "Paulina Mock", "mail", "mock.jpg", "mrsmock69"))
+    add_to_db("room_object", ("paulinaMock21", "Budget Battle", "budgetroom", "{}", "map.jpg", ""))
+    room = room_state.get_room("budgetroom")
+    for i in range(8):
+        room.add_character(f"budgetMock{i}", f"Hero {i}", f"budgetmock{i}", "hero.jpg")
+        room.set_initiative(f"budgetMock{i}", f"Hero {i}", str(i))
+    if event == "end_combat":
+        room.start_combat()
+    room.checkpoint()
+    socket = socketio.test_client(app, namespace="/combat")
+    db.write_behind.flush()
+
+    with db.traced(event) as trace:
+        socket.emit(event, {"room_id": "budgetroom", "character_name": "", "desc": ""}, namespace="/combat")
+
+    assert trace.count <= budget, trace.statements
+    socket.disconnect(namespace="/combat")
+    room_state.drop_room("budgetroom")
+    delete("active_room", {"room_id": "budgetroom"})
+    delete("log", {"room_id": "budgetroom"})
+    delete("room_object", {"active_room_id": "budgetroom"})
+
+# Debug-only diagnostics cost nothing when the level is off, and token moves are sampled
+def test_logging_levels_and_sampling(mocker):
+    mocker.patch("flask_login.utils._get_user", return_value = User("paulinaMock21", "Paulina Mock", "mail", "mock.jpg", "mrsmock69"))
+    client = app.test_client()
+    queries = {}
+    old_level = logs.http_log.level
+    for level in (logging.INFO, logging.DEBUG):
+        logs.http_log.setLevel(level)
+        with db.traced("home") as trace:
+            client.get("/home")
+        queries[level] = trace.count
+    logs.http_log.setLevel(old_level)
+    assert queries[logging.DEBUG] == queries[logging.INFO] + 2
+
+    sample = logs.Sample(5)
+    records = [logging.LogRecord("combat.tokens", logging.DEBUG, __file__, 0, "Token moved", ({"room_id": "r"},), None) for _ in range(20)]
+    kept = [record for record in records if sample.filter(record)]
+    assert len(kept) == 4
+    assert logs.KeyValueFormatter().format(kept[0]).endswith("Token moved room_id=r sampled=1/5")
+
+# Repeats of an error are one group with a count, and distinct errors past max_groups are dropped until the next flush
+def test_error_store_groups_repeats(monkeypatch):
+    monkeypatch.setattr(errors, "max_groups", 2)
+    store = errors.ErrorStore(interval=3600)
+    for i in range(50):
+        key = store.report("ClientError", "browser", f"Cannot read property 'token{i}' of undefined at line {i}")
+    store.report("ClientError", "browser", "Lost connection to the room")
+    store.report("ClientError", "browser", "Map image failed to load")
+    assert store.flush() == 2
+    assert store.dropped == 0 and len(store.recent) == 52
+
+    for i in range(3):
+        store.report("ClientError", "browser", f"Cannot read property 'npc{i}' of undefined at line {i + 7}")
+    store.flush()
+    group = dict(zip(db.error_group_columns, next(row for row in db.read_error_db() if row[0] == key)))
+    assert group["count"] == 53
+    assert group["message"] == "Cannot read property '?' of undefined at line ?"
+    assert group["sample"] == "Cannot read property 'token0' of undefined at line 0"
+
+# A flush that fails with something other than a database error doesn't end the flusher thread
+def test_error_store_survives_failed_flush(monkeypatch):
+    key = errors.fingerprint("ClientError", "browser", "Map image failed to load")
+    written = []
+    real_add_error_groups = db.add_error_groups
+    def add_error_groups(groups):
+        # The app's own error store may flush through here too
+        if key not in [group[0] for group in groups]:
+            return real_add_error_groups(groups)
+        if not written:
+            written.append(None)
+            raise RuntimeError("disk gone")
+        written.append(groups)
+    monkeypatch.setattr(db, "add_error_groups", add_error_groups)
+    store = errors.ErrorStore(interval=0.01)
+    store.report("ClientError", "browser", "Map image failed to load")
+    for _ in range(200):
+        if len(written) > 1:
+            break
+        store.thread.join(0.01)
+
+    assert store.thread.is_alive()
+    assert [group[0] for group in written[1]] == [key]
+
+# Open rooms are found without a query, and an id already taken by a room the registry hasn't seen is passed over
+def test_open_room_registry(mocker):
+    mocker.patch("flask_login.utils._get_user", return_value = User("paulinaMock21", "Paulina Mock", "mail", "mock.jpg", "mrsmock69"))
+    client = app.test_client()
+    add_to_db("room_object", ("otherMock", "Elsewhere", "takenid1", "{}", "map.jpg", ""))
+    add_to_db("room_object", ("paulinaMock21", "Registry Battle", "null", "{}", "registry.jpg", ""))
+    row_id = select_one("room_object", "row_id", {"room_name": "Registry Battle"})[0]
+
+    ids = iter(["takenid1", "freshid1"])
+    assert room_state.open_room(row_id, "paulinaMock21", "Registry Battle", "registry.jpg", lambda: next(ids)) == "freshid1"
+    with db.traced("spectate") as trace:
+        response = client.get("/spectate/freshid1")
+    assert response.status_code == 200 and trace.count == 0
+    assert room_state.find_open_room("takenid1").owner == "otherMock"
+    assert room_state.find_open_room("null") is None
+
+    for room_id in ("takenid1", "freshid1"):
+        room_state.forget_open_room(room_id)
+        delete("room_object", {"active_room_id": room_id})
+
+# /errors holds tracebacks, so it is closed unless METRICS_TOKEN is set and sent
+def test_errors_endpoint_needs_token(monkeypatch):
+    client = app.test_client()
+    monkeypatch.setitem(app.config, "METRICS_TOKEN", None)
+    assert client.get("/errors").status_code == 401
+    monkeypatch.setitem(app.config, "METRICS_TOKEN", "s3cret")
+    assert client.get("/errors", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    assert client.get("/errors", headers={"Authorization": "Bearer s3cret"}).status_code == 200
+    assert client.get("/errors?limit=abc", headers={"Authorization": "Bearer s3cret"}).status_code == 400
+
+# The operator diagnostics need METRICS_TOKEN, a logged in player can't see them
+@pytest.mark.parametrize("route", ["/startup", "/cache", "/retention"])
+def test_operator_routes_need_token(route, mocker, monkeypatch):
+    mocker.patch("flask_login.utils._get_user", return_value = User("paulinaMock21", "Paulina Mock", "mail", "mock.jpg", "mrsmock69"))
+    client = app.test_client()
+    monkeypatch.setitem(app.config, "METRICS_TOKEN", None)
+    assert client.get(route).status_code == 401
+    monkeypatch.setitem(app.config, "METRICS_TOKEN", "s3cret")
+    assert client.get(route).status_code == 401
+    assert client.get(route, headers={"Authorization": "Bearer s3cret"}).status_code == 200
+
+# Reopening a room under a new key closes the old one, including the RoomState loaded for it
+def test_generate_room_closes_old_id(mocker, monkeypatch):
+    mocker.patch("flask_login.utils._get_user", return_value = User("paulinaMock21", "Paulina Mock", "mail", "mock.jpg", "mrsmock69"))
+    monkeypatch.setitem(app.config, "WTF_CSRF_ENABLED", False)
+    client = app.test_client()
+    add_to_db("room_object", ("paulinaMock21", "Reopened Battle", "null", "{}", "map.jpg", ""))
+    old_id = client.post("/generate_room", data={"room_name": "Reopened Battle"}).headers["Location"].rsplit("/", 1)[1]
+    room_state.get_room(old_id).add_character("paulinaMock21", "Yanko", "mrsmock69", "lizardboi.jpg")
+    room_state.get_room(old_id).checkpoint()
+
+    new_id = client.post("/generate_room", data={"room_name": "Reopened Battle"}).headers["Location"].rsplit("/", 1)[1]
+    assert new_id != old_id
+    assert room_state.get_room(old_id) is None and old_id not in room_state.rooms
+    assert select_one("active_room", "chr_name", {"room_id": old_id}) is None
+    assert room_state.find_open_room(new_id).room_name == "Reopened Battle"
+    room_state.forget_open_room(new_id)
+    delete("room_object", {"active_room_id": new_id})
+
 # SocketIO Event Tests
 
 # def test_open_room(client_2):